@@ -1,16 +1,113 @@
-from flask import Flask, request, jsonify, g, session, redirect, url_for, send_from_directory
+from flask import Flask, Response, request, jsonify, g, session, redirect, url_for, send_from_directory, stream_with_context, abort
+from werkzeug.utils import safe_join
 from werkzeug.security import generate_password_hash, check_password_hash
 from dotenv import load_dotenv
+import click
 import os
 import functools
 import uuid # Для уникальных имен файлов
+import hashlib
+import mimetypes
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 # Загружаем переменные окружения из .env файла
 load_dotenv()
 
 # Импортируем конфигурацию и функции для работы с БД
 from config import Config
-from database import get_db, close_db, init_app
+from database import get_db, get_read_db, get_batch_writer, get_background_writer, close_db, write_transaction, fold_search_text, init_app
+from events import ChatNotifier, EventBroker, format_sse
+from cache import TTLCache
+from jsonstream import LazyArray, LazyValue, iter_json
+from compression import choose_encoding, compress_body, compress_stream, etag_variants
+from negotiation import MSGPACK_MIMETYPES, choose_mimetype, pack
+from thumbnails import THUMBNAILS_AVAILABLE, build_thumbnail, is_image
+from storage import LocalStorage, create_storage
+from upload_gc import collect_legacy_files, collect_orphan_files, collect_unreferenced_blobs, collect_upload_sessions
+
+# CTE my_chats: все чаты пользователя :user_id (личные, группы, каналы) с его ролью
+# и участниками личного чата. Используется в списке чатов и в поиске по сообщениям.
+USER_CHATS_CTE = """
+    WITH my_chats AS (
+        SELECT pc.chat_id AS chat_id, NULL AS role, pc.user1_id, pc.user2_id,
+               CASE WHEN pc.user1_id = :user_id THEN pc.user2_id ELSE pc.user1_id END AS peer_id
+        FROM private_chats pc
+        WHERE pc.user1_id = :user_id OR pc.user2_id = :user_id
+        UNION ALL
+        SELECT gm.group_id, gm.role, NULL, NULL, NULL FROM group_members gm WHERE gm.user_id = :user_id
+        UNION ALL
+        SELECT cs.channel_id, NULL, NULL, NULL, NULL FROM channel_subscribers cs WHERE cs.user_id = :user_id
+    )
+"""
+
+# Общая часть запроса сообщений.
+# LEFT JOIN с users для получения display_name отправителя.
+# CASE WHEN u.is_deleted = TRUE OR u.id IS NULL для отображения "Удаленный пользователь"
+MESSAGE_SELECT_SQL = """
+    SELECT
+        m.id,
+        m.chat_id,
+        m.sender_id,
+        CASE
+            WHEN u.is_deleted = TRUE OR u.id IS NULL THEN 'Удаленный пользователь'
+            ELSE u.display_name
+        END AS sender_display_name,
+        CASE
+            WHEN u.is_deleted = TRUE OR u.id IS NULL THEN NULL -- Аватар удаленного пользователя
+            ELSE u.avatar_url
+        END AS sender_avatar_url,
+        m.message_type,
+        m.content,
+        m.file_url,
+        m.file_name,
+        m.file_size,
+        m.file_sha256,
+        m.width,
+        m.height,
+        m.sent_at,
+        m.is_deleted,
+        m.revision
+    FROM messages m
+    LEFT JOIN users u ON m.sender_id = u.id
+"""
+
+# Сколько значений передавать в одном IN (...): меньше лимита переменных SQLite (999 в старых сборках)
+IN_QUERY_BATCH = 500
+
+# Поиск пользователей: до скольких совпадений начала строки сортировать по id, а не искать в потоке FTS
+USER_SEARCH_PREFIX_SORT_MAX = 256
+
+# Имя файла в хранилище по адресу содержимого - SHA-256 в hex
+SHA256_RE = re.compile(r'^[0-9a-f]{64}$')
+# Файлы, загруженные до хранения по адресу содержимого: <uuid4>.<ext>
+UUID_FILENAME_RE = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}\.\w+$')
+
+# Компактный формат (format=compact): без JOIN с users, отправители передаются
+# один раз на страницу в карте users (см. _load_users_map)
+MESSAGE_COMPACT_SELECT_SQL = """
+    SELECT
+        m.id,
+        m.chat_id,
+        m.sender_id,
+        m.message_type,
+        m.content,
+        m.file_url,
+        m.file_name,
+        m.file_size,
+        m.file_sha256,
+        m.width,
+        m.height,
+        m.sent_at,
+        m.is_deleted,
+        m.revision
+    FROM messages m
+"""
 
 def create_app():
     app = Flask(__name__)
@@ -18,9 +115,35 @@ def create_app():
 
     init_app(app)
 
+    # Брокер push-событий (Server-Sent Events) для подключенных клиентов
+    event_broker = EventBroker(max_queue_size=app.config['EVENTS_QUEUE_SIZE'])
+    # Уведомитель для long polling (GET /api/chats/<id>/messages/sync?wait=...)
+    chat_notifier = ChatNotifier()
+    # Кеш прав доступа: (user_id, chat_id) -> результат _get_chat_access.
+    # Сбрасывается эндпоинтами, которые меняют состав участников или роли.
+    chat_access_cache = TTLCache(app.config['CHAT_ACCESS_CACHE_SIZE'], app.config['CHAT_ACCESS_CACHE_TTL'])
+    # Кеш строк пользователей для load_logged_in_user: user_id -> dict.
+    # Сбрасывается при изменении профиля, пароля и удалении аккаунта.
+    user_cache = TTLCache(app.config['USER_CACHE_SIZE'], app.config['USER_CACHE_TTL'])
+    # Пул процессов для миниатюр: декодирование изображений не занимает GIL рабочих потоков.
+    # Процессы запускаются при первой задаче; spawn - потому что в процессе уже работают потоки.
+    thumbnail_executor = None
+    if app.config['THUMBNAILS_ENABLED'] and THUMBNAILS_AVAILABLE:
+        thumbnail_executor = ProcessPoolExecutor(max_workers=app.config['THUMBNAIL_WORKERS'],
+                                                 mp_context=multiprocessing.get_context('spawn'))
+    # Миниатюры, которые сейчас строятся: повторные запросы не ставят ту же задачу в пул
+    thumbnails_pending = set()
+    thumbnails_pending_lock = threading.Lock()
+    # Файлы, для которых миниатюру построить не удалось (поврежденное изображение): не повторяем час
+    thumbnails_failed = TTLCache(1024, 3600)
+
     # Убедимся, что папка для загрузок существует
     if not os.path.exists(app.config['UPLOAD_FOLDER']):
         os.makedirs(app.config['UPLOAD_FOLDER'])
+    os.makedirs(app.config['UPLOAD_TEMP_FOLDER'], exist_ok=True) # Недокачанные части возобновляемых загрузок
+    os.makedirs(app.config['THUMBNAIL_FOLDER'], exist_ok=True)
+    # Передачу файлов выполняет фронт-прокси (см. uploaded_file)
+    app.config['USE_X_SENDFILE'] = app.config['FILE_OFFLOAD'] == 'x-sendfile'
 
     # --- Вспомогательные функции для аутентификации ---
     def login_required(view):
@@ -37,13 +160,19 @@ def create_app():
         if user_id is None:
             g.user = None
         else:
-            db = get_db()
-            cursor = db.cursor()
-            cursor.execute(
-                "SELECT id, username, display_name, email, avatar_url, is_deleted FROM users WHERE id = ?", (user_id,)
-            )
-            user_data = cursor.fetchone()
-            cursor.close()
+            # При попадании в кеш соединение с БД для запроса даже не открывается
+            user_data = user_cache.get(user_id)
+            if user_data is None:
+                db = get_read_db() # Только чтение: не занимаем соединение-писатель
+                cursor = db.cursor()
+                cursor.execute(
+                    "SELECT id, username, display_name, email, avatar_url, is_deleted FROM users WHERE id = ?", (user_id,)
+                )
+                row = cursor.fetchone()
+                cursor.close()
+                if row and not row['is_deleted']:
+                    user_data = dict(row)
+                    user_cache.set(user_id, user_data)
 
             if user_data and not user_data['is_deleted']:
                 g.user = user_data
@@ -51,11 +180,572 @@ def create_app():
                 g.user = None
                 session.clear()
 
+    @app.after_request
+    def compress_json_response(response):
+        """
+        Сжимает JSON- и MessagePack-ответы (gzip, brotli при наличии модуля) по заголовку Accept-Encoding.
+        Обычные ответы сжимаются, начиная с COMPRESSION_MIN_SIZE байт;
+        потоковые ответы (размер заранее неизвестен) сжимаются всегда, по мере генерации.
+        """
+        if not app.config['COMPRESSION_ENABLED'] or response.mimetype not in ('application/json',) + MSGPACK_MIMETYPES:
+            return response
+        response.vary.add('Accept-Encoding')
+        if response.status_code not in (200, 304) or 'Content-Encoding' in response.headers \
+                or response.direct_passthrough:
+            return response
+        encoding = choose_encoding(request.accept_encodings)
+        if encoding is None:
+            return response
+        level = {'gzip': app.config['COMPRESSION_GZIP_LEVEL'], 'br': app.config['COMPRESSION_BROTLI_QUALITY']}
+
+        if response.status_code == 200:
+            if response.is_streamed:
+                response.response = compress_stream(response.response, encoding, level)
+                response.headers.pop('Content-Length', None)
+            else:
+                data = response.get_data()
+                if len(data) < app.config['COMPRESSION_MIN_SIZE']:
+                    return response
+                response.set_data(compress_body(data, encoding, level))
+            response.headers['Content-Encoding'] = encoding
+        # Сжатое представление получает свой ETag (в том числе в ответе 304)
+        etag, weak = response.get_etag()
+        if etag:
+            response.set_etag(f'{etag}-{encoding}', weak)
+        return response
+
     # --- Вспомогательная функция для проверки разрешенных расширений файлов ---
     def allowed_file(filename):
         return '.' in filename and \
                filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
 
+    # --- Вспомогательные функции для сообщений ---
+    def _parse_page_limit(raw_limit):
+        """Проверяет параметр limit и приводит его к допустимому диапазону."""
+        if raw_limit is None or raw_limit == '':
+            return app.config['MESSAGES_PAGE_SIZE']
+        try:
+            limit = int(raw_limit)
+        except (TypeError, ValueError):
+            raise ValueError('Параметр limit должен быть целым числом.')
+        if limit < 1:
+            raise ValueError('Параметр limit должен быть положительным.')
+        return min(limit, app.config['MESSAGES_MAX_PAGE_SIZE'])
+
+    def _parse_message_id_arg(name):
+        """Читает необязательный курсор пагинации (before_id/after_id). Бросает ValueError при ошибке."""
+        raw_value = request.args.get(name)
+        if raw_value is None or raw_value == '':
+            return None
+        try:
+            value = int(raw_value)
+        except ValueError:
+            raise ValueError(f'Параметр {name} должен быть целым числом.')
+        if value < 0:
+            raise ValueError(f'Параметр {name} не может быть отрицательным.')
+        return value
+
+    def _get_chat_access(cursor, chat_id, user_id):
+        """
+        Возвращает права пользователя в чате или None, если чат не найден:
+        {'type', 'owner_id', 'is_member', 'role', 'can_send', 'can_delete_any'}.
+        Результат кешируется; при промахе все проверки выполняются одним запросом.
+        """
+        cache_key = (user_id, chat_id)
+        access = chat_access_cache.get(cache_key)
+        if access is not None:
+            return access
+
+        cursor.execute(
+            """
+            SELECT
+                c.type,
+                c.owner_id,
+                EXISTS(SELECT 1 FROM private_chats pc WHERE pc.chat_id = c.id AND (pc.user1_id = ? OR pc.user2_id = ?)) AS is_private_member,
+                (SELECT gm.role FROM group_members gm WHERE gm.group_id = c.id AND gm.user_id = ?) AS group_role,
+                EXISTS(SELECT 1 FROM channel_subscribers cs WHERE cs.channel_id = c.id AND cs.user_id = ?) AS is_subscriber
+            FROM chats c
+            WHERE c.id = ?
+            """,
+            (user_id, user_id, user_id, user_id, chat_id)
+        )
+        row = cursor.fetchone()
+        if row is None:
+            return None # Несуществующие чаты не кешируем
+
+        chat_type = row['type']
+        access = {'type': chat_type, 'owner_id': row['owner_id'], 'is_member': False, 'role': None,
+                  'can_send': False, 'can_delete_any': False}
+        if chat_type == 'private':
+            access['is_member'] = bool(row['is_private_member'])
+            access['can_send'] = access['is_member']
+        elif chat_type == 'group':
+            access['role'] = row['group_role']
+            access['is_member'] = row['group_role'] is not None
+            # Только админы и обычные участники могут писать. 'restricted' не могут.
+            access['can_send'] = row['group_role'] in ['admin', 'member']
+            access['can_delete_any'] = row['group_role'] == 'admin'
+        elif chat_type == 'channel':
+            access['is_member'] = bool(row['is_subscriber'])
+            # В канале пишет и удаляет сообщения только владелец
+            is_owner = row['owner_id'] is not None and row['owner_id'] == user_id
+            access['can_send'] = is_owner
+            access['can_delete_any'] = is_owner
+
+        chat_access_cache.set(cache_key, access)
+        return access
+
+    def _invalidate_chat_access(chat_id, user_id=None):
+        """Сбрасывает кеш прав для участника чата или для всех участников чата."""
+        if user_id is not None:
+            chat_access_cache.invalidate((user_id, chat_id))
+        else:
+            chat_access_cache.invalidate_where(lambda key: key[1] == chat_id)
+
+    def _check_chat_read_access(cursor, chat_id, user_id):
+        """
+        Проверяет, что пользователь является участником/подписчиком чата.
+        Возвращает None при наличии доступа, иначе готовый ответ с ошибкой.
+        """
+        access = _get_chat_access(cursor, chat_id, user_id)
+        if access is None:
+            return jsonify({'error': 'Чат не найден.'}), 404
+        if not access['is_member']:
+            return jsonify({'error': 'У вас нет доступа к этому чату.'}), 403
+        return None
+
+    def _get_chat_revision(cursor, chat_id):
+        """Возвращает текущую ревизию сообщений чата (0, если сообщений нет)."""
+        cursor.execute("SELECT COALESCE(MAX(revision), 0) FROM messages WHERE chat_id = ?", (chat_id,))
+        return cursor.fetchone()[0]
+
+    def _get_chat_member_ids(cursor, chat_id):
+        """Возвращает ID всех участников/подписчиков чата независимо от его типа."""
+        cursor.execute(
+            """
+            SELECT user1_id AS user_id FROM private_chats WHERE chat_id = ?
+            UNION SELECT user2_id FROM private_chats WHERE chat_id = ?
+            UNION SELECT user_id FROM group_members WHERE group_id = ?
+            UNION SELECT user_id FROM channel_subscribers WHERE channel_id = ?
+            """,
+            (chat_id, chat_id, chat_id, chat_id)
+        )
+        return [row['user_id'] for row in cursor.fetchall()]
+
+    def _publish_message_event(cursor, chat_id, message_id, event_name):
+        """
+        Будит long polling запросы чата и рассылает событие о сообщении
+        подключенным участникам. Вызывается после commit; ошибки доставки
+        не влияют на результат запроса.
+        """
+        chat_notifier.notify(chat_id)
+        if not event_broker.has_subscribers():
+            return
+        try:
+            cursor.execute(MESSAGE_SELECT_SQL + " WHERE m.id = ?", (message_id,))
+            msg = cursor.fetchone()
+            if msg is None:
+                return
+            member_ids = _get_chat_member_ids(cursor, chat_id)
+            event_broker.publish(member_ids, event_name, _format_message(msg))
+        except Exception as e:
+            print(f"Ошибка при публикации события {event_name}: {e}")
+
+    def _insert_message(sql, params):
+        """
+        Добавляет сообщение и возвращает его ID. При включенном групповом коммите
+        INSERT уходит в BatchWriter и коммитится вместе с соседними запросами.
+        """
+        batch_writer = get_batch_writer()
+        if batch_writer is not None:
+            return batch_writer.execute(sql, params, timeout=app.config['DB_WRITER_TIMEOUT'])
+        with write_transaction() as writer:
+            return writer.execute(sql, params).lastrowid
+
+    # --- Хранилище файлов по адресу содержимого (SHA-256) ---
+    def _get_storage():
+        """Хранилище загрузок (STORAGE_BACKEND): локальные каталоги-шарды или S3-совместимое."""
+        storage = app.extensions.get('upload_storage')
+        if storage is None:
+            storage = app.extensions['upload_storage'] = create_storage(app.config)
+        return storage
+
+    def _store_blob(stream):
+        """
+        Сохраняет поток в хранилище, вычисляя SHA-256 по мере записи (файл не читается повторно).
+        Возвращает (sha256, size).
+        """
+        digest = hashlib.sha256()
+        size = 0
+        fd, temp_path = tempfile.mkstemp(dir=app.config['UPLOAD_TEMP_FOLDER'], suffix='.blob')
+        try:
+            with os.fdopen(fd, 'wb') as temp:
+                while True:
+                    chunk = stream.read(64 * 1024)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    temp.write(chunk)
+                    size += len(chunk)
+            sha256 = digest.hexdigest()
+            _put_blob(sha256, size, temp_path)
+            return sha256, size
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def _hash_file(path):
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def _touch_blob(sha256, size):
+        """
+        Регистрирует файл в blobs или обновляет updated_at ("касание"): сборщик мусора (gc-uploads)
+        удаляет строку и файл в одной транзакции записи и только после UPLOAD_GC_GRACE_PERIOD
+        с последнего касания. После касания файл с этим содержимым не пропадет.
+        """
+        sql = """
+            INSERT INTO blobs (sha256, size) VALUES (?, ?)
+            ON CONFLICT(sha256) DO UPDATE SET updated_at = CURRENT_TIMESTAMP
+        """
+        batch_writer = get_batch_writer()
+        if batch_writer is not None:
+            batch_writer.execute(sql, (sha256, size), timeout=app.config['DB_WRITER_TIMEOUT'])
+        else:
+            with write_transaction() as writer:
+                writer.execute(sql, (sha256, size))
+
+    def _put_blob(sha256, size, source_path):
+        """
+        Переносит готовый файл в хранилище: касание blobs - короткая транзакция до переноса,
+        сам перенос (возможно, в S3) идет без соединения-писателя.
+        Если такое содержимое уже хранится, копия удаляется.
+        """
+        _touch_blob(sha256, size)
+        _get_storage().put_file(sha256, source_path)
+
+    def _find_blob(cursor, sha256, size):
+        """
+        True, если файл с таким содержимым уже хранится (повторная отправка без загрузки).
+        Наличие файла проверяется после касания blobs, иначе его мог удалить сборщик мусора.
+        """
+        cursor.execute("SELECT size FROM blobs WHERE sha256 = ?", (sha256,))
+        row = cursor.fetchone()
+        if row is None or row['size'] != size:
+            return False
+        _touch_blob(sha256, size)
+        return _get_storage().exists(sha256)
+
+    # --- Миниатюры изображений ---
+    def _get_thumbnails():
+        """Кеш миниатюр на диске (<sha256>.jpg), разложенный по каталогам-шардам так же, как загрузки."""
+        thumbnails = app.extensions.get('thumbnail_storage')
+        if thumbnails is None:
+            thumbnails = app.extensions['thumbnail_storage'] = LocalStorage(
+                app.config['THUMBNAIL_FOLDER'], shard_depth=app.config['STORAGE_SHARD_DEPTH']
+            )
+        return thumbnails
+
+    def _thumbnail_path(sha256):
+        return _get_thumbnails().local_path(sha256 + '.jpg')
+
+    def _submit_thumbnail(sha256):
+        """
+        Ставит построение миниатюры в пул процессов, если она еще не строится. Когда она готова,
+        размеры изображения записываются во все сообщения с этим файлом.
+        """
+        with thumbnails_pending_lock:
+            if sha256 in thumbnails_pending:
+                return
+            thumbnails_pending.add(sha256)
+        try:
+            future = thumbnail_executor.submit(build_thumbnail, _get_storage(), sha256, _thumbnail_path(sha256),
+                                               app.config['THUMBNAIL_SIZE'], app.config['THUMBNAIL_QUALITY'])
+        except Exception:
+            with thumbnails_pending_lock:
+                thumbnails_pending.discard(sha256)
+            raise
+        future.add_done_callback(functools.partial(_record_image_size, sha256))
+
+    def _record_image_size(sha256, future):
+        """
+        Вызывается в служебном потоке пула процессов, вне запроса. Запись размеров ставится
+        в очередь фонового писателя: поток пула не ждет соединение-писатель.
+        """
+        with thumbnails_pending_lock:
+            thumbnails_pending.discard(sha256)
+        try:
+            width, height = future.result()
+        except Exception as e:
+            print(f"Ошибка при построении миниатюры {sha256}: {e}")
+            thumbnails_failed.set(sha256, True)
+            return
+
+        def notify_chats(rows, error):
+            if error is not None:
+                print(f"Ошибка при сохранении размеров изображения {sha256}: {error}")
+                return
+            for chat_id in {row['chat_id'] for row in rows}:
+                chat_notifier.notify(chat_id) # Размеры приходят клиентам через синхронизацию
+
+        try:
+            with app.app_context():
+                get_background_writer().submit(
+                    "UPDATE messages SET width = ?, height = ? WHERE file_sha256 = ? AND width IS NULL RETURNING chat_id",
+                    (width, height, sha256),
+                    callback=notify_chats
+                )
+        except Exception as e:
+            print(f"Ошибка при сохранении размеров изображения {sha256}: {e}")
+
+    def _create_file_message(cursor, chat_id, sender_id, sha256, original_filename, file_size):
+        """
+        Добавляет файловое сообщение для файла, уже сохраненного в хранилище под именем sha256.
+        Счетчик ссылок blobs.ref_count увеличивает триггер на INSERT в messages.
+        cursor нужен только для чтения. Возвращает (message_id, file_url).
+        """
+        # Касание откладывает сборку мусора файла до появления ссылки
+        _touch_blob(sha256, file_size)
+
+        # Размеры уже известны, если это изображение загружали раньше (миниатюра есть на диске)
+        width = height = None
+        thumbnail_needed = thumbnail_executor is not None and is_image(original_filename)
+        if thumbnail_needed:
+            cursor.execute("SELECT width, height FROM messages WHERE file_sha256 = ? AND width IS NOT NULL LIMIT 1", (sha256,))
+            known = cursor.fetchone()
+            if known is not None and os.path.exists(_thumbnail_path(sha256)):
+                width, height = known['width'], known['height']
+                thumbnail_needed = False
+
+        # Расширение в URL нужно только для типа содержимого при отдаче
+        filename = sha256 + '.' + original_filename.rsplit('.', 1)[1].lower()
+        # _external=True необходимо для создания полного URL, доступного извне
+        file_url = url_for('uploaded_file', filename=filename, _external=True)
+        message_id = _insert_message(
+            "INSERT INTO messages (chat_id, sender_id, message_type, file_url, file_name, file_size, file_sha256, width, height) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (chat_id, sender_id, 'file', file_url, original_filename, file_size, sha256, width, height)
+        )
+        _publish_message_event(cursor, chat_id, message_id, 'message_created')
+        if thumbnail_needed:
+            _submit_thumbnail(sha256) # Ответ не ждет миниатюру
+        return message_id, file_url
+
+    def _build_fts_query(raw_query):
+        """
+        Превращает пользовательский ввод в безопасное выражение FTS5:
+        каждое слово берется в кавычки (спецсимволы FTS5 не интерпретируются)
+        и ищется по префиксу; слова объединяются через AND.
+        """
+        terms = [term.replace('"', '""') for term in raw_query.split()]
+        return ' '.join(f'"{term}"*' for term in terms if term)
+
+    def _search_messages(cursor, fts_query, chat_filter_sql, params, limit, offset):
+        """
+        Выполняет ранжированный (bm25) поиск по messages_fts.
+        chat_filter_sql ограничивает набор чатов; возвращает (сообщения со сниппетами, has_more).
+        """
+        # Сортировку только по rank выполняет сам FTS5, и строки идут уже в порядке ранга:
+        # LIMIT останавливает выборку, сниппеты строятся только для страницы, а не для каждого совпадения.
+        # Данные сообщений читаются отдельным запросом по id страницы.
+        cursor.execute(
+            chat_filter_sql[0] + f"""
+            SELECT m.id, snippet(messages_fts, -1, '<b>', '</b>', '…', 12) AS snippet
+            FROM messages_fts
+            JOIN messages m ON m.id = messages_fts.rowid
+            WHERE messages_fts MATCH :fts_query AND m.is_deleted = FALSE AND {chat_filter_sql[1]}
+            ORDER BY messages_fts.rank
+            LIMIT :limit OFFSET :offset
+            """,
+            dict(params, fts_query=fts_query, limit=limit + 1, offset=offset)
+        )
+        hits = cursor.fetchall()
+        has_more = len(hits) > limit
+        hits = hits[:limit]
+        if not hits:
+            return [], False
+
+        placeholders = ', '.join('?' for _ in hits)
+        cursor.execute(MESSAGE_SELECT_SQL + f" WHERE m.id IN ({placeholders})", [hit['id'] for hit in hits])
+        rows_by_id = {row['id']: row for row in cursor.fetchall()}
+
+        results = []
+        for hit in hits: # Сохраняем порядок ранжирования
+            row = rows_by_id.get(hit['id'])
+            if row is not None:
+                message = _format_message(row)
+                message['snippet'] = hit['snippet']
+                results.append(message)
+        return results, has_more
+
+    def _parse_search_args():
+        """Разбирает q/limit/offset поисковых эндпоинтов. Бросает ValueError при ошибке."""
+        fts_query = _build_fts_query(request.args.get('q', ''))
+        limit = _parse_page_limit(request.args.get('limit'))
+        offset = request.args.get('offset', default=0, type=int)
+        if offset < 0:
+            raise ValueError('Параметр offset не может быть отрицательным.')
+        return fts_query, limit, offset
+
+    def _user_search_match(query):
+        """
+        Выбирает FTS5-индекс пользователей для запроса.
+        Возвращает (нормализованный запрос, имя FTS-таблицы, выражение MATCH).
+        """
+        folded = fold_search_text(query)
+        escaped = folded.replace('"', '""')
+        if len(folded) >= 3:
+            # Подстрока: trigram-индекс
+            return folded, 'users_trigram_fts', f'"{escaped}"'
+        # Короткий запрос: начало любого слова, prefix-индекс на 1-2 символа
+        return folded, 'users_prefix_fts', f'"{escaped}"*'
+
+    def _get_revision(cursor, name):
+        """Возвращает счетчик ревизий набора данных из таблицы revisions."""
+        cursor.execute("SELECT revision FROM revisions WHERE name = ?", (name,))
+        row = cursor.fetchone()
+        return row['revision'] if row else 0
+
+    def _make_etag(*parts):
+        """
+        Строит ETag из ревизии данных и параметров, от которых зависит представление.
+        Формат ответа (JSON/MessagePack) учитывается автоматически.
+        """
+        parts += (_response_mimetype(),)
+        return hashlib.sha1('|'.join(str(part) for part in parts).encode('utf-8')).hexdigest()[:20]
+
+    def _not_modified(etag):
+        """Возвращает ответ 304, если клиент прислал актуальный ETag (If-None-Match), иначе None."""
+        # Клиент мог получить ETag сжатого представления (с суффиксом кодировки)
+        if not any(request.if_none_match.contains(variant) for variant in etag_variants(etag)):
+            return None
+        response = app.response_class(status=304, mimetype=_response_mimetype())
+        response.vary.add('Accept')
+        return _set_etag(response, etag)
+
+    def _set_etag(response, etag):
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache' # Клиент хранит копию, но всегда перепроверяет
+        return response
+
+    def _get_chat_version(cursor, chat_id):
+        """Счетчик изменений чата (chats.version), поддерживаемый триггерами из schema.sql."""
+        cursor.execute("SELECT version FROM chats WHERE id = ?", (chat_id,))
+        row = cursor.fetchone()
+        return row['version'] if row else 0
+
+    def _response_mimetype():
+        """Формат ответа горячих эндпоинтов: application/json или application/msgpack (по Accept)."""
+        return choose_mimetype(request.accept_mimetypes)
+
+    def _api_response(payload):
+        """Ответ в формате, выбранном по заголовку Accept (JSON по умолчанию)."""
+        mimetype = _response_mimetype()
+        if mimetype in MSGPACK_MIMETYPES:
+            response = app.response_class(pack(payload), mimetype=mimetype)
+        else:
+            response = jsonify(payload)
+        response.vary.add('Accept')
+        return response
+
+    def _stream_response(payload, cursor):
+        """
+        Отдает payload (может содержать LazyArray/LazyValue) как JSON или MessagePack.
+        В потоковом режиме JSON кодируется по мере чтения курсора, и курсор
+        закрывается генератором после отправки; иначе ответ собирается целиком.
+        MessagePack всегда собирается целиком: ему нужна длина массивов заранее.
+        """
+        chunk_size = app.config['JSON_STREAM_CHUNK_SIZE']
+        mimetype = _response_mimetype()
+        if mimetype in MSGPACK_MIMETYPES or not app.config['JSON_STREAMING']:
+            body = pack(payload) if mimetype in MSGPACK_MIMETYPES else b''.join(iter_json(payload, chunk_size))
+            cursor.close()
+            response = app.response_class(body, mimetype=mimetype)
+            response.vary.add('Accept')
+            return response
+
+        def generate():
+            try:
+                yield from iter_json(payload, chunk_size)
+            except Exception as e:
+                # Заголовки уже отправлены: клиент получит оборванный (невалидный) JSON
+                print(f"Ошибка при потоковой отдаче ответа: {e}")
+            finally:
+                cursor.close()
+
+        # stream_with_context держит контекст запроса (и соединение с БД) до конца генератора
+        response = app.response_class(stream_with_context(generate()), mimetype=mimetype)
+        response.vary.add('Accept')
+        return response
+
+    def _parse_message_format():
+        """Формат сообщений из параметра format: True для compact, False для full (по умолчанию)."""
+        message_format = request.args.get('format', 'full')
+        if message_format not in ('full', 'compact'):
+            raise ValueError('Параметр format должен быть full или compact.')
+        return message_format == 'compact'
+
+    def _load_users_map(db, user_ids):
+        """
+        Карта отправителей для компактного формата: {"<id>": {display_name, avatar_url}}.
+        Удаленные пользователи отображаются как "Удаленный пользователь" без аватара.
+        """
+        user_ids = [user_id for user_id in user_ids if user_id is not None]
+        if not user_ids:
+            return {}
+        placeholders = ','.join('?' * len(user_ids))
+        rows = db.execute(
+            f"SELECT id, display_name, avatar_url, is_deleted FROM users WHERE id IN ({placeholders})", user_ids
+        ).fetchall()
+        return {
+            str(row['id']): {
+                'display_name': 'Удаленный пользователь' if row['is_deleted'] else row['display_name'],
+                'avatar_url': None if row['is_deleted'] else row['avatar_url']
+            }
+            for row in rows
+        }
+
+    def _format_message(msg, compact=False):
+        """
+        Преобразует строку из MESSAGE_SELECT_SQL в словарь для ответа API.
+        compact=True - строка из MESSAGE_COMPACT_SELECT_SQL, без данных отправителя.
+        """
+        formatted_msg = {
+            'id': msg['id'],
+            'chat_id': msg['chat_id'],
+            'sender_id': msg['sender_id'],
+            'message_type': msg['message_type'],
+            'sent_at': msg['sent_at'],
+            'is_deleted': bool(msg['is_deleted']),
+            'revision': msg['revision']
+        }
+        if not compact:
+            formatted_msg['sender_display_name'] = msg['sender_display_name']
+            formatted_msg['sender_avatar_url'] = msg['sender_avatar_url']
+        if not formatted_msg['is_deleted']: # Отображаем контент, только если сообщение не удалено
+            if msg['message_type'] == 'text':
+                formatted_msg['content'] = msg['content']
+            elif msg['message_type'] == 'file':
+                formatted_msg['file_url'] = msg['file_url']
+                formatted_msg['file_name'] = msg['file_name']
+                formatted_msg['file_size'] = msg['file_size']
+                # Размеры и миниатюра появляются после фоновой обработки изображения
+                formatted_msg['width'] = msg['width']
+                formatted_msg['height'] = msg['height']
+                formatted_msg['thumbnail_url'] = (
+                    url_for('thumbnail', filename=msg['file_sha256'] + '.jpg', _external=True)
+                    if msg['width'] is not None else None
+                )
+        else: # Если сообщение удалено, скрываем контент
+            formatted_msg['content'] = '[Сообщение удалено]'
+            formatted_msg['file_url'] = None
+            formatted_msg['file_name'] = None
+            formatted_msg['file_size'] = None
+        return formatted_msg
+
     # --- Основные маршруты ---
     @app.route('/')
     def index():
@@ -72,7 +762,7 @@ def create_app():
         if not username or not password:
             return jsonify({'error': 'Имя пользователя и пароль обязательны'}), 400
 
-        db = get_db()
+        db = get_read_db()
         cursor = db.cursor()
 
         try:
@@ -80,17 +770,19 @@ def create_app():
             if cursor.fetchone():
                 return jsonify({'error': 'Пользователь с таким именем уже существует'}), 409
 
+            # Хеширование пароля (сотни миллисекунд) выполняется до того, как берется писатель
             hashed_password = generate_password_hash(password)
 
-            cursor.execute(
-                "INSERT INTO users (username, password_hash, display_name) VALUES (?, ?, ?)",
-                (username, hashed_password, display_name)
-            )
-            db.commit()
-            user_id = cursor.lastrowid
+            with write_transaction() as writer:
+                user_id = writer.execute(
+                    "INSERT INTO users (username, password_hash, display_name) VALUES (?, ?, ?)",
+                    (username, hashed_password, display_name)
+                ).lastrowid
             return jsonify({'message': 'Пользователь успешно зарегистрирован', 'user_id': user_id}), 201
+        except sqlite3.IntegrityError:
+            # Имя заняли параллельным запросом после проверки выше
+            return jsonify({'error': 'Пользователь с таким именем уже существует'}), 409
         except Exception as e:
-            db.rollback()
             print(f"Ошибка при регистрации пользователя: {e}")
             return jsonify({'error': 'Внутренняя ошибка сервера'}), 500
         finally:
@@ -105,7 +797,7 @@ def create_app():
         if not username or not password:
             return jsonify({'error': 'Имя пользователя и пароль обязательны'}), 400
 
-        db = get_db()
+        db = get_read_db() # Вход ничего не пишет в базу
         cursor = db.cursor()
 
         try:
@@ -171,7 +863,7 @@ def create_app():
         if not any([display_name is not None, email is not None, avatar_url is not None]):
             return jsonify({'error': 'Нечего обновлять. Предоставьте display_name, email или avatar_url.'}), 400
 
-        db = get_db()
+        db = get_read_db()
         cursor = db.cursor()
 
         try:
@@ -202,12 +894,12 @@ def create_app():
             query = f"UPDATE users SET {', '.join(updates)} WHERE id = ?"
             params.append(user_id)
 
-            cursor.execute(query, tuple(params))
-            db.commit()
+            with write_transaction() as writer:
+                writer.execute(query, tuple(params))
+            user_cache.invalidate(user_id)
 
             return jsonify({'message': 'Профиль успешно обновлен'}), 200
         except Exception as e:
-            db.rollback()
             print(f"Ошибка при обновлении профиля: {e}")
             return jsonify({'error': 'Внутренняя ошибка сервера'}), 500
         finally:
@@ -226,7 +918,7 @@ def create_app():
         if len(new_password) < 6: # Пример минимальной длины пароля
             return jsonify({'error': 'Новый пароль должен быть не менее 6 символов.'}), 400
 
-        db = get_db()
+        db = get_read_db()
         cursor = db.cursor()
 
         try:
@@ -241,15 +933,15 @@ def create_app():
 
             new_hashed_password = generate_password_hash(new_password)
 
-            cursor.execute(
-                "UPDATE users SET password_hash = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
-                (new_hashed_password, user_id)
-            )
-            db.commit()
+            with write_transaction() as writer:
+                writer.execute(
+                    "UPDATE users SET password_hash = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+                    (new_hashed_password, user_id)
+                )
+            user_cache.invalidate(user_id)
 
             return jsonify({'message': 'Пароль успешно обновлен'}), 200
         except Exception as e:
-            db.rollback()
             print(f"Ошибка при обновлении пароля: {e}")
             return jsonify({'error': 'Внутренняя ошибка сервера'}), 500
         finally:
@@ -259,59 +951,96 @@ def create_app():
     @login_required
     def delete_user_account():
         user_id = g.user['id']
-        
-        db = get_db()
-        cursor = db.cursor()
 
         try:
             # Мягкое удаление пользователя: меняем username, сбрасываем email/avatar, помечаем как удаленный
             # Это позволяет сохранить ссылки на сообщения пользователя без раскрытия его данных
             deleted_username = f"deleted_user_{user_id}_{uuid.uuid4().hex[:8]}" # Добавляем UUID для уникальности
-            
-            cursor.execute(
-                """
-                UPDATE users
-                SET username = ?,
-                    display_name = 'Удаленный пользователь',
-                    email = NULL,
-                    avatar_url = NULL,
-                    password_hash = ?, -- Хешируем случайный пароль, чтобы нельзя было войти
-                    is_deleted = TRUE,
-                    updated_at = CURRENT_TIMESTAMP
-                WHERE id = ?
-                """,
-                (deleted_username, generate_password_hash(os.urandom(16).hex()), user_id)
-            )
-            db.commit()
+            password_hash = generate_password_hash(os.urandom(16).hex()) # Хешируем до того, как берется писатель
+
+            with write_transaction() as writer:
+                writer.execute(
+                    """
+                    UPDATE users
+                    SET username = ?,
+                        display_name = 'Удаленный пользователь',
+                        email = NULL,
+                        avatar_url = NULL,
+                        password_hash = ?, -- Хешируем случайный пароль, чтобы нельзя было войти
+                        is_deleted = TRUE,
+                        updated_at = CURRENT_TIMESTAMP
+                    WHERE id = ?
+                    """,
+                    (deleted_username, password_hash, user_id)
+                )
+            user_cache.invalidate(user_id)
 
             session.clear() # Выходим из системы после удаления аккаунта
 
             return jsonify({'message': 'Аккаунт успешно удален (помечен как удаленный)'}), 200
         except Exception as e:
-            db.rollback()
             print(f"Ошибка при удалении аккаунта: {e}")
             return jsonify({'error': 'Внутренняя ошибка сервера'}), 500
-        finally:
-            cursor.close()
     
     @app.route('/api/users', methods=['GET'])
     @login_required
     def get_all_users():
         """
-        Возвращает список всех активных пользователей.
-        Доступно только для аутентифицированных пользователей.
+        Возвращает страницу активных пользователей (массив, отсортированный по id).
+        Параметры: limit, after_id (курсор), query (фильтр по username/display_name),
+        exclude_self=1 (исключить текущего пользователя).
+        Курсор следующей страницы передается в заголовке X-Next-Cursor.
+        Поддерживает ETag/If-None-Match: повторный запрос без изменений получает 304.
         """
+        user_id = g.user['id']
+        try:
+            limit = int(request.args.get('limit') or app.config['USERS_PAGE_SIZE'])
+            after_id = int(request.args.get('after_id') or 0)
+            if limit < 1 or after_id < 0:
+                raise ValueError
+        except ValueError:
+            return jsonify({'error': 'Параметры limit и after_id должны быть неотрицательными целыми числами (limit > 0).'}), 400
+        limit = min(limit, app.config['USERS_MAX_PAGE_SIZE'])
+        query = (request.args.get('query') or '').strip()
+        exclude_self = request.args.get('exclude_self') in ('1', 'true')
+
         db = get_db()
         cursor = db.cursor()
         try:
-            # Ищем всех пользователей, исключая удаленных
+            # Сначала дешевая проверка ревизии: если набор пользователей не менялся, страницу не читаем
+            etag = _make_etag('users', _get_revision(cursor, 'users'), limit, after_id, query,
+                              user_id if exclude_self else '')
+            not_modified = _not_modified(etag)
+            if not_modified is not None:
+                return not_modified
+
+            conditions = ["u.is_deleted = FALSE", "u.id > :after_id"]
+            params = {'after_id': after_id, 'user_id': user_id}
+            if exclude_self:
+                conditions.append("u.id != :user_id")
+            source = "users u"
+            if query:
+                _, fts_table, params['match'] = _user_search_match(query)
+                source = f"{fts_table} f JOIN users u ON u.id = f.rowid"
+                conditions.append(f"{fts_table} MATCH :match")
+
+            where = ' AND '.join(conditions)
+            # Курсор нужен в заголовке до отправки тела, поэтому страница (не больше USERS_MAX_PAGE_SIZE)
+            # читается целиком одним запросом с лишней строкой: она есть, только если есть следующая страница
             cursor.execute(
-                "SELECT id, username, display_name, avatar_url FROM users WHERE is_deleted = FALSE"
+                f"SELECT u.id, u.username, u.display_name, u.avatar_url FROM {source} "
+                f"WHERE {where} ORDER BY u.id LIMIT :limit",
+                dict(params, limit=limit + 1)
             )
-            users = cursor.fetchall()
-            # Преобразуем Row-объекты в словари для jsonify
-            users_list = [dict(user) for user in users]
-            return jsonify(users_list), 200 # Возвращаем список пользователей
+            users = [dict(row) for row in cursor.fetchall()]
+            has_more = len(users) > limit
+            users = users[:limit]
+
+            response = _api_response(users)
+            _set_etag(response, etag)
+            if has_more:
+                response.headers['X-Next-Cursor'] = str(users[-1]['id'])
+            return response, 200
         except Exception as e:
             print(f"Ошибка при получении списка пользователей: {e}")
             return jsonify({'error': 'Внутренняя ошибка сервера'}), 500
@@ -321,8 +1050,31 @@ def create_app():
     # API для Управления Чатами
 
     # Вспомогательная функция для создания чата (используется внутренне)
-    def _create_chat_logic(user_id, chat_type, name=None, avatar_url=None, member_ids=None):
-        db = get_db()
+    def _find_active_users(cursor, column, values):
+        """
+        {значение column: id} для неудаленных пользователей из values.
+        Один запрос WHERE column IN (...) на IN_QUERY_BATCH значений вместо запроса на каждое.
+        """
+        found = {}
+        for start in range(0, len(values), IN_QUERY_BATCH):
+            batch = values[start:start + IN_QUERY_BATCH]
+            placeholders = ','.join('?' * len(batch))
+            cursor.execute(
+                f"SELECT id, {column} AS value FROM users WHERE {column} IN ({placeholders}) AND is_deleted = FALSE", batch
+            )
+            found.update((row['value'], row['id']) for row in cursor.fetchall())
+        return found
+
+    def _parse_member_ids(data):
+        """Список member_ids из тела запроса или None, если он некорректен."""
+        member_ids = data.get('member_ids') or []
+        if not isinstance(member_ids, list) or not all(
+                isinstance(member_id, int) and not isinstance(member_id, bool) for member_id in member_ids):
+            return None
+        return member_ids
+
+    def _create_chat_logic(user_id, chat_type, name=None, avatar_url=None, member_ids=None, skipped_usernames=None):
+        db = get_read_db() # Проверки идут через читателя, писатель берется только на вставку
         cursor = db.cursor()
         chat_id = None
         try:
@@ -351,73 +1103,73 @@ def create_app():
                 if existing_chat:
                     return jsonify({'error': 'Личный чат с этим пользователем уже существует.', 'chat_id': existing_chat['id']}), 409
 
-                cursor.execute(
-                    "INSERT INTO chats (type) VALUES (?)",
-                    (chat_type,)
-                )
-                chat_id = cursor.lastrowid
-                
-                cursor.execute(
-                    "INSERT INTO private_chats (chat_id, user1_id, user2_id) VALUES (?, ?, ?)",
-                    (chat_id, user1, user2)
-                )
+                with write_transaction() as writer:
+                    chat_id = writer.execute(
+                        "INSERT INTO chats (type) VALUES (?)",
+                        (chat_type,)
+                    ).lastrowid
+                    
+                    writer.execute(
+                        "INSERT INTO private_chats (chat_id, user1_id, user2_id) VALUES (?, ?, ?)",
+                        (chat_id, user1, user2)
+                    )
                 
             elif chat_type in ['group', 'channel']:
                 if not name:
                     return jsonify({'error': 'Для групп и каналов требуется имя.'}), 400
 
-                if chat_type == 'channel':
-                    # Устанавливаем создателя канала как его владельца
-                    cursor.execute(
-                        "INSERT INTO chats (type, name, avatar_url, owner_id) VALUES (?, ?, ?, ?)",
-                        (chat_type, name, avatar_url, user_id)
-                    )
-                else: # group
-                    cursor.execute(
-                        "INSERT INTO chats (type, name, avatar_url) VALUES (?, ?, ?)",
-                        (chat_type, name, avatar_url)
-                    )
-                chat_id = cursor.lastrowid
-
-                # Добавляем создателя как участника/подписчика
-                if chat_type == 'group':
-                    cursor.execute(
-                        "INSERT INTO group_members (group_id, user_id, role) VALUES (?, ?, ?)",
-                        (chat_id, user_id, 'admin') # Создатель группы всегда админ
-                    )
-                else: # channel
-                    cursor.execute(
-                        "INSERT INTO channel_subscribers (channel_id, user_id) VALUES (?, ?)",
-                        (chat_id, user_id)
-                    )
-                
-                # Добавляем дополнительных участников/подписчиков (если есть)
-                if member_ids:
-                    # Используем set для удаления дубликатов и избегаем добавления создателя снова
-                    for member_id in set(member_ids):
-                        if member_id == user_id:
-                            continue 
-                        cursor.execute("SELECT id FROM users WHERE id = ? AND is_deleted = FALSE", (member_id,))
-                        if not cursor.fetchone():
-                            print(f"Предупреждение: Пользователь с ID {member_id} не существует или удален и не будет добавлен.")
-                            continue
-
-                        if chat_type == 'group':
-                            cursor.execute(
-                                "INSERT INTO group_members (group_id, user_id, role) VALUES (?, ?, ?)",
-                                (chat_id, member_id, 'member')
-                            )
-                        else: # channel
-                            cursor.execute(
-                                "INSERT INTO channel_subscribers (channel_id, user_id) VALUES (?, ?)",
-                                (chat_id, member_id)
-                            )
+                # Дополнительные участники/подписчики (если есть).
+                # Дубликаты и создатель отбрасываются, порядок сохраняется
+                candidate_ids = [member_id for member_id in dict.fromkeys(member_ids or []) if member_id != user_id]
+                # Существование проверяется пачками, вставка - одним executemany в транзакции создания чата
+                existing_ids = _find_active_users(cursor, 'id', candidate_ids)
+                added_ids = [member_id for member_id in candidate_ids if member_id in existing_ids]
+                skipped_member_ids = [member_id for member_id in candidate_ids if member_id not in existing_ids]
+                if skipped_member_ids:
+                    print(f"Предупреждение: Пользователи с ID {skipped_member_ids} не существуют или удалены и не будут добавлены.")
+
+                with write_transaction() as writer:
+                    if chat_type == 'channel':
+                        # Устанавливаем создателя канала как его владельца
+                        chat_id = writer.execute(
+                            "INSERT INTO chats (type, name, avatar_url, owner_id) VALUES (?, ?, ?, ?)",
+                            (chat_type, name, avatar_url, user_id)
+                        ).lastrowid
+                    else: # group
+                        chat_id = writer.execute(
+                            "INSERT INTO chats (type, name, avatar_url) VALUES (?, ?, ?)",
+                            (chat_type, name, avatar_url)
+                        ).lastrowid
+
+                    # Добавляем создателя как участника/подписчика, затем остальных
+                    if chat_type == 'group':
+                        writer.execute(
+                            "INSERT INTO group_members (group_id, user_id, role) VALUES (?, ?, ?)",
+                            (chat_id, user_id, 'admin') # Создатель группы всегда админ
+                        )
+                        writer.executemany(
+                            "INSERT INTO group_members (group_id, user_id, role) VALUES (?, ?, 'member')",
+                            [(chat_id, member_id) for member_id in added_ids]
+                        )
+                    else: # channel
+                        writer.execute(
+                            "INSERT INTO channel_subscribers (channel_id, user_id) VALUES (?, ?)",
+                            (chat_id, user_id)
+                        )
+                        writer.executemany(
+                            "INSERT INTO channel_subscribers (channel_id, user_id) VALUES (?, ?)",
+                            [(chat_id, member_id) for member_id in added_ids]
+                        )
             
-            db.commit()
-            return jsonify({'message': f'{chat_type.capitalize()} чат успешно создан', 'chat_id': chat_id}), 201
+            result = {'message': f'{chat_type.capitalize()} чат успешно создан', 'chat_id': chat_id}
+            if chat_type != 'private':
+                result['added_member_count'] = len(added_ids)
+                result['skipped_member_ids'] = skipped_member_ids
+                if skipped_usernames is not None:
+                    result['skipped_usernames'] = skipped_usernames
+            return jsonify(result), 201
 
         except Exception as e:
-            db.rollback()
             print(f"Ошибка при создании чата: {e}")
             return jsonify({'error': 'Внутренняя ошибка сервера'}), 500
         finally:
@@ -438,7 +1190,7 @@ def create_app():
         if not username:
             return jsonify({'error': 'Требуется имя пользователя для личного чата.'}), 400
 
-        db = get_db()
+        db = get_read_db()
         cursor = db.cursor()
 
         try:
@@ -468,21 +1220,7 @@ def create_app():
             if existing_chat:
                 return jsonify({'error': 'Приватный чат с этим пользователем уже существует.', 'chat_id': existing_chat['chat_id']}), 409 # 409 Conflict
 
-            # Создаем новую запись в таблице chats
-            cursor.execute(
-                "INSERT INTO chats (type) VALUES (?)",
-                ('private',)
-            )
-            chat_id = cursor.lastrowid
-
-            # Создаем новую запись в таблице private_chats
-            cursor.execute(
-                "INSERT INTO private_chats (chat_id, user1_id, user2_id) VALUES (?, ?, ?)",
-                (chat_id, user_id, other_user_id) # <-- user1_id заменен на user_id
-            )
-            db.commit()
-            
-            # Обновляем имя приватного чата
+            # Имя приватного чата
             # Здесь можно было бы установить имя на стороне клиента, но для согласованности с серверным подходом
             # установим его здесь, используя display_name пользователей
             
@@ -495,12 +1233,23 @@ def create_app():
             other_user_display_name = cursor.fetchone()['display_name']
 
             chat_name = f"{current_user_display_name} и {other_user_display_name}"
-            cursor.execute("UPDATE chats SET name = ? WHERE id = ?", (chat_name, chat_id))
-            db.commit()
+
+            # Писатель нужен только на вставку: чат создается сразу с именем, одной транзакцией
+            with write_transaction() as writer:
+                # Создаем новую запись в таблице chats
+                chat_id = writer.execute(
+                    "INSERT INTO chats (type, name) VALUES (?, ?)",
+                    ('private', chat_name)
+                ).lastrowid
+
+                # Создаем новую запись в таблице private_chats
+                writer.execute(
+                    "INSERT INTO private_chats (chat_id, user1_id, user2_id) VALUES (?, ?, ?)",
+                    (chat_id, user_id, other_user_id) # <-- user1_id заменен на user_id
+                )
 
             return jsonify({'message': 'Приватный чат создан успешно.', 'chat_id': chat_id, 'chat_name': chat_name}), 201
         except Exception as e:
-            db.rollback()
             print(f"Ошибка при создании приватного чата: {e}")
             return jsonify({'error': 'Внутренняя ошибка сервера'}), 500
         finally:
@@ -513,27 +1262,29 @@ def create_app():
         user_id = g.user['id']
         data = request.get_json()
         name = data.get('name')
-        member_usernames = data.get('member_usernames', [])
+        member_usernames = data.get('member_usernames') or []
+        member_ids = _parse_member_ids(data)
 
         if not name:
             return jsonify({'error': 'Требуется имя для группового чата.'}), 400
+        if member_ids is None:
+            return jsonify({'error': 'member_ids должен быть списком ID пользователей.'}), 400
+        if not isinstance(member_usernames, list) or not all(isinstance(username, str) for username in member_usernames):
+            return jsonify({'error': 'member_usernames должен быть списком имен пользователей.'}), 400
         
-        member_ids = []
+        skipped_usernames = None
         if member_usernames:
-            db = get_db()
-            cursor = db.cursor()
+            cursor = get_read_db().cursor()
             try:
-                for username in member_usernames:
-                    cursor.execute("SELECT id FROM users WHERE username = ? AND is_deleted = FALSE", (username,))
-                    user = cursor.fetchone()
-                    if user:
-                        member_ids.append(user['id'])
-                    else:
-                        print(f"Предупреждение: Пользователь '{username}' не найден или удален и не будет добавлен в группу.")
+                found = _find_active_users(cursor, 'username', list(dict.fromkeys(member_usernames)))
             finally:
                 cursor.close()
+            member_ids = member_ids + [found[username] for username in member_usernames if username in found]
+            skipped_usernames = [username for username in member_usernames if username not in found]
+            if skipped_usernames:
+                print(f"Предупреждение: Пользователи {skipped_usernames} не найдены или удалены и не будут добавлены в группу.")
         
-        return _create_chat_logic(user_id, 'group', name=name, member_ids=member_ids)
+        return _create_chat_logic(user_id, 'group', name=name, member_ids=member_ids, skipped_usernames=skipped_usernames)
 
     @app.route('/api/chats/channel', methods=['POST'])
     @login_required
@@ -542,11 +1293,14 @@ def create_app():
         data = request.get_json()
         name = data.get('name')
         avatar_url = data.get('avatar_url') # Каналы тоже могут иметь аватар
+        member_ids = _parse_member_ids(data) # Начальные подписчики (например, список сотрудников)
 
         if not name:
             return jsonify({'error': 'Требуется имя для канала.'}), 400
+        if member_ids is None:
+            return jsonify({'error': 'member_ids должен быть списком ID пользователей.'}), 400
         
-        return _create_chat_logic(user_id, 'channel', name=name, avatar_url=avatar_url)
+        return _create_chat_logic(user_id, 'channel', name=name, avatar_url=avatar_url, member_ids=member_ids)
 
 
     @app.route('/api/chats', methods=['GET'])
@@ -558,84 +1312,95 @@ def create_app():
         
         chats = []
         try:
-            # Получение приватных чатов
+            # ETag списка: версии чатов пользователя, его курсоры прочтения (курсор только растет)
+            # и ревизия пользователей (имена собеседников). Без изменений - 304 без основного запроса.
             cursor.execute(
-                """
-                SELECT
-                    c.id, c.type, c.created_at, c.updated_at,
-                    CASE
-                        WHEN pc.user1_id = ? THEN u2.display_name
-                        ELSE u1.display_name
-                    END AS name,
-                    CASE
-                        WHEN pc.user1_id = ? THEN u2.avatar_url
-                        ELSE u1.avatar_url
-                    END AS avatar_url,
-                    pc.user1_id, pc.user2_id
-                FROM chats c
-                JOIN private_chats pc ON c.id = pc.chat_id
-                JOIN users u1 ON pc.user1_id = u1.id
-                JOIN users u2 ON pc.user2_id = u2.id
-                WHERE c.type = 'private' AND (pc.user1_id = ? OR pc.user2_id = ?)
-                """,
-                (user_id, user_id, user_id, user_id)
+                USER_CHATS_CTE + "SELECT c.id, c.version FROM my_chats mc JOIN chats c ON c.id = mc.chat_id ORDER BY c.id",
+                {'user_id': user_id}
             )
-            private_chats = cursor.fetchall()
-            for chat in private_chats:
-                chats.append({
-                    'id': chat['id'],
-                    'type': chat['type'],
-                    'name': chat['name'],
-                    'avatar_url': chat['avatar_url'],
-                    'created_at': chat['created_at'],
-                    'updated_at': chat['updated_at'],
-                    'participants': [chat['user1_id'], chat['user2_id']] # Можно добавить список ID участников
-                })
-
-            # Получение групповых чатов
+            chat_versions = ','.join(f"{row['id']}:{row['version']}" for row in cursor.fetchall())
             cursor.execute(
-                """
-                SELECT c.id, c.type, c.name, c.avatar_url, c.created_at, c.updated_at, gm.role
-                FROM chats c
-                JOIN group_members gm ON c.id = gm.group_id
-                WHERE c.type = 'group' AND gm.user_id = ?
-                """,
+                "SELECT COUNT(*), COALESCE(SUM(last_read_message_id), 0) FROM chat_read_cursors WHERE user_id = ?",
                 (user_id,)
             )
-            groups = cursor.fetchall()
-            for group in groups:
-                chats.append({
-                    'id': group['id'],
-                    'type': group['type'],
-                    'name': group['name'],
-                    'avatar_url': group['avatar_url'],
-                    'created_at': group['created_at'],
-                    'updated_at': group['updated_at'],
-                    'role': group['role'] # Роль пользователя в группе
-                })
-
-            # Получение каналов
+            read_state = tuple(cursor.fetchone())
+            etag = _make_etag('chats', user_id, chat_versions, read_state, _get_revision(cursor, 'users'))
+            not_modified = _not_modified(etag)
+            if not_modified is not None:
+                return not_modified
+
+            # Один запрос вместо трех: чаты всех типов, последнее сообщение и число непрочитанных.
+            # Непрочитанные - сообщения других участников после курсора прочтения (chat_read_cursors).
             cursor.execute(
-                """
-                SELECT c.id, c.type, c.name, c.avatar_url, c.created_at, c.updated_at
-                FROM chats c
-                JOIN channel_subscribers cs ON c.id = cs.channel_id
-                WHERE c.type = 'channel' AND cs.user_id = ?
+                USER_CHATS_CTE + """
+                SELECT
+                    c.id, c.type, c.created_at, c.updated_at,
+                    CASE WHEN c.type = 'private' THEN peer.display_name ELSE c.name END AS name,
+                    CASE WHEN c.type = 'private' THEN peer.avatar_url ELSE c.avatar_url END AS avatar_url,
+                    mc.role, mc.user1_id, mc.user2_id,
+                    lm.id AS last_message_id,
+                    lm.sender_id AS last_message_sender_id,
+                    CASE
+                        WHEN lu.is_deleted = TRUE OR lu.id IS NULL THEN 'Удаленный пользователь'
+                        ELSE lu.display_name
+                    END AS last_message_sender_display_name,
+                    lm.message_type AS last_message_type,
+                    substr(lm.content, 1, :preview_length) AS last_message_content,
+                    lm.file_name AS last_message_file_name,
+                    lm.sent_at AS last_message_sent_at,
+                    lm.is_deleted AS last_message_is_deleted,
+                    COALESCE(lm.sent_at, c.created_at) AS last_activity_at,
+                    COALESCE(rc.last_read_message_id, 0) AS last_read_message_id,
+                    (
+                        SELECT COUNT(*) FROM messages um
+                        WHERE um.chat_id = c.id
+                          AND um.id > COALESCE(rc.last_read_message_id, 0)
+                          AND um.is_deleted = FALSE
+                          AND (um.sender_id IS NULL OR um.sender_id != :user_id)
+                    ) AS unread_count
+                FROM my_chats mc
+                JOIN chats c ON c.id = mc.chat_id
+                LEFT JOIN users peer ON peer.id = mc.peer_id
+                LEFT JOIN messages lm ON lm.id = (SELECT MAX(m.id) FROM messages m WHERE m.chat_id = c.id)
+                LEFT JOIN users lu ON lu.id = lm.sender_id
+                LEFT JOIN chat_read_cursors rc ON rc.chat_id = c.id AND rc.user_id = :user_id
+                ORDER BY last_activity_at DESC, c.id DESC
                 """,
-                (user_id,)
+                {'user_id': user_id, 'preview_length': app.config['CHAT_LIST_PREVIEW_LENGTH']}
             )
-            channels = cursor.fetchall()
-            for channel in channels:
-                chats.append({
-                    'id': channel['id'],
-                    'type': channel['type'],
-                    'name': channel['name'],
-                    'avatar_url': channel['avatar_url'],
-                    'created_at': channel['created_at'],
-                    'updated_at': channel['updated_at']
-                })
-
-            return jsonify({'chats': chats}), 200
+            for row in cursor.fetchall():
+                chat = {
+                    'id': row['id'],
+                    'type': row['type'],
+                    'name': row['name'],
+                    'avatar_url': row['avatar_url'],
+                    'created_at': row['created_at'],
+                    'updated_at': row['updated_at'],
+                    'last_activity_at': row['last_activity_at'], # Ключ сортировки списка чатов
+                    'last_read_message_id': row['last_read_message_id'],
+                    'unread_count': row['unread_count'],
+                    'last_message': None
+                }
+                if row['type'] == 'private':
+                    chat['participants'] = [row['user1_id'], row['user2_id']] # Можно добавить список ID участников
+                elif row['type'] == 'group':
+                    chat['role'] = row['role'] # Роль пользователя в группе
+
+                if row['last_message_id'] is not None:
+                    is_deleted = bool(row['last_message_is_deleted'])
+                    chat['last_message'] = {
+                        'id': row['last_message_id'],
+                        'sender_id': row['last_message_sender_id'],
+                        'sender_display_name': row['last_message_sender_display_name'],
+                        'message_type': row['last_message_type'],
+                        'content': '[Сообщение удалено]' if is_deleted else row['last_message_content'],
+                        'file_name': None if is_deleted else row['last_message_file_name'],
+                        'sent_at': row['last_message_sent_at'],
+                        'is_deleted': is_deleted
+                    }
+                chats.append(chat)
+
+            return _set_etag(_api_response({'chats': chats}), etag), 200
 
         except Exception as e:
             print(f"Ошибка при получении чатов пользователя: {e}")
@@ -643,6 +1408,59 @@ def create_app():
         finally:
             cursor.close()
 
+    @app.route('/api/chats/<int:chat_id>/read', methods=['POST'])
+    @login_required
+    def mark_chat_read(chat_id):
+        """
+        Сдвигает курсор прочтения пользователя в чате.
+        Без message_id чат отмечается прочитанным до последнего сообщения.
+        Курсор только растет: более старый message_id не уменьшает его, а больший,
+        чем у последнего сообщения чата, ограничивается им.
+        """
+        user_id = g.user['id']
+        data = request.get_json(silent=True) or {}
+        message_id = data.get('message_id')
+        # bool - подкласс int: JSON true не должен читаться как message_id = 1
+        if message_id is not None and (not isinstance(message_id, int) or isinstance(message_id, bool) or message_id < 0):
+            return jsonify({'error': 'message_id должен быть неотрицательным целым числом.'}), 400
+
+        db = get_read_db()
+        cursor = db.cursor()
+
+        try:
+            access_error = _check_chat_read_access(cursor, chat_id, user_id)
+            if access_error:
+                return access_error
+
+            if message_id is None:
+                cursor.execute("SELECT COALESCE(MAX(id), 0) FROM messages WHERE chat_id = ?", (chat_id,))
+                message_id = cursor.fetchone()[0]
+
+            with write_transaction() as writer:
+                # Курсор не может уйти дальше последнего сообщения чата, иначе будущие
+                # сообщения заранее считались бы прочитанными
+                writer.execute(
+                    """
+                    INSERT INTO chat_read_cursors (chat_id, user_id, last_read_message_id)
+                    VALUES (:chat_id, :user_id, MIN(:message_id, (SELECT COALESCE(MAX(id), 0) FROM messages WHERE chat_id = :chat_id)))
+                    ON CONFLICT(chat_id, user_id) DO UPDATE SET
+                        last_read_message_id = MAX(last_read_message_id, excluded.last_read_message_id),
+                        updated_at = CURRENT_TIMESTAMP
+                    """,
+                    {'chat_id': chat_id, 'user_id': user_id, 'message_id': message_id}
+                )
+
+            cursor.execute(
+                "SELECT last_read_message_id FROM chat_read_cursors WHERE chat_id = ? AND user_id = ?",
+                (chat_id, user_id)
+            )
+            return jsonify({'chat_id': chat_id, 'last_read_message_id': cursor.fetchone()['last_read_message_id']}), 200
+        except Exception as e:
+            print(f"Ошибка при обновлении курсора прочтения: {e}")
+            return jsonify({'error': 'Внутренняя ошибка сервера'}), 500
+        finally:
+            cursor.close()
+
     @app.route('/api/chats/<int:chat_id>', methods=['GET'])
     @login_required
     def get_chat_details(chat_id):
@@ -651,6 +1469,26 @@ def create_app():
         cursor = db.cursor()
 
         try:
+            # Проверка доступа через кеш прав: посторонние получают отказ до выборки списка участников
+            access = _get_chat_access(cursor, chat_id, user_id)
+            if access is None:
+                return jsonify({'error': 'Чат не найден.'}), 404
+            if not access['is_member']:
+                if access['type'] == 'private':
+                    return jsonify({'error': 'У вас нет доступа к этому приватному чату.'}), 403
+                elif access['type'] == 'group':
+                    return jsonify({'error': 'Вы не являетесь участником этой группы.'}), 403
+                elif access['type'] == 'channel':
+                    return jsonify({'error': 'Вы не подписаны на этот канал.'}), 403
+                return jsonify({'error': 'У вас нет доступа к этому чату.'}), 403
+
+            # Детали зависят от версии чата (данные, участники), профилей пользователей и
+            # от того, кто смотрит (имя приватного чата - имя собеседника)
+            etag = _make_etag('chat', chat_id, _get_chat_version(cursor, chat_id), _get_revision(cursor, 'users'), user_id)
+            not_modified = _not_modified(etag)
+            if not_modified is not None:
+                return not_modified
+
             cursor.execute(
                 """
                 SELECT c.id, c.type, c.name, c.avatar_url, c.created_at, c.updated_at, c.owner_id
@@ -702,28 +1540,18 @@ def create_app():
                         return jsonify({'error': 'У вас нет доступа к этому приватному чату.'}), 403
 
             elif chat['type'] == 'group':
+                # Членство уже проверено через кеш прав; участники выдаются прямо из курсора
+                is_member = True
                 cursor.execute(
                     "SELECT gm.role, u.id, u.username, u.display_name, u.avatar_url, u.is_deleted FROM group_members gm JOIN users u ON gm.user_id = u.id WHERE gm.group_id = ?",
                     (chat_id,)
                 )
-                members_data = cursor.fetchall()
-                chat_details['members'] = [{'id': m['id'], 'username': m['username'], 'display_name': m['display_name'], 'avatar_url': m['avatar_url'], 'role': m['role'], 'is_deleted': m['is_deleted']} for m in members_data]
-                is_member = any(m['id'] == user_id for m in members_data)
-                if not is_member:
-                    return jsonify({'error': 'Вы не являетесь участником этой группы.'}), 403
+                chat_details['members'] = LazyArray(cursor, lambda m: {'id': m['id'], 'username': m['username'], 'display_name': m['display_name'], 'avatar_url': m['avatar_url'], 'role': m['role'], 'is_deleted': m['is_deleted']})
 
             elif chat['type'] == 'channel':
-                cursor.execute(
-                    "SELECT cs.joined_at, u.id, u.username, u.display_name, u.avatar_url, u.is_deleted FROM channel_subscribers cs JOIN users u ON cs.user_id = u.id WHERE cs.channel_id = ?",
-                    (chat_id,)
-                )
-                subscribers_data = cursor.fetchall()
-                chat_details['members'] = [{'id': s['id'], 'username': s['username'], 'display_name': s['display_name'], 'avatar_url': s['avatar_url'], 'is_deleted': s['is_deleted']} for s in subscribers_data]
-                is_member = any(s['id'] == user_id for s in subscribers_data)
-                if not is_member:
-                    return jsonify({'error': 'Вы не подписаны на этот канал.'}), 403
-                
-                # Добавляем информацию о владельце канала
+                is_member = True
+
+                # Добавляем информацию о владельце канала (до выборки подписчиков, которые читаются из курсора при отправке)
                 if chat['owner_id']:
                     cursor.execute("SELECT id, username, display_name, avatar_url, is_deleted FROM users WHERE id = ?", (chat['owner_id'],))
                     owner_info = cursor.fetchone()
@@ -732,17 +1560,27 @@ def create_app():
                     else: # Если владелец удален
                         chat_details['owner'] = {'id': chat['owner_id'], 'username': 'Удаленный пользователь', 'display_name': 'Удаленный пользователь', 'avatar_url': None}
 
+                # Подписчиков канала могут быть тысячи: не собираем их в список
+                cursor.execute(
+                    "SELECT cs.joined_at, u.id, u.username, u.display_name, u.avatar_url, u.is_deleted FROM channel_subscribers cs JOIN users u ON cs.user_id = u.id WHERE cs.channel_id = ?",
+                    (chat_id,)
+                )
+                chat_details['members'] = LazyArray(cursor, lambda s: {'id': s['id'], 'username': s['username'], 'display_name': s['display_name'], 'avatar_url': s['avatar_url'], 'is_deleted': s['is_deleted']})
+
 
             if not is_member: # Дублирующая проверка, на всякий случай
                 return jsonify({'error': 'У вас нет доступа к этому чату.'}), 403
 
-            return jsonify(chat_details), 200
+            response = _stream_response(chat_details, cursor)
+            cursor = None # Курсор закроет генератор ответа
+            return _set_etag(response, etag), 200
 
         except Exception as e:
             print(f"Ошибка при получении деталей чата: {e}")
             return jsonify({'error': 'Внутренняя ошибка сервера'}), 500
         finally:
-            cursor.close()
+            if cursor is not None:
+                cursor.close()
     
     @app.route('/api/chats/<int:chat_id>', methods=['PUT'])
     @login_required
@@ -752,28 +1590,22 @@ def create_app():
         name = data.get('name')
         avatar_url = data.get('avatar_url')
 
-        db = get_db()
+        db = get_read_db()
         cursor = db.cursor()
 
         try:
-            cursor.execute("SELECT type, owner_id FROM chats WHERE id = ?", (chat_id,))
-            chat_info = cursor.fetchone()
-            if not chat_info:
+            access = _get_chat_access(cursor, chat_id, user_id)
+            if not access:
                 return jsonify({'error': 'Чат не найден.'}), 404
             
-            chat_type = chat_info['type']
-            owner_id = chat_info['owner_id']
+            chat_type = access['type']
+            owner_id = access['owner_id']
 
             if chat_type == 'private':
                 return jsonify({'error': 'Нельзя обновить информацию личного чата.'}), 400
 
             if chat_type == 'group':
-                cursor.execute(
-                    "SELECT role FROM group_members WHERE group_id = ? AND user_id = ?",
-                    (chat_id, user_id)
-                )
-                member_role = cursor.fetchone()
-                if not member_role or member_role['role'] != 'admin':
+                if access['role'] != 'admin':
                     return jsonify({'error': 'Только администратор группы может обновлять информацию о группе.'}), 403
             elif chat_type == 'channel':
                 # Только владелец канала может обновлять информацию о канале
@@ -799,12 +1631,11 @@ def create_app():
             query = f"UPDATE chats SET {', '.join(updates)} WHERE id = ?"
             params.append(chat_id)
 
-            cursor.execute(query, tuple(params))
-            db.commit()
+            with write_transaction() as writer:
+                writer.execute(query, tuple(params))
 
             return jsonify({'message': f'Информация о {chat_type} чате успешно обновлена'}), 200
         except Exception as e:
-            db.rollback()
             print(f"Ошибка при обновлении информации о чате: {e}")
             return jsonify({'error': 'Внутренняя ошибка сервера'}), 500
         finally:
@@ -814,7 +1645,7 @@ def create_app():
     @login_required
     def delete_chat(chat_id):
         user_id = g.user['id']
-        db = get_db()
+        db = get_read_db()
         cursor = db.cursor()
 
         try:
@@ -852,12 +1683,12 @@ def create_app():
             if not can_delete:
                 return jsonify({'error': 'У вас нет прав на удаление этого чата.'}), 403
 
-            cursor.execute("DELETE FROM chats WHERE id = ?", (chat_id,))
-            db.commit()
+            with write_transaction() as writer:
+                writer.execute("DELETE FROM chats WHERE id = ?", (chat_id,))
+            _invalidate_chat_access(chat_id)
 
             return jsonify({'message': f'{chat_type.capitalize()} чат успешно удален.'}), 200
         except Exception as e:
-            db.rollback()
             print(f"Ошибка при удалении чата: {e}")
             return jsonify({'error': 'Внутренняя ошибка сервера'}), 500
         finally:
@@ -867,7 +1698,7 @@ def create_app():
     @login_required
     def leave_chat(chat_id):
         user_id = g.user['id']
-        db = get_db()
+        db = get_read_db()
         cursor = db.cursor()
         try:
             # Получаем тип чата
@@ -891,11 +1722,12 @@ def create_app():
                 if not cursor.fetchone():
                     return jsonify({'error': 'Вы не являетесь участником этого группового чата.'}), 403
                 
-                cursor.execute(
-                    "DELETE FROM group_members WHERE group_id = ? AND user_id = ?",
-                    (chat_id, user_id)
-                )
-                db.commit()
+                with write_transaction() as writer:
+                    writer.execute(
+                        "DELETE FROM group_members WHERE group_id = ? AND user_id = ?",
+                        (chat_id, user_id)
+                    )
+                _invalidate_chat_access(chat_id, user_id)
                 return jsonify({'message': 'Вы успешно покинули групповой чат.'}), 200
             elif chat_type == 'channel':
                 # Владелец канала не может его "покинуть", он может только удалить его
@@ -910,16 +1742,16 @@ def create_app():
                 if not cursor.fetchone():
                     return jsonify({'error': 'Вы не являетесь подписчиком этого канала.'}), 403
                 
-                cursor.execute(
-                    "DELETE FROM channel_subscribers WHERE channel_id = ? AND user_id = ?",
-                    (chat_id, user_id)
-                )
-                db.commit()
+                with write_transaction() as writer:
+                    writer.execute(
+                        "DELETE FROM channel_subscribers WHERE channel_id = ? AND user_id = ?",
+                        (chat_id, user_id)
+                    )
+                _invalidate_chat_access(chat_id, user_id)
                 return jsonify({'message': 'Вы успешно отписались от канала.'}), 200
             else:
                 return jsonify({'error': 'Неизвестный тип чата.'}), 400
         except Exception as e:
-            db.rollback()
             print(f"Ошибка при выходе из чата: {e}")
             return jsonify({'error': 'Внутренняя ошибка сервера'}), 500
         finally:
@@ -931,7 +1763,7 @@ def create_app():
     @login_required
     def delete_chat_full(chat_id):
         user_id = g.user['id']
-        db = get_db()
+        db = get_read_db()
         cursor = db.cursor()
         try:
             # Получаем информацию о чате: тип и владельца
@@ -986,11 +1818,11 @@ def create_app():
                 return jsonify({'error': 'У вас нет прав на удаление этого чата.'}), 403
 
             # Удаляем чат. Благодаря ON DELETE CASCADE, все связанные записи (участники, сообщения) будут удалены.
-            cursor.execute("DELETE FROM chats WHERE id = ?", (chat_id,))
-            db.commit()
+            with write_transaction() as writer:
+                writer.execute("DELETE FROM chats WHERE id = ?", (chat_id,))
+            _invalidate_chat_access(chat_id)
             return jsonify({'message': f'Чат (ID: {chat_id}) успешно удален.'}), 200
         except Exception as e:
-            db.rollback()
             print(f"Ошибка при удалении чата: {e}")
             return jsonify({'error': 'Внутренняя ошибка сервера'}), 500
         finally:
@@ -1009,7 +1841,7 @@ def create_app():
         if role not in ['admin', 'member', 'restricted']:
             return jsonify({'error': 'Неверная роль. Допустимы: admin, member, restricted.'}), 400
 
-        db = get_db()
+        db = get_read_db()
         cursor = db.cursor()
 
         try:
@@ -1040,15 +1872,15 @@ def create_app():
             if cursor.fetchone():
                 return jsonify({'error': 'Пользователь уже является участником этой группы.'}), 409
 
-            cursor.execute(
-                "INSERT INTO group_members (group_id, user_id, role) VALUES (?, ?, ?)",
-                (group_id, target_user_id, role)
-            )
-            db.commit()
+            with write_transaction() as writer:
+                writer.execute(
+                    "INSERT INTO group_members (group_id, user_id, role) VALUES (?, ?, ?)",
+                    (group_id, target_user_id, role)
+                )
+            _invalidate_chat_access(group_id, target_user_id)
 
             return jsonify({'message': 'Пользователь успешно добавлен в группу.'}), 201
         except Exception as e:
-            db.rollback()
             print(f"Ошибка при добавлении участника группы: {e}")
             return jsonify({'error': 'Внутренняя ошибка сервера'}), 500
         finally:
@@ -1064,7 +1896,7 @@ def create_app():
         if not new_role or new_role not in ['admin', 'member', 'restricted']:
             return jsonify({'error': 'Неверная роль. Допустимы: admin, member, restricted.'}), 400
 
-        db = get_db()
+        db = get_read_db()
         cursor = db.cursor()
 
         try:
@@ -1091,18 +1923,18 @@ def create_app():
                 if admin_count == 1:
                     return jsonify({'error': 'Нельзя понизить свою роль, если вы единственный администратор группы.'}), 400
 
-            cursor.execute(
-                "UPDATE group_members SET role = ?, joined_at = CURRENT_TIMESTAMP WHERE group_id = ? AND user_id = ?",
-                (new_role, group_id, target_user_id)
-            )
-            if cursor.rowcount == 0:
+            with write_transaction() as writer:
+                updated = writer.execute(
+                    "UPDATE group_members SET role = ?, joined_at = CURRENT_TIMESTAMP WHERE group_id = ? AND user_id = ?",
+                    (new_role, group_id, target_user_id)
+                ).rowcount
+            if updated == 0:
                 return jsonify({'error': 'Пользователь не является участником этой группы.'}), 404
             
-            db.commit()
+            _invalidate_chat_access(group_id, target_user_id)
 
             return jsonify({'message': 'Роль участника успешно обновлена.'}), 200
         except Exception as e:
-            db.rollback()
             print(f"Ошибка при изменении роли участника группы: {e}")
             return jsonify({'error': 'Внутренняя ошибка сервера'}), 500
         finally:
@@ -1112,7 +1944,7 @@ def create_app():
     @login_required
     def remove_group_member(group_id, target_user_id):
         current_user_id = g.user['id']
-        db = get_db()
+        db = get_read_db()
         cursor = db.cursor()
 
         try:
@@ -1139,18 +1971,18 @@ def create_app():
                 if admin_count == 1:
                     return jsonify({'error': 'Нельзя удалить себя, если вы единственный администратор группы.'}), 400
 
-            cursor.execute(
-                "DELETE FROM group_members WHERE group_id = ? AND user_id = ?",
-                (group_id, target_user_id)
-            )
-            if cursor.rowcount == 0:
+            with write_transaction() as writer:
+                deleted = writer.execute(
+                    "DELETE FROM group_members WHERE group_id = ? AND user_id = ?",
+                    (group_id, target_user_id)
+                ).rowcount
+            if deleted == 0:
                 return jsonify({'error': 'Пользователь не является участником этой группы.'}), 404
             
-            db.commit()
+            _invalidate_chat_access(group_id, target_user_id)
 
             return jsonify({'message': 'Участник успешно удален из группы.'}), 200
         except Exception as e:
-            db.rollback()
             print(f"Ошибка при удалении участника группы: {e}")
             return jsonify({'error': 'Внутренняя ошибка сервера'}), 500
         finally:
@@ -1166,7 +1998,7 @@ def create_app():
         if not target_username:
             return jsonify({'error': 'Требуется имя пользователя (username) для добавления.'}), 400
 
-        db = get_db()
+        db = get_read_db()
         cursor = db.cursor()
 
         try:
@@ -1193,15 +2025,15 @@ def create_app():
             if cursor.fetchone():
                 return jsonify({'error': 'Пользователь уже подписан на этот канал.'}), 409
 
-            cursor.execute(
-                "INSERT INTO channel_subscribers (channel_id, user_id) VALUES (?, ?)",
-                (channel_id, target_user_id)
-            )
-            db.commit()
+            with write_transaction() as writer:
+                writer.execute(
+                    "INSERT INTO channel_subscribers (channel_id, user_id) VALUES (?, ?)",
+                    (channel_id, target_user_id)
+                )
+            _invalidate_chat_access(channel_id, target_user_id)
 
             return jsonify({'message': 'Пользователь успешно добавлен в канал.'}), 201
         except Exception as e:
-            db.rollback()
             print(f"Ошибка при добавлении подписчика канала: {e}")
             return jsonify({'error': 'Внутренняя ошибка сервера'}), 500
         finally:
@@ -1211,7 +2043,7 @@ def create_app():
     @login_required
     def unsubscribe_channel(channel_id):
         user_id = g.user['id']
-        db = get_db()
+        db = get_read_db()
         cursor = db.cursor()
 
         try:
@@ -1224,18 +2056,18 @@ def create_app():
             if user_id == chat_info['owner_id']:
                 return jsonify({'error': 'Владелец не может отписаться от собственного канала. Для удаления канала используйте DELETE /api/chats/<id>.'}), 403
 
-            cursor.execute(
-                "DELETE FROM channel_subscribers WHERE channel_id = ? AND user_id = ?",
-                (channel_id, user_id)
-            )
-            if cursor.rowcount == 0:
+            with write_transaction() as writer:
+                deleted = writer.execute(
+                    "DELETE FROM channel_subscribers WHERE channel_id = ? AND user_id = ?",
+                    (channel_id, user_id)
+                ).rowcount
+            if deleted == 0:
                 return jsonify({'error': 'Вы не подписаны на этот канал.'}), 404
             
-            db.commit()
+            _invalidate_chat_access(channel_id, user_id)
 
             return jsonify({'message': 'Вы успешно отписались от канала.'}), 200
         except Exception as e:
-            db.rollback()
             print(f"Ошибка при отписке от канала: {e}")
             return jsonify({'error': 'Внутренняя ошибка сервера'}), 500
         finally:
@@ -1245,7 +2077,7 @@ def create_app():
     @login_required
     def subscribe_channel(channel_id):
         user_id = g.user['id']
-        db = get_db()
+        db = get_read_db()
         cursor = db.cursor()
 
         try:
@@ -1261,15 +2093,15 @@ def create_app():
             if cursor.fetchone():
                 return jsonify({'error': 'Вы уже подписаны на этот канал.'}), 409
 
-            cursor.execute(
-                "INSERT INTO channel_subscribers (channel_id, user_id) VALUES (?, ?)",
-                (channel_id, user_id)
-            )
-            db.commit()
+            with write_transaction() as writer:
+                writer.execute(
+                    "INSERT INTO channel_subscribers (channel_id, user_id) VALUES (?, ?)",
+                    (channel_id, user_id)
+                )
+            _invalidate_chat_access(channel_id, user_id)
 
             return jsonify({'message': 'Вы успешно подписались на канал.'}), 201
         except Exception as e:
-            db.rollback()
             print(f"Ошибка при подписке на канал: {e}")
             return jsonify({'error': 'Внутренняя ошибка сервера'}), 500
         finally:
@@ -1278,20 +2110,95 @@ def create_app():
     @app.route('/api/users/search', methods=['GET'])
     @login_required
     def search_users():
-        query = request.args.get('query')
+        """
+        Поиск пользователей по username или display_name через FTS5-индексы.
+        Ранжирование: точное совпадение > совпадение начала > подстрока.
+        Пагинация курсором next_cursor (формат "<ранг>:<id>").
+        """
+        query = (request.args.get('query') or '').strip()
         if not query:
-            return jsonify({'users': []}), 200 # Возвращаем пустой список, если нет запроса
-        
+            return _api_response({'users': [], 'next_cursor': None}), 200 # Возвращаем пустой список, если нет запроса
+
+        raw_limit = request.args.get('limit')
+        try:
+            limit = int(raw_limit) if raw_limit else app.config['USER_SEARCH_PAGE_SIZE']
+            if limit < 1:
+                raise ValueError
+        except ValueError:
+            return jsonify({'error': 'Параметр limit должен быть положительным целым числом.'}), 400
+        limit = min(limit, app.config['USER_SEARCH_MAX_PAGE_SIZE'])
+
+        cursor_rank, cursor_id = -1, 0
+        raw_cursor = request.args.get('cursor')
+        if raw_cursor:
+            try:
+                cursor_rank, cursor_id = (int(part) for part in raw_cursor.split(':', 1))
+            except ValueError:
+                return jsonify({'error': 'Некорректный cursor.'}), 400
+
+        folded, fts_table, match = _user_search_match(query)
+        exact_sql = "(u.username_folded = :q OR u.display_name_folded = :q)"
+        prefix_sql = "(substr(u.username_folded, 1, :q_len) = :q OR substr(u.display_name_folded, 1, :q_len) = :q)"
+        # Совпадения FTS идут по возрастанию rowid: выборка останавливается на LIMIT без сортировки
+        fts_sql = (f"SELECT u.id FROM {fts_table} f CROSS JOIN users u ON u.id = f.rowid "
+                   f"WHERE {fts_table} MATCH :match AND f.rowid > :after_id AND u.is_deleted = FALSE AND {{}} "
+                   f"ORDER BY f.rowid LIMIT :limit")
+        params = {'q': folded, 'q_len': len(folded), 'q_end': folded + '\U0010ffff', 'match': match,
+                  'probe': USER_SEARCH_PREFIX_SORT_MAX}
+
         db = get_db()
         cursor = db.cursor()
         try:
-            # Ищем по username или display_name, исключая удаленных пользователей
+            # Совпадений начала строки немного - их берут диапазоны индексов *_folded и сортирует SQLite;
+            # если их много, первые по id быстрее найти в потоке FTS. Число оценивается с ограничением.
             cursor.execute(
-                "SELECT id, username, display_name, avatar_url FROM users WHERE (username LIKE ? OR display_name LIKE ?) AND is_deleted = FALSE LIMIT 10",
-                (f'%{query}%', f'%{query}%')
+                """
+                SELECT (SELECT count(*) FROM (SELECT 1 FROM users WHERE username_folded >= :q AND username_folded < :q_end LIMIT :probe))
+                     + (SELECT count(*) FROM (SELECT 1 FROM users WHERE display_name_folded >= :q AND display_name_folded < :q_end LIMIT :probe))
+                """,
+                params
             )
-            users = cursor.fetchall()
-            return jsonify({'users': users}), 200
+            if cursor.fetchone()[0] < USER_SEARCH_PREFIX_SORT_MAX:
+                prefix_tier_sql = (
+                    "SELECT u.id FROM ("
+                    "    SELECT id FROM users WHERE username_folded >= :q AND username_folded < :q_end AND id > :after_id"
+                    "    UNION"
+                    "    SELECT id FROM users WHERE display_name_folded >= :q AND display_name_folded < :q_end AND id > :after_id"
+                    f") AS p CROSS JOIN users u ON u.id = p.id WHERE NOT {exact_sql} AND u.is_deleted = FALSE "
+                    "ORDER BY u.id LIMIT :limit"
+                )
+            else:
+                prefix_tier_sql = fts_sql.format(f"{prefix_sql} AND NOT {exact_sql}")
+            tiers = [
+                # 0 - точное совпадение (поиск по индексам *_folded), 1 - совпадение начала, 2 - остальные
+                f"SELECT u.id FROM users u WHERE {exact_sql} AND u.is_deleted = FALSE AND u.id > :after_id ORDER BY u.id LIMIT :limit",
+                prefix_tier_sql,
+                fts_sql.format(f"NOT {prefix_sql}"),
+            ]
+
+            # Уровни ранжирования читаются по очереди, пока не набрана страница и одна строка сверх нее
+            hits = [] # (match_rank, id)
+            for match_rank in range(max(cursor_rank, 0), len(tiers)):
+                after_id = cursor_id if match_rank == cursor_rank else 0
+                cursor.execute(tiers[match_rank], dict(params, after_id=after_id, limit=limit + 1 - len(hits)))
+                hits.extend((match_rank, row['id']) for row in cursor.fetchall())
+                if len(hits) > limit:
+                    break
+            has_more = len(hits) > limit
+            hits = hits[:limit]
+
+            users = []
+            if hits:
+                placeholders = ', '.join('?' for _ in hits)
+                cursor.execute(f"SELECT id, username, display_name, avatar_url FROM users WHERE id IN ({placeholders})",
+                               [user_id for _, user_id in hits])
+                rows_by_id = {row['id']: row for row in cursor.fetchall()}
+                users = [{'id': user_id, 'username': rows_by_id[user_id]['username'],
+                          'display_name': rows_by_id[user_id]['display_name'],
+                          'avatar_url': rows_by_id[user_id]['avatar_url']}
+                         for _, user_id in hits if user_id in rows_by_id]
+            next_cursor = f"{hits[-1][0]}:{hits[-1][1]}" if has_more else None
+            return _api_response({'users': users, 'next_cursor': next_cursor}), 200
         except Exception as e:
             print(f"Ошибка при поиске пользователей: {e}")
             return jsonify({'error': 'Внутренняя ошибка сервера'}), 500
@@ -1305,46 +2212,18 @@ def create_app():
     @login_required
     def send_message(chat_id):
         sender_id = g.user['id']
-        db = get_db()
+        # Права проверяем через читателя: соединение-писатель (одно на процесс) берется
+        # только на INSERT, а не на время приема тела запроса и записи файла
+        db = get_read_db()
         cursor = db.cursor()
 
         try:
-            # Проверяем, существует ли чат
-            cursor.execute("SELECT type FROM chats WHERE id = ?", (chat_id,))
-            chat_info = cursor.fetchone()
-            if not chat_info:
+            # Проверяем, существует ли чат и может ли отправитель писать в него
+            access = _get_chat_access(cursor, chat_id, sender_id)
+            if not access:
                 return jsonify({'error': 'Чат не найден.'}), 404
-            
-            chat_type = chat_info['type']
+            can_send_message = access['can_send']
 
-            # Проверяем, что отправитель является участником чата и имеет право писать
-            can_send_message = False
-            if chat_type == 'private':
-                cursor.execute(
-                    "SELECT 1 FROM private_chats WHERE chat_id = ? AND (user1_id = ? OR user2_id = ?)",
-                    (chat_id, sender_id, sender_id)
-                )
-                if cursor.fetchone():
-                    can_send_message = True
-            elif chat_type == 'group':
-                cursor.execute(
-                    "SELECT role FROM group_members WHERE group_id = ? AND user_id = ?",
-                    (chat_id, sender_id)
-                )
-                member_info = cursor.fetchone()
-                # Только админы и обычные участники могут писать. 'restricted' не могут.
-                if member_info and member_info['role'] in ['admin', 'member']:
-                    can_send_message = True
-            elif chat_type == 'channel':
-                # В канале могут писать только владельцы
-                cursor.execute(
-                    "SELECT owner_id FROM chats WHERE id = ?",
-                    (chat_id,)
-                )
-                channel_owner_info = cursor.fetchone()
-                if channel_owner_info and channel_owner_info['owner_id'] == sender_id:
-                    can_send_message = True
-                
             if not can_send_message:
                 return jsonify({'error': 'У вас нет прав для отправки сообщений в этот чат.'}), 403
 
@@ -1355,12 +2234,11 @@ def create_app():
                 if not content or not content.strip():
                     return jsonify({'error': 'Текстовое сообщение не может быть пустым.'}), 400
                 
-                cursor.execute(
+                message_id = _insert_message(
                     "INSERT INTO messages (chat_id, sender_id, message_type, content) VALUES (?, ?, ?, ?)",
                     (chat_id, sender_id, message_type, content.strip())
                 )
-                db.commit()
-                message_id = cursor.lastrowid
+                _publish_message_event(cursor, chat_id, message_id, 'message_created')
                 return jsonify({'message': 'Текстовое сообщение отправлено', 'message_id': message_id}), 201
 
             # Обработка файловых сообщений (если файл загружен)
@@ -1371,23 +2249,10 @@ def create_app():
                 
                 if file and allowed_file(file.filename):
                     original_filename = file.filename
-                    # Генерируем уникальное имя файла для хранения
-                    filename = str(uuid.uuid4()) + '.' + original_filename.rsplit('.', 1)[1].lower()
-                    file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                    file.save(file_path)
-                    
-                    file_size = os.path.getsize(file_path) # Получаем размер файла
-
-                    message_type = 'file'
-                    # _external=True необходимо для создания полного URL, доступного извне
-                    file_url = url_for('uploaded_file', filename=filename, _external=True)
+                    # Хешируем по мере записи; одинаковое содержимое хранится один раз
+                    sha256, file_size = _store_blob(file.stream)
 
-                    cursor.execute(
-                        "INSERT INTO messages (chat_id, sender_id, message_type, file_url, file_name, file_size) VALUES (?, ?, ?, ?, ?, ?)",
-                        (chat_id, sender_id, message_type, file_url, original_filename, file_size)
-                    )
-                    db.commit()
-                    message_id = cursor.lastrowid
+                    message_id, file_url = _create_file_message(cursor, chat_id, sender_id, sha256, original_filename, file_size)
                     return jsonify({'message': 'Файловое сообщение отправлено', 'message_id': message_id, 'file_url': file_url, 'file_name': original_filename, 'file_size': file_size}), 201
                 else:
                     return jsonify({'error': 'Недопустимый тип файла или файл слишком большой.'}), 400
@@ -1395,16 +2260,352 @@ def create_app():
                 return jsonify({'error': 'Необходимо предоставить либо "content" (текст), либо "file" (файл).'}), 400
 
         except Exception as e:
-            db.rollback()
             print(f"Ошибка при отправке сообщения: {e}")
             return jsonify({'error': 'Внутренняя ошибка сервера'}), 500
         finally:
             cursor.close()
 
+    def _send_local_file(directory, relpath, mimetype, etag, immutable):
+        """
+        Отдает файл из локального каталога с поддержкой Range и условных запросов.
+        При FILE_OFFLOAD файл передает фронт-прокси, а рабочий процесс сразу освобождается.
+        """
+        max_age = app.config['UPLOAD_CACHE_MAX_AGE'] if immutable else None
+        if app.config['FILE_OFFLOAD'] == 'x-accel':
+            path = safe_join(directory, relpath)
+            if path is None or not os.path.isfile(path):
+                abort(404)
+            # Range, ETag и 304 для внутреннего location обрабатывает nginx
+            response = app.response_class(mimetype=mimetype)
+            response.headers['X-Accel-Redirect'] = app.config['FILE_OFFLOAD_PREFIX'].rstrip('/') + '/' + relpath
+            if max_age is not None:
+                response.cache_control.public = True
+                response.cache_control.max_age = max_age
+        else:
+            # Для 'x-sendfile' send_file отдает только заголовок X-Sendfile (USE_X_SENDFILE)
+            response = send_from_directory(directory, relpath, mimetype=mimetype, etag=etag, max_age=max_age)
+        if max_age is not None:
+            response.cache_control.immutable = True
+        return response
+
     @app.route('/uploads/<path:filename>')
     def uploaded_file(filename):
-        """Маршрут для отдачи загруженных файлов."""
-        return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+        """
+        Маршрут для отдачи загруженных файлов.
+        Файлы из удаленного хранилища отдаются редиректом на подписанную ссылку.
+        """
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        # Файлы по адресу содержимого хранятся без расширения: <sha256>.<ext> -> <sha256>
+        name, _, _ = filename.partition('.')
+        if SHA256_RE.match(name):
+            storage = _get_storage()
+            url = storage.url(name, mimetype)
+            if url is not None:
+                return redirect(url)
+            # Хеш содержимого - готовый строгий ETag
+            return _send_local_file(storage.root, storage.relpath(name), mimetype, etag=name, immutable=True)
+        # Файлы, загруженные до хранения по адресу содержимого, лежат в UPLOAD_FOLDER без шардов
+        return _send_local_file(app.config['UPLOAD_FOLDER'], filename, mimetype, etag=True,
+                                immutable=bool(UUID_FILENAME_RE.match(filename)))
+
+    @app.route('/thumbnails/<filename>')
+    def thumbnail(filename):
+        """
+        Миниатюра изображения: <sha256 исходного файла>.jpg. Миниатюры кешируются на диске;
+        если миниатюры еще нет, она ставится в пул процессов, а клиент получает 202 и повторяет запрос.
+        """
+        sha256, _, ext = filename.partition('.')
+        if not SHA256_RE.match(sha256) or ext != 'jpg':
+            abort(404)
+        thumbnails = _get_thumbnails()
+        if not thumbnails.exists(filename):
+            if thumbnail_executor is None or thumbnails_failed.get(sha256) or not _get_storage().exists(sha256):
+                abort(404)
+            cursor = get_db().cursor()
+            try:
+                cursor.execute("SELECT file_name FROM messages WHERE file_sha256 = ? LIMIT 1", (sha256,))
+                message = cursor.fetchone()
+            finally:
+                cursor.close()
+            if message is None or not is_image(message['file_name']):
+                abort(404)
+            try:
+                _submit_thumbnail(sha256) # Запрос не ждет пул: рабочий поток сразу свободен
+            except Exception as e:
+                print(f"Ошибка при построении миниатюры {sha256}: {e}")
+                abort(404)
+            response = jsonify({'error': 'Миниатюра еще не готова.'})
+            response.headers['Retry-After'] = '1'
+            response.cache_control.no_store = True
+            return response, 202
+        response = send_from_directory(app.config['THUMBNAIL_FOLDER'], thumbnails.relpath(filename),
+                                       etag=sha256, max_age=app.config['UPLOAD_CACHE_MAX_AGE'])
+        response.cache_control.immutable = True
+        return response
+
+    # --- Возобновляемая загрузка файлов ---
+    def _upload_part_path(upload_id):
+        return os.path.join(app.config['UPLOAD_TEMP_FOLDER'], upload_id + '.part')
+
+    def _get_upload_session(cursor, upload_id, user_id):
+        cursor.execute("SELECT * FROM upload_sessions WHERE id = ? AND user_id = ?", (upload_id, user_id))
+        return cursor.fetchone()
+
+    @app.route('/api/chats/<int:chat_id>/uploads', methods=['POST'])
+    @login_required
+    def create_upload(chat_id):
+        """
+        Начинает возобновляемую загрузку файла в чат. Тело (JSON): file_name, file_size.
+        Части отправляются через PUT /api/uploads/<upload_id>?offset=N,
+        POST /api/uploads/<upload_id>/complete превращает файл в сообщение.
+        """
+        user_id = g.user['id']
+        data = request.get_json(silent=True) or {}
+        file_name = (data.get('file_name') or '').strip()
+        file_size = data.get('file_size')
+        sha256 = data.get('sha256')
+
+        if sha256 is not None and (not isinstance(sha256, str) or not SHA256_RE.match(sha256)):
+            return jsonify({'error': 'Параметр sha256 должен быть SHA-256 в hex (64 символа в нижнем регистре).'}), 400
+        if not file_name or not allowed_file(file_name):
+            return jsonify({'error': 'Недопустимое имя или тип файла.'}), 400
+        if not isinstance(file_size, int) or isinstance(file_size, bool) or file_size <= 0:
+            return jsonify({'error': 'Параметр file_size должен быть положительным целым числом.'}), 400
+        if file_size > app.config['UPLOAD_MAX_FILE_SIZE']:
+            return jsonify({'error': 'Файл слишком большой.'}), 413
+
+        db = get_read_db()
+        cursor = db.cursor()
+        try:
+            access = _get_chat_access(cursor, chat_id, user_id)
+            if not access:
+                return jsonify({'error': 'Чат не найден.'}), 404
+            if not access['can_send']:
+                return jsonify({'error': 'У вас нет прав для отправки сообщений в этот чат.'}), 403
+
+            # Такое содержимое уже хранится - файл не загружается повторно, сообщение создается сразу
+            if sha256 is not None and _find_blob(cursor, sha256, file_size):
+                message_id, file_url = _create_file_message(cursor, chat_id, user_id, sha256, file_name, file_size)
+                return jsonify({'message': 'Файловое сообщение отправлено', 'message_id': message_id, 'file_url': file_url,
+                                'file_name': file_name, 'file_size': file_size, 'deduplicated': True}), 201
+
+            upload_id = uuid.uuid4().hex
+            open(_upload_part_path(upload_id), 'wb').close() # Части дописываются в этот файл по смещению
+            with write_transaction() as writer:
+                writer.execute(
+                    "INSERT INTO upload_sessions (id, user_id, chat_id, file_name, file_size, sha256) VALUES (?, ?, ?, ?, ?, ?)",
+                    (upload_id, user_id, chat_id, file_name, file_size, sha256)
+                )
+            return jsonify({
+                'upload_id': upload_id,
+                'offset': 0,
+                'file_size': file_size,
+                'chunk_size': app.config['UPLOAD_CHUNK_SIZE']
+            }), 201
+        except Exception as e:
+            print(f"Ошибка при создании загрузки: {e}")
+            return jsonify({'error': 'Внутренняя ошибка сервера'}), 500
+        finally:
+            cursor.close()
+
+    @app.route('/api/uploads/<upload_id>', methods=['GET'])
+    @login_required
+    def get_upload(upload_id):
+        """Состояние загрузки: offset - сколько байт уже принято (с него продолжают после обрыва)."""
+        db = get_db()
+        cursor = db.cursor()
+        try:
+            upload = _get_upload_session(cursor, upload_id, g.user['id'])
+            if upload is None:
+                return jsonify({'error': 'Загрузка не найдена.'}), 404
+            return jsonify({
+                'upload_id': upload['id'],
+                'chat_id': upload['chat_id'],
+                'file_name': upload['file_name'],
+                'file_size': upload['file_size'],
+                'offset': upload['received_size'],
+                'status': upload['status']
+            }), 200
+        except Exception as e:
+            print(f"Ошибка при получении состояния загрузки: {e}")
+            return jsonify({'error': 'Внутренняя ошибка сервера'}), 500
+        finally:
+            cursor.close()
+
+    @app.route('/api/uploads/<upload_id>', methods=['PUT'])
+    @login_required
+    def put_upload_chunk(upload_id):
+        """
+        Принимает часть файла (тело запроса - сырые байты) начиная с offset.
+        offset должен совпадать с уже принятым объемом, иначе 409 с актуальным offset.
+        Тело пишется на диск по мере чтения, без буферизации в памяти.
+        """
+        user_id = g.user['id']
+        offset = request.args.get('offset', type=int)
+        if offset is None or offset < 0:
+            return jsonify({'error': 'Требуется неотрицательный параметр offset.'}), 400
+        length = request.content_length
+        if length is not None and length > app.config['MAX_CONTENT_LENGTH']:
+            return jsonify({'error': 'Часть слишком большая.', 'chunk_size': app.config['UPLOAD_CHUNK_SIZE']}), 413
+
+        db = get_read_db()
+        cursor = db.cursor()
+        try:
+            upload = _get_upload_session(cursor, upload_id, user_id)
+            if upload is None:
+                return jsonify({'error': 'Загрузка не найдена.'}), 404
+            if length is not None and offset + length > upload['file_size']:
+                return jsonify({'error': 'Часть выходит за пределы объявленного размера файла.'}), 400
+
+            # Захватываем сессию на время записи: смещение должно совпасть с принятым объемом,
+            # а другой запрос не должен писать ту же загрузку (зависший захват истекает по таймауту)
+            with write_transaction() as writer:
+                claimed = writer.execute(
+                    """
+                    UPDATE upload_sessions SET status = 'writing', updated_at = CURRENT_TIMESTAMP
+                    WHERE id = ? AND received_size = ?
+                      AND (status = 'pending' OR updated_at < datetime('now', ?))
+                    """,
+                    (upload_id, offset, f"-{app.config['UPLOAD_CLAIM_TIMEOUT']} seconds")
+                ).rowcount
+            if claimed == 0:
+                return jsonify({'error': 'Смещение не совпадает с принятым объемом, или часть уже записывается.',
+                                'offset': upload['received_size']}), 409
+        except Exception as e:
+            print(f"Ошибка при приеме части загрузки: {e}")
+            return jsonify({'error': 'Внутренняя ошибка сервера'}), 500
+        finally:
+            cursor.close()
+
+        # Не держим соединение, пока читаем тело
+        close_db()
+
+        written = 0
+        failed = False
+        try:
+            with open(_upload_part_path(upload_id), 'r+b') as part:
+                part.seek(offset)
+                remaining = upload['file_size'] - offset
+                try:
+                    while remaining > 0:
+                        chunk = request.stream.read(min(64 * 1024, remaining))
+                        if not chunk:
+                            break
+                        part.write(chunk)
+                        written += len(chunk)
+                        remaining -= len(chunk)
+                finally:
+                    # Даже при обрыве соединения сохраняем принятое: клиент продолжит с нового offset
+                    part.flush()
+                    os.fsync(part.fileno())
+        except Exception as e:
+            failed = True
+            print(f"Ошибка при записи части загрузки: {e}")
+
+        try:
+            with write_transaction() as writer:
+                writer.execute(
+                    "UPDATE upload_sessions SET received_size = ?, status = 'pending', updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+                    (offset + written, upload_id)
+                )
+        except Exception as e:
+            print(f"Ошибка при сохранении прогресса загрузки: {e}")
+            return jsonify({'error': 'Внутренняя ошибка сервера'}), 500
+
+        if failed:
+            return jsonify({'error': 'Часть принята не полностью. Продолжите с offset.', 'offset': offset + written}), 400
+        return jsonify({
+            'offset': offset + written,
+            'file_size': upload['file_size'],
+            'complete': offset + written == upload['file_size']
+        }), 200
+
+    @app.route('/api/uploads/<upload_id>/complete', methods=['POST'])
+    @login_required
+    def complete_upload(upload_id):
+        """Завершает загрузку: файл переносится в хранилище и отправляется в чат сообщением."""
+        user_id = g.user['id']
+        db = get_read_db()
+        cursor = db.cursor()
+        try:
+            upload = _get_upload_session(cursor, upload_id, user_id)
+            if upload is None:
+                return jsonify({'error': 'Загрузка не найдена.'}), 404
+            if upload['status'] != 'pending' or upload['received_size'] != upload['file_size']:
+                return jsonify({'error': 'Файл загружен не полностью.', 'offset': upload['received_size']}), 409
+
+            # Права могли измениться, пока файл загружался
+            access = _get_chat_access(cursor, upload['chat_id'], user_id)
+            if not access or not access['can_send']:
+                return jsonify({'error': 'У вас нет прав для отправки сообщений в этот чат.'}), 403
+
+            completing_path = _upload_part_path(upload_id) + '.completing'
+            try:
+                # Переименование атомарно: повторный complete той же загрузки файла уже не найдет
+                os.replace(_upload_part_path(upload_id), completing_path)
+            except FileNotFoundError:
+                return jsonify({'error': 'Загрузка уже завершена.'}), 409
+        except Exception as e:
+            print(f"Ошибка при завершении загрузки: {e}")
+            return jsonify({'error': 'Внутренняя ошибка сервера'}), 500
+        finally:
+            cursor.close()
+
+        # Хеш файла (до UPLOAD_MAX_FILE_SIZE) и перенос в хранилище (возможно, S3) выполняются
+        # без соединения с базой: писатель берется только на короткие транзакции ниже
+        close_db()
+
+        claimed_path = completing_path
+        cursor = None
+        try:
+            # Части приходили в разных запросах, поэтому хеш считаем один раз по готовому файлу
+            sha256 = _hash_file(completing_path)
+            if upload['sha256'] is not None and upload['sha256'] != sha256:
+                os.remove(completing_path)
+                claimed_path = None
+                with write_transaction() as writer:
+                    writer.execute("DELETE FROM upload_sessions WHERE id = ?", (upload_id,))
+                return jsonify({'error': 'Хеш загруженного файла не совпадает с sha256. Загрузите файл заново.'}), 400
+            _put_blob(sha256, upload['file_size'], completing_path)
+            claimed_path = None # Файл в хранилище; если сообщение не создано, его уберет сборщик мусора
+
+            # Удаление сессии - захват завершения: параллельная отмена (или повторный complete) удалит ее раньше
+            with write_transaction() as writer:
+                deleted = writer.execute("DELETE FROM upload_sessions WHERE id = ? AND user_id = ?", (upload_id, user_id)).rowcount
+            if deleted == 0:
+                return jsonify({'error': 'Загрузка отменена.'}), 409
+            cursor = get_read_db().cursor()
+            message_id, file_url = _create_file_message(
+                cursor, upload['chat_id'], user_id, sha256, upload['file_name'], upload['file_size']
+            )
+            return jsonify({'message': 'Файловое сообщение отправлено', 'message_id': message_id, 'file_url': file_url,
+                            'file_name': upload['file_name'], 'file_size': upload['file_size']}), 201
+        except Exception as e:
+            if claimed_path is not None:
+                os.replace(claimed_path, _upload_part_path(upload_id)) # Загрузку можно завершить снова
+            print(f"Ошибка при завершении загрузки: {e}")
+            return jsonify({'error': 'Внутренняя ошибка сервера'}), 500
+        finally:
+            if cursor is not None:
+                cursor.close()
+
+    @app.route('/api/uploads/<upload_id>', methods=['DELETE'])
+    @login_required
+    def cancel_upload(upload_id):
+        """Отменяет загрузку и удаляет принятые части."""
+        try:
+            with write_transaction() as writer:
+                deleted = writer.execute("DELETE FROM upload_sessions WHERE id = ? AND user_id = ?", (upload_id, g.user['id'])).rowcount
+            if deleted == 0:
+                return jsonify({'error': 'Загрузка не найдена.'}), 404
+            try:
+                os.remove(_upload_part_path(upload_id))
+            except FileNotFoundError:
+                pass
+            return jsonify({'message': 'Загрузка отменена.'}), 200
+        except Exception as e:
+            print(f"Ошибка при отмене загрузки: {e}")
+            return jsonify({'error': 'Внутренняя ошибка сервера'}), 500
 
     @app.route('/api/chats/<int:chat_id>/messages', methods=['GET'])
     @login_required
@@ -1415,110 +2616,251 @@ def create_app():
 
         try:
             # Проверяем доступ пользователя к чату
-            is_member = False
-            cursor.execute("SELECT type FROM chats WHERE id = ?", (chat_id,))
-            chat_info = cursor.fetchone()
-            if not chat_info:
-                return jsonify({'error': 'Чат не найден.'}), 404
-            
-            chat_type = chat_info['type']
+            access_error = _check_chat_read_access(cursor, chat_id, user_id)
+            if access_error:
+                return access_error
 
-            if chat_type == 'private':
-                cursor.execute(
-                    "SELECT 1 FROM private_chats WHERE chat_id = ? AND (user1_id = ? OR user2_id = ?)",
-                    (chat_id, user_id, user_id)
-                )
-                is_member = cursor.fetchone() is not None
-            elif chat_type == 'group':
-                cursor.execute(
-                    "SELECT 1 FROM group_members WHERE group_id = ? AND user_id = ?",
-                    (chat_id, user_id)
-                )
-                is_member = cursor.fetchone() is not None
-            elif chat_type == 'channel':
+            # Параметры курсорной пагинации (keyset по messages.id)
+            try:
+                before_id = _parse_message_id_arg('before_id')
+                after_id = _parse_message_id_arg('after_id')
+                limit = _parse_page_limit(request.args.get('limit'))
+                compact = _parse_message_format()
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+
+            if before_id is not None and after_id is not None:
+                return jsonify({'error': 'Нельзя одновременно указывать before_id и after_id.'}), 400
+
+            # Страница не менялась, если не изменились версия чата и профили пользователей (имена отправителей)
+            etag = _make_etag('messages', chat_id, _get_chat_version(cursor, chat_id), _get_revision(cursor, 'users'),
+                              before_id, after_id, limit, compact)
+            not_modified = _not_modified(etag)
+            if not_modified is not None:
+                return not_modified
+
+            # Текущая ревизия чата - отправная точка для инкрементальной синхронизации.
+            # Читаем ее до сообщений: изменение между запросами клиент догрузит через sync, а не пропустит
+            revision = _get_chat_revision(cursor, chat_id)
+
+            select_sql = MESSAGE_COMPACT_SELECT_SQL if compact else MESSAGE_SELECT_SQL
+            # Индекс (chat_id, id) позволяет SQLite читать только нужную страницу
+            if after_id is not None:
+                cursor.execute(select_sql + " WHERE m.chat_id = ? AND m.id > ? ORDER BY m.id ASC LIMIT ?",
+                               (chat_id, after_id, limit))
+            else:
+                # Последняя страница (или страница перед before_id) выбирается с конца и
+                # переворачивается в SQL: клиенту всегда отдаем хронологический порядок
+                where, params = ("m.chat_id = ? AND m.id < ?", (chat_id, before_id)) if before_id is not None \
+                    else ("m.chat_id = ?", (chat_id,))
                 cursor.execute(
-                    "SELECT 1 FROM channel_subscribers WHERE channel_id = ? AND user_id = ?",
-                    (chat_id, user_id)
+                    f"SELECT * FROM ({select_sql} WHERE {where} ORDER BY m.id DESC LIMIT ?) ORDER BY id ASC",
+                    params + (limit,)
                 )
-                is_member = cursor.fetchone() is not None
-            
-            if not is_member:
-                return jsonify({'error': 'У вас нет доступа к этому чату.'}), 403
 
-            # Получаем сообщения для чата
-            # LEFT JOIN с users для получения display_name отправителя.
-            # CASE WHEN u.is_deleted = TRUE OR u.id IS NULL для отображения "Удаленный пользователь"
-            cursor.execute(
-                """
-                SELECT
-                    m.id,
-                    m.chat_id,
-                    m.sender_id,
-                    CASE
-                        WHEN u.is_deleted = TRUE OR u.id IS NULL THEN 'Удаленный пользователь'
-                        ELSE u.display_name
-                    END AS sender_display_name,
-                    CASE
-                        WHEN u.is_deleted = TRUE OR u.id IS NULL THEN NULL -- Аватар удаленного пользователя
-                        ELSE u.avatar_url
-                    END AS sender_avatar_url,
-                    m.message_type,
-                    m.content,
-                    m.file_url,
-                    m.file_name,
-                    m.file_size,
-                    m.sent_at,
-                    m.is_deleted
-                FROM messages m
-                LEFT JOIN users u ON m.sender_id = u.id
-                WHERE m.chat_id = ?
-                ORDER BY m.sent_at ASC
-                """,
-                (chat_id,)
-            )
-            messages = cursor.fetchall()
-
-            # Форматируем сообщения для ответа
-            formatted_messages = []
-            for msg in messages:
-                formatted_msg = {
-                    'id': msg['id'],
-                    'chat_id': msg['chat_id'],
-                    'sender_id': msg['sender_id'],
-                    'sender_display_name': msg['sender_display_name'],
-                    'sender_avatar_url': msg['sender_avatar_url'],
-                    'message_type': msg['message_type'],
-                    'sent_at': msg['sent_at'],
-                    'is_deleted': bool(msg['is_deleted'])
+            page = {'first_id': None, 'last_id': None, 'sender_ids': set()}
+
+            def format_row(msg):
+                if page['first_id'] is None:
+                    page['first_id'] = msg['id']
+                page['last_id'] = msg['id']
+                page['sender_ids'].add(msg['sender_id'])
+                return _format_message(msg, compact)
+
+            def page_cursor():
+                # Вызывается после выдачи всех сообщений страницы
+                if page['first_id'] is None:
+                    has_more = False
+                elif after_id is not None:
+                    has_more = db.execute("SELECT EXISTS (SELECT 1 FROM messages WHERE chat_id = ? AND id > ?)",
+                                          (chat_id, page['last_id'])).fetchone()[0] == 1
+                else:
+                    has_more = db.execute("SELECT EXISTS (SELECT 1 FROM messages WHERE chat_id = ? AND id < ?)",
+                                          (chat_id, page['first_id'])).fetchone()[0] == 1
+                return {
+                    'before_id': page['first_id'] if page['first_id'] is not None else before_id,
+                    'after_id': page['last_id'] if page['last_id'] is not None else after_id,
+                    'has_more': has_more,
+                    'limit': limit
                 }
-                if not formatted_msg['is_deleted']: # Отображаем контент, только если сообщение не удалено
-                    if msg['message_type'] == 'text':
-                        formatted_msg['content'] = msg['content']
-                    elif msg['message_type'] == 'file':
-                        formatted_msg['file_url'] = msg['file_url']
-                        formatted_msg['file_name'] = msg['file_name']
-                        formatted_msg['file_size'] = msg['file_size']
-                else: # Если сообщение удалено, скрываем контент
-                    formatted_msg['content'] = '[Сообщение удалено]'
-                    formatted_msg['file_url'] = None
-                    formatted_msg['file_name'] = None
-                    formatted_msg['file_size'] = None
-
-                formatted_messages.append(formatted_msg)
-
-            return jsonify({'messages': formatted_messages}), 200
+
+            # Сообщения сериализуются по одной строке прямо из курсора
+            payload = {
+                'messages': LazyArray(cursor, format_row),
+                'cursor': LazyValue(page_cursor),
+                'revision': revision
+            }
+            if compact:
+                # Отправители страницы - один раз, после сообщений
+                payload['users'] = LazyValue(lambda: _load_users_map(db, page['sender_ids']))
+            response = _stream_response(payload, cursor)
+            cursor = None # Курсор закроет генератор ответа
+            return _set_etag(response, etag), 200
 
         except Exception as e:
             print(f"Ошибка при получении сообщений: {e}")
             return jsonify({'error': 'Внутренняя ошибка сервера'}), 500
+        finally:
+            if cursor is not None:
+                cursor.close()
+
+    @app.route('/api/chats/<int:chat_id>/messages/sync', methods=['GET'])
+    @login_required
+    def sync_messages(chat_id):
+        """
+        Инкрементальная синхронизация: возвращает сообщения, добавленные или
+        удаленные после ревизии since. Если изменений нет - 204 без тела.
+        С параметром wait работает как long polling: ждет до wait секунд,
+        пока в чате не появится изменение.
+        """
+        user_id = g.user['id']
+        since = request.args.get('since', type=int)
+        if since is None or since < 0:
+            return jsonify({'error': 'Требуется неотрицательный параметр since (ревизия).'}), 400
+        wait = request.args.get('wait', default=0, type=float)
+        if wait < 0:
+            return jsonify({'error': 'Параметр wait не может быть отрицательным.'}), 400
+        wait = min(wait, app.config['LONG_POLL_MAX_WAIT_SECONDS'])
+
+        db = get_db()
+        cursor = db.cursor()
+
+        try:
+            try:
+                limit = _parse_page_limit(request.args.get('limit'))
+                compact = _parse_message_format()
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+
+            access_error = _check_chat_read_access(cursor, chat_id, user_id)
+            if access_error:
+                return access_error
+
+            # Токен берется до чтения из БД, чтобы не пропустить сообщение,
+            # закоммиченное между запросом и началом ожидания
+            token = chat_notifier.token(chat_id)
+
+            # Индекс (chat_id, revision) позволяет вернуть только изменения
+            changes_query = (MESSAGE_COMPACT_SELECT_SQL if compact else MESSAGE_SELECT_SQL) + \
+                " WHERE m.chat_id = ? AND m.revision > ? ORDER BY m.revision ASC LIMIT ?"
+            cursor.execute(changes_query, (chat_id, since, limit + 1))
+            messages = cursor.fetchall()
+
+            if not messages and wait > 0 and chat_notifier.wait(chat_id, token, wait):
+                cursor.execute(changes_query, (chat_id, since, limit + 1))
+                messages = cursor.fetchall()
+
+            if not messages:
+                return '', 204 # Изменений нет - пустой ответ
+
+            has_more = len(messages) > limit
+            messages = messages[:limit]
+
+            result = {
+                'messages': [_format_message(msg, compact) for msg in messages],
+                'revision': messages[-1]['revision'], # Передайте как since в следующем запросе
+                'has_more': has_more
+            }
+            if compact:
+                result['users'] = _load_users_map(db, {msg['sender_id'] for msg in messages})
+            return _api_response(result), 200
+
+        except Exception as e:
+            print(f"Ошибка при синхронизации сообщений: {e}")
+            return jsonify({'error': 'Внутренняя ошибка сервера'}), 500
+        finally:
+            cursor.close()
+
+    @app.route('/api/chats/<int:chat_id>/messages/search', methods=['GET'])
+    @login_required
+    def search_chat_messages(chat_id):
+        """Полнотекстовый поиск по сообщениям одного чата."""
+        user_id = g.user['id']
+        try:
+            fts_query, limit, offset = _parse_search_args()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        db = get_db()
+        cursor = db.cursor()
+        try:
+            access_error = _check_chat_read_access(cursor, chat_id, user_id)
+            if access_error:
+                return access_error
+            if not fts_query:
+                return _api_response({'messages': [], 'next_offset': None}), 200
+
+            messages, has_more = _search_messages(
+                cursor, fts_query, ('', 'm.chat_id = :chat_id'), {'chat_id': chat_id}, limit, offset
+            )
+            return _api_response({'messages': messages, 'next_offset': offset + limit if has_more else None}), 200
+        except Exception as e:
+            print(f"Ошибка при поиске сообщений в чате: {e}")
+            return jsonify({'error': 'Внутренняя ошибка сервера'}), 500
+        finally:
+            cursor.close()
+
+    @app.route('/api/messages/search', methods=['GET'])
+    @login_required
+    def search_all_messages():
+        """Полнотекстовый поиск по сообщениям во всех чатах текущего пользователя."""
+        user_id = g.user['id']
+        try:
+            fts_query, limit, offset = _parse_search_args()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if not fts_query:
+            return _api_response({'messages': [], 'next_offset': None}), 200
+
+        db = get_db()
+        cursor = db.cursor()
+        try:
+            messages, has_more = _search_messages(
+                cursor, fts_query, (USER_CHATS_CTE, 'm.chat_id IN (SELECT chat_id FROM my_chats)'),
+                {'user_id': user_id}, limit, offset
+            )
+            return _api_response({'messages': messages, 'next_offset': offset + limit if has_more else None}), 200
+        except Exception as e:
+            print(f"Ошибка при поиске сообщений: {e}")
+            return jsonify({'error': 'Внутренняя ошибка сервера'}), 500
         finally:
             cursor.close()
 
+    @app.route('/api/events', methods=['GET'])
+    @login_required
+    def event_stream():
+        """
+        Поток Server-Sent Events для текущего пользователя.
+        События: message_created, message_deleted, resync (клиенту нужно
+        догрузить изменения через /messages/sync). Пустые комментарии
+        периодически отправляются, чтобы прокси не закрывали соединение.
+        """
+        subscription = event_broker.subscribe(g.user['id'])
+        keepalive = app.config['EVENTS_KEEPALIVE_SECONDS']
+
+        def generate():
+            try:
+                yield "retry: 3000\n\n" # Интервал переподключения для EventSource
+                while True:
+                    event = subscription.get(timeout=keepalive)
+                    if event is None:
+                        yield ": keepalive\n\n"
+                    else:
+                        yield format_sse(event)
+            finally:
+                # Клиент отключился - освобождаем подписку
+                event_broker.unsubscribe(subscription)
+
+        return Response(generate(), mimetype='text/event-stream', headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no' # Отключаем буферизацию в nginx
+        })
+
     @app.route('/api/messages/<int:message_id>', methods=['DELETE'])
     @login_required
     def delete_message(message_id):
         user_id = g.user['id']
-        db = get_db()
+        db = get_read_db()
         cursor = db.cursor()
 
         try:
@@ -1548,43 +2890,59 @@ def create_app():
                 can_delete = True # Отправитель может удалить своё сообщение
             else:
                 # Проверяем, является ли пользователь админом группы или владельцем канала
-                cursor.execute("SELECT type, owner_id FROM chats WHERE id = ?", (chat_id,))
-                chat_details = cursor.fetchone()
-                chat_type = chat_details['type']
-                owner_id = chat_details['owner_id']
-                
-                if chat_type == 'group':
-                    cursor.execute(
-                        "SELECT role FROM group_members WHERE group_id = ? AND user_id = ?",
-                        (chat_id, user_id)
-                    )
-                    member_role = cursor.fetchone()
-                    if member_role and member_role['role'] == 'admin':
-                        can_delete = True
-                elif chat_type == 'channel':
-                    # Только владелец канала может удалять сообщения
-                    if user_id == owner_id:
-                        can_delete = True
+                access = _get_chat_access(cursor, chat_id, user_id)
+                can_delete = bool(access and access['can_delete_any'])
 
             if not can_delete:
                 return jsonify({'error': 'У вас нет прав на удаление этого сообщения.'}), 403
 
             # Выполняем мягкое удаление сообщения
             # Обнуляем content, file_url, file_name, file_size при удалении
-            cursor.execute(
-                "UPDATE messages SET is_deleted = TRUE, deleted_by = ?, content = NULL, file_url = NULL, file_name = NULL, file_size = NULL WHERE id = ?",
-                (user_id, message_id)
-            )
-            db.commit()
+            with write_transaction() as writer:
+                writer.execute(
+                    "UPDATE messages SET is_deleted = TRUE, deleted_by = ?, content = NULL, file_url = NULL, file_name = NULL, file_size = NULL, file_sha256 = NULL WHERE id = ?",
+                    (user_id, message_id)
+                )
+            _publish_message_event(cursor, chat_id, message_id, 'message_deleted')
 
             return jsonify({'message': 'Сообщение успешно удалено.'}), 200
         except Exception as e:
-            db.rollback()
             print(f"Ошибка при удалении сообщения: {e}")
             return jsonify({'error': 'Внутренняя ошибка сервера'}), 500
         finally:
             cursor.close()
 
+    # --- Сборка мусора загрузок (flask --app app gc-uploads) ---
+    @app.cli.command('gc-uploads')
+    @click.option('--dry-run', is_flag=True, help='Только показать, что будет удалено.')
+    @click.option('--batch-size', type=int, default=None, help='Записей и файлов за один проход (по умолчанию UPLOAD_GC_BATCH_SIZE).')
+    def gc_uploads_command(dry_run, batch_size):
+        """Удаляет загруженные файлы, на которые больше не ссылаются сообщения, и брошенные загрузки."""
+        batch_size = batch_size or app.config['UPLOAD_GC_BATCH_SIZE']
+        grace = app.config['UPLOAD_GC_GRACE_PERIOD']
+        db = get_db()
+        storage = _get_storage()
+        started = time.monotonic()
+        reports = [
+            collect_unreferenced_blobs(db, storage, _get_thumbnails(), grace, batch_size, dry_run),
+            collect_orphan_files(db, storage, _get_thumbnails(), grace, batch_size, dry_run),
+            collect_legacy_files(db, app.config['UPLOAD_FOLDER'], grace, batch_size, dry_run),
+            collect_upload_sessions(db, app.config['UPLOAD_TEMP_FOLDER'], app.config['UPLOAD_SESSION_TTL'],
+                                    grace, batch_size, dry_run),
+        ]
+        elapsed = time.monotonic() - started
+
+        action = 'будет удалено' if dry_run else 'удалено'
+        for report in reports:
+            click.echo(f"{report.title}: проверено {report.scanned}, {action} {report.deleted} "
+                       f"({report.freed_bytes / (1024 * 1024):.1f} МБ)")
+        scanned = sum(report.scanned for report in reports)
+        deleted = sum(report.deleted for report in reports)
+        freed = sum(report.freed_bytes for report in reports)
+        click.echo(f"Итого: проверено {scanned} за {elapsed:.2f} с ({scanned / max(elapsed, 1e-6):.0f} объектов/с), "
+                   f"{action} {deleted}, освобождено {freed / (1024 * 1024):.1f} МБ"
+                   + (" (пробный запуск, ничего не удалено)" if dry_run else ""))
+
     return app
 
 if __name__ == '__main__':
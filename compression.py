@@ -0,0 +1,53 @@
+import zlib
+
+try:
+    import brotli # Необязательная зависимость: сжатие Brotli
+except ImportError:
+    brotli = None
+
+# Кодировки в порядке предпочтения сервера
+SUPPORTED_ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def choose_encoding(accept_encodings):
+    """Выбирает кодировку по заголовку Accept-Encoding (request.accept_encodings) или None."""
+    return accept_encodings.best_match(SUPPORTED_ENCODINGS)
+
+
+def etag_variants(etag):
+    """
+    ETag сжатого представления отличается суффиксом кодировки.
+    Возвращает все варианты ETag, которые мог получить клиент.
+    """
+    return (etag,) + tuple(f'{etag}-{encoding}' for encoding in SUPPORTED_ENCODINGS)
+
+
+def _compressor(encoding, level):
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=level['br'])
+        return compressor.process, compressor.finish
+    compressor = zlib.compressobj(level['gzip'], zlib.DEFLATED, 31) # wbits=31: формат gzip
+    return compressor.compress, compressor.flush
+
+
+def compress_body(data, encoding, level):
+    """Сжимает тело ответа целиком."""
+    compress, finish = _compressor(encoding, level)
+    return compress(data) + finish()
+
+
+def compress_stream(chunks, encoding, level):
+    """Сжимает потоковый ответ по мере генерации, не собирая его в памяти."""
+    compress, finish = _compressor(encoding, level)
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            compressed = compress(chunk)
+            if compressed:
+                yield compressed
+        yield finish()
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close() # Закрываем исходный генератор (курсор БД, контекст запроса)
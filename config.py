@@ -3,9 +3,101 @@ import os
 class Config:
     BASE_DIR = os.path.abspath(os.path.dirname(__file__))
     DATABASE = os.getenv('DATABASE_PATH', os.path.join(BASE_DIR, 'messenger.db'))
+    # Пул соединений с SQLite (database.ConnectionPool)
+    DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 8)) # Сколько простаивающих соединений-читателей держать открытыми
+    DB_READ_ONLY_GET = True # GET/HEAD запросы используют соединения только для чтения
+    DB_WRITER_CONNECTIONS = 1 # Пишущие запросы процесса выполняются по очереди через одно соединение
+    DB_WRITER_TIMEOUT = 30 # Секунды ожидания свободного соединения-писателя
+    DB_STATEMENT_CACHE_SIZE = 256 # Кеш подготовленных выражений на одно соединение
+    DB_JOURNAL_MODE = os.getenv('DB_JOURNAL_MODE', 'WAL')
+    DB_BUSY_TIMEOUT_MS = 5000 # Сколько ждать освобождения блокировки записи
+    DB_SYNCHRONOUS = 'NORMAL' # В режиме WAL безопасно и заметно быстрее FULL
+    # Групповой коммит сообщений (database.BatchWriter): INSERT из параллельных send_message
+    # собираются в одну транзакцию раз в DB_WRITE_BATCH_WINDOW_MS
+    DB_WRITE_BATCHING = os.getenv('DB_WRITE_BATCHING', '0').lower() in ('1', 'true', 'yes')
+    DB_WRITE_BATCH_WINDOW_MS = 5
+    DB_WRITE_BATCH_MAX = 256 # Максимум записей в одной транзакции
     SECRET_KEY = os.getenv('SECRET_KEY', 'your_super_secret_key_change_me')
     
     # Добавляем настройку для загрузки файлов
     UPLOAD_FOLDER = os.path.join(BASE_DIR, 'uploads')
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024 # Максимальный размер файла: 16 МБ
-    ALLOWED_EXTENSIONS = {'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif', 'zip', 'mp3', 'mp4'}
\ No newline at end of file
+    ALLOWED_EXTENSIONS = {'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif', 'zip', 'mp3', 'mp4'}
+
+    # Пагинация сообщений (GET /api/chats/<id>/messages)
+    MESSAGES_PAGE_SIZE = 50 # Размер страницы по умолчанию
+    MESSAGES_MAX_PAGE_SIZE = 200 # Максимально допустимый limit
+
+    # Push-доставка событий (GET /api/events, Server-Sent Events)
+    EVENTS_QUEUE_SIZE = 100 # Максимум неотправленных событий на одно подключение
+    EVENTS_KEEPALIVE_SECONDS = 15 # Интервал keepalive-комментариев
+    LONG_POLL_MAX_WAIT_SECONDS = 30 # Максимальное время удержания long polling запроса
+
+    # Кеш прав доступа к чатам (user_id, chat_id) -> тип чата, роль, права
+    CHAT_ACCESS_CACHE_SIZE = 10000 # Максимальное число записей
+    CHAT_ACCESS_CACHE_TTL = 60 # Секунды; ограничивает устаревание при нескольких worker-процессах
+
+    # Кеш пользователя текущей сессии (load_logged_in_user)
+    USER_CACHE_SIZE = 10000
+    USER_CACHE_TTL = 30 # Секунды
+
+    # Список чатов (GET /api/chats)
+    CHAT_LIST_PREVIEW_LENGTH = 100 # Сколько символов последнего сообщения отдавать в превью
+
+    # Поиск пользователей (GET /api/users/search)
+    USER_SEARCH_PAGE_SIZE = 10
+    USER_SEARCH_MAX_PAGE_SIZE = 50
+
+    # Список пользователей (GET /api/users)
+    USERS_PAGE_SIZE = 100
+    USERS_MAX_PAGE_SIZE = 500
+
+    # Потоковая отдача больших JSON-ответов (сообщения, пользователи, участники чата).
+    # При выключении ответ собирается целиком перед отправкой.
+    JSON_STREAMING = os.getenv('JSON_STREAMING', '1').lower() in ('1', 'true', 'yes')
+    JSON_STREAM_CHUNK_SIZE = 64 * 1024
+
+    # Сжатие JSON-ответов по Accept-Encoding (gzip; brotli, если установлен модуль brotli)
+    COMPRESSION_ENABLED = os.getenv('COMPRESSION_ENABLED', '1').lower() in ('1', 'true', 'yes')
+    COMPRESSION_MIN_SIZE = 1024 # Меньшие ответы отдаются без сжатия
+    COMPRESSION_GZIP_LEVEL = 6
+    COMPRESSION_BROTLI_QUALITY = 5
+
+    # Возобновляемая загрузка файлов (POST /api/chats/<id>/uploads, PUT /api/uploads/<id>)
+    UPLOAD_TEMP_FOLDER = os.path.join(BASE_DIR, 'uploads_tmp') # Недокачанные файлы, вне UPLOAD_FOLDER
+    UPLOAD_MAX_FILE_SIZE = 2 * 1024 * 1024 * 1024 # 2 ГБ; ограничение MAX_CONTENT_LENGTH действует на одну часть
+    UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024 # Рекомендуемый размер части (должен быть меньше MAX_CONTENT_LENGTH)
+    UPLOAD_CLAIM_TIMEOUT = 300 # Секунды, после которых зависшую запись части можно перехватить
+
+    # Отдача загруженных файлов (GET /uploads/<filename>). Имена файлов неизменяемы (SHA-256/uuid),
+    # поэтому браузер и прокси могут кэшировать их надолго.
+    UPLOAD_CACHE_MAX_AGE = 365 * 24 * 3600 # Секунды
+    # Передача файла фронт-прокси вместо Python-процесса:
+    # '' - отдает Flask; 'x-sendfile' - Apache (mod_xsendfile), lighttpd; 'x-accel' - nginx (X-Accel-Redirect)
+    FILE_OFFLOAD = os.getenv('FILE_OFFLOAD', '').lower()
+    FILE_OFFLOAD_PREFIX = os.getenv('FILE_OFFLOAD_PREFIX', '/_uploads/') # internal location nginx для 'x-accel'
+
+    # Миниатюры изображений (нужен Pillow). Строятся в пуле процессов после загрузки,
+    # хранятся на диске по SHA-256 исходного файла и отдаются через GET /thumbnails/<sha256>.jpg
+    THUMBNAILS_ENABLED = os.getenv('THUMBNAILS_ENABLED', '1').lower() in ('1', 'true', 'yes')
+    THUMBNAIL_FOLDER = os.path.join(BASE_DIR, 'thumbnails')
+    THUMBNAIL_SIZE = 320 # Наибольшая сторона миниатюры, пиксели
+    THUMBNAIL_QUALITY = 80 # Качество JPEG
+    THUMBNAIL_WORKERS = int(os.getenv('THUMBNAIL_WORKERS', '2')) # Процессов в пуле
+
+    # Хранилище загруженных файлов: 'local' - UPLOAD_FOLDER с раскладкой по каталогам-шардам
+    # (ab/cd/<sha256>), 's3' - S3-совместимое хранилище (нужен boto3; MinIO и т.п. через S3_ENDPOINT_URL)
+    STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'local').lower()
+    STORAGE_SHARD_DEPTH = 2 # Уровней каталогов по 2 hex-символа префикса
+    S3_BUCKET = os.getenv('S3_BUCKET')
+    S3_PREFIX = os.getenv('S3_PREFIX', 'uploads/')
+    S3_ENDPOINT_URL = os.getenv('S3_ENDPOINT_URL')
+    S3_REGION = os.getenv('S3_REGION')
+    S3_ACCESS_KEY_ID = os.getenv('S3_ACCESS_KEY_ID')
+    S3_SECRET_ACCESS_KEY = os.getenv('S3_SECRET_ACCESS_KEY')
+    S3_URL_EXPIRES = 3600 # Срок действия подписанной ссылки на файл, секунды
+
+    # Сборка мусора загрузок (flask --app app gc-uploads)
+    UPLOAD_GC_GRACE_PERIOD = 3600 # Секунды: более новые файлы без ссылок не трогаем (загрузка может еще завершаться)
+    UPLOAD_GC_BATCH_SIZE = 500 # Записей и файлов за один проход; транзакция - на пачку
+    UPLOAD_SESSION_TTL = 7 * 24 * 3600 # Секунды без новых частей, после которых загрузка считается брошенной
\ No newline at end of file
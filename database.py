@@ -1,38 +1,354 @@
 import sqlite3
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
 from sqlite3 import Error
-from flask import current_app, g
+from flask import current_app, g, has_request_context, request
 import click
 from flask.cli import with_appcontext
 
-def get_db():
+# HTTP-методы, которые обслуживаются соединениями только для чтения
+READ_ONLY_METHODS = ('GET', 'HEAD')
+
+def fold_search_text(value):
+    """
+    Текст для поиска пользователей (SQL-функция search_fold(x)): приведение регистра
+    с поддержкой Unicode и "ё" как "е", чтобы "петр" находил "Пётр".
     """
-    Устанавливает соединение с базой данных, если его еще нет в объекте g.
+    return value.casefold().replace('ё', 'е') if isinstance(value, str) else value
+
+class ConnectionPool:
+    """
+    Пул постоянных соединений с SQLite.
+    Соединение выдается запросу в get_db и возвращается в пул в close_db,
+    поэтому подключение и PRAGMA выполняются один раз на соединение, а не на каждый запрос.
+    Каждое соединение в один момент времени используется только одним запросом.
+
+    readonly=True открывает соединения в режиме mode=ro (роль читателя).
+    max_open ограничивает число одновременно выданных соединений: пул писателя
+    с max_open=1 выстраивает пишущие запросы процесса в очередь вместо
+    конкуренции за блокировку SQLite.
     """
-    if 'db' not in g:
-        db_path = current_app.config['DATABASE']
+
+    def __init__(self, db_path, max_idle=8, statement_cache_size=256,
+                 journal_mode='WAL', busy_timeout_ms=5000, synchronous='NORMAL',
+                 readonly=False, max_open=None, acquire_timeout=None):
+        self.db_path = db_path
+        self.statement_cache_size = statement_cache_size
+        self.journal_mode = journal_mode
+        self.busy_timeout_ms = busy_timeout_ms
+        self.synchronous = synchronous
+        self.readonly = readonly
+        self.acquire_timeout = acquire_timeout
+        self._slots = threading.BoundedSemaphore(max_open) if max_open else None
+        self._idle = queue.LifoQueue(maxsize=max_idle) # LIFO: чаще используем "теплые" соединения
+
+    def _connect(self):
+        if self.readonly:
+            database, uri = Path(self.db_path).resolve().as_uri() + '?mode=ro', True
+        else:
+            database, uri = self.db_path, False
+        conn = sqlite3.connect(
+            database,
+            uri=uri,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            check_same_thread=False, # Соединение может вернуться в пул из другого потока
+            cached_statements=self.statement_cache_size # Кеш подготовленных выражений
+        )
+        # Устанавливаем режим возврата строк в виде объектов Row (доступ по имени столбца)
+        conn.row_factory = sqlite3.Row
+        # PRAGMA применяются один раз при создании соединения
+        conn.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout_ms)}")
+        if self.journal_mode and not self.readonly: # Режим журнала меняет только писатель
+            conn.execute(f"PRAGMA journal_mode = {self.journal_mode}")
+        if self.synchronous:
+            conn.execute(f"PRAGMA synchronous = {self.synchronous}")
+        conn.execute("PRAGMA foreign_keys = ON") # Нужно для ON DELETE CASCADE/SET NULL из schema.sql
+        # Встроенная lower() SQLite работает только с ASCII; search_fold() вычисляет
+        # столбцы users.*_folded (нужна при записи в users, не при чтении)
+        conn.create_function('search_fold', 1, fold_search_text, deterministic=True)
+        return conn
+
+    def acquire(self):
+        if self._slots is not None and not self._slots.acquire(timeout=self.acquire_timeout):
+            raise sqlite3.OperationalError('Не удалось дождаться свободного соединения с базой данных.')
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            try:
+                return self._connect()
+            except Exception:
+                if self._slots is not None:
+                    self._slots.release()
+                raise
+
+    def release(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback() # Не оставляем незавершенных транзакций следующему запросу
+            self._idle.put_nowait(conn)
+        except (queue.Full, Error):
+            conn.close()
+        finally:
+            if self._slots is not None:
+                self._slots.release()
+
+    def close_all(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+def _get_pools(app):
+    """Возвращает пулы {'reader': ..., 'writer': ...} для текущей базы данных приложения."""
+    pools = app.extensions.get('db_pools')
+    if pools is None or pools['writer'].db_path != app.config['DATABASE']:
+        if pools is not None:
+            for pool in pools.values():
+                pool.close_all()
+        common = dict(
+            statement_cache_size=app.config['DB_STATEMENT_CACHE_SIZE'],
+            journal_mode=app.config['DB_JOURNAL_MODE'],
+            busy_timeout_ms=app.config['DB_BUSY_TIMEOUT_MS'],
+            synchronous=app.config['DB_SYNCHRONOUS']
+        )
+        pools = {
+            'reader': ConnectionPool(app.config['DATABASE'], max_idle=app.config['DB_POOL_SIZE'],
+                                     readonly=True, **common),
+            'writer': ConnectionPool(app.config['DATABASE'], max_idle=app.config['DB_WRITER_CONNECTIONS'],
+                                     max_open=app.config['DB_WRITER_CONNECTIONS'],
+                                     acquire_timeout=app.config['DB_WRITER_TIMEOUT'], **common)
+        }
+        app.extensions['db_pools'] = pools
+    return pools
+
+def _connection_role():
+    """GET/HEAD запросы читают через соединения только для чтения, остальные - через писателя."""
+    if (current_app.config['DB_READ_ONLY_GET'] and has_request_context()
+            and request.method in READ_ONLY_METHODS):
+        return 'reader'
+    return 'writer'
+
+def _get_connection(role):
+    """Берет соединение роли role из пула, если его еще нет в объекте g."""
+    connections = g.setdefault('db_connections', {})
+    if role not in connections:
         try:
-            g.db = sqlite3.connect(
-                db_path,
-                detect_types=sqlite3.PARSE_DECLTYPES
-            )
-            # Устанавливаем режим возврата строк в виде объектов Row (доступ по имени столбца)
-            g.db.row_factory = sqlite3.Row
-            print(f"Подключение к SQLite успешно установлено: {db_path}")
+            connections[role] = _get_pools(current_app)[role].acquire()
         except Error as e:
             print(f"Ошибка при подключении к SQLite: {e}")
             raise # Передаем ошибку выше
+    return connections[role]
+
+def get_db():
+    """
+    Возвращает соединение для текущего запроса: читателя для GET/HEAD, иначе писателя.
+    """
+    return _get_connection(_connection_role())
 
-    return g.db
+def get_read_db():
+    """
+    Возвращает соединение только для чтения независимо от HTTP-метода.
+    Нужно пишущим запросам, которые читают данные, но не должны занимать писателя.
+    """
+    return _get_connection('reader')
 
 def close_db(e=None):
     """
-    Закрывает соединение с базой данных в конце запроса.
+    Возвращает соединения в пул в конце запроса.
     """
-    db = g.pop('db', None)
+    connections = g.pop('db_connections', None)
+
+    if connections:
+        pools = _get_pools(current_app)
+        for role, db in connections.items():
+            pools[role].release(db)
 
-    if db is not None:
-        db.close()
-        print("Соединение с SQLite закрыто.")
+def release_writer():
+    """
+    Возвращает соединение-писатель в пул до конца запроса (если запрос его брал).
+    Соединение-читатель остается у запроса; следующий get_db() возьмет писателя заново.
+    """
+    connections = g.get('db_connections')
+    if connections and 'writer' in connections:
+        _get_pools(current_app)['writer'].release(connections.pop('writer'))
+
+@contextmanager
+def write_transaction():
+    """
+    Соединение-писатель на время одной транзакции записи.
+    При выходе из блока транзакция фиксируется (при исключении - откатывается),
+    и писатель сразу возвращается в пул: проверки прав, хеширование паролей
+    и прочая работа запроса выполняются без него.
+    """
+    db = _get_connection('writer')
+    try:
+        yield db
+        db.commit()
+    except BaseException:
+        db.rollback()
+        raise
+    finally:
+        release_writer()
+
+class _PendingWrite:
+    def __init__(self, sql, params, callback=None):
+        self.sql = sql
+        self.params = params
+        self.callback = callback
+        self.lastrowid = None
+        self.rows = []
+        self.error = None
+        self.done = threading.Event()
+        self._state = 'queued' # queued -> claimed (выполняется в пачке) или cancelled (истекло ожидание)
+        self._state_lock = threading.Lock()
+
+    def claim(self):
+        """Вызывается фоновым потоком перед выполнением. False, если запрос уже отказался от записи."""
+        with self._state_lock:
+            if self._state == 'cancelled':
+                return False
+            self._state = 'claimed'
+            return True
+
+    def cancel(self):
+        """Снимает запись с очереди. False, если она уже выполняется и будет закоммичена или отменена пачкой."""
+        with self._state_lock:
+            if self._state != 'queued':
+                return False
+            self._state = 'cancelled'
+            return True
+
+class BatchWriter:
+    """
+    Очередь отложенной записи с групповым коммитом.
+    Запросы ставят INSERT в очередь и ждут результата; фоновый поток собирает
+    все INSERT, пришедшие за window_ms, и выполняет их одной транзакцией
+    (один fsync на пачку вместо одного на сообщение). Каждая запись выполняется
+    в своем SAVEPOINT, поэтому ошибка одной записи не отменяет остальные.
+    """
+
+    def __init__(self, connect, window_ms=5, max_batch=256):
+        self._connect = connect
+        self.window = window_ms / 1000.0
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def execute(self, sql, params, timeout=None):
+        """Выполняет запись в ближайшей пачке и возвращает lastrowid."""
+        self._ensure_started()
+        item = _PendingWrite(sql, params)
+        self._queue.put(item)
+        if not item.done.wait(timeout):
+            # Ошибку можно вернуть, только если запись точно не выполнится: иначе повтор
+            # запроса клиентом создаст дубликат. Взятую в пачку запись дожидаемся до конца.
+            if item.cancel():
+                raise sqlite3.OperationalError('Истекло время ожидания пакетной записи.')
+            item.done.wait()
+        if item.error is not None:
+            raise item.error
+        return item.lastrowid
+
+    def submit(self, sql, params, callback=None):
+        """
+        Ставит запись в ближайшую пачку и не ждет ее выполнения.
+        callback(rows, error) вызывается фоновым потоком после фиксации пачки;
+        rows - строки RETURNING.
+        """
+        self._ensure_started()
+        self._queue.put(_PendingWrite(sql, params, callback))
+
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='sqlite-batch-writer', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        conn = self._connect()
+        conn.isolation_level = None # Транзакциями управляем вручную
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._flush(conn, batch)
+
+    def _flush(self, conn, batch):
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for item in batch:
+                if not item.claim():
+                    continue
+                conn.execute("SAVEPOINT batch_item")
+                try:
+                    cursor = conn.execute(item.sql, item.params)
+                    item.rows = cursor.fetchall()
+                    item.lastrowid = cursor.lastrowid
+                except Error as e:
+                    conn.execute("ROLLBACK TO batch_item")
+                    item.error = e
+                conn.execute("RELEASE batch_item")
+            conn.execute("COMMIT")
+        except Error as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            for item in batch:
+                if item.error is None:
+                    item.lastrowid, item.rows, item.error = None, [], e
+        finally:
+            for item in batch:
+                item.done.set()
+            for item in batch:
+                if item.callback is not None:
+                    try:
+                        item.callback(item.rows, item.error)
+                    except Exception as e:
+                        print(f"Ошибка в обработчике пакетной записи: {e}")
+
+def _get_app_batch_writer(app, name):
+    """BatchWriter приложения, сохраненный в app.extensions[name] (создается при первом обращении)."""
+    writer = app.extensions.get(name)
+    if writer is None or writer.db_path != app.config['DATABASE']:
+        # Отдельное соединение-писатель вне пула, со всеми PRAGMA пула писателя
+        writer_pool = _get_pools(app)['writer']
+        writer = BatchWriter(writer_pool._connect,
+                             window_ms=app.config['DB_WRITE_BATCH_WINDOW_MS'],
+                             max_batch=app.config['DB_WRITE_BATCH_MAX'])
+        writer.db_path = app.config['DATABASE']
+        app.extensions[name] = writer
+    return writer
+
+def get_batch_writer():
+    """Возвращает пакетного писателя приложения или None, если групповой коммит выключен."""
+    app = current_app._get_current_object()
+    if not app.config['DB_WRITE_BATCHING']:
+        return None
+    return _get_app_batch_writer(app, 'db_batch_writer')
+
+def get_background_writer():
+    """
+    Писатель для записей вне запросов (например, из служебных потоков пулов): BatchWriter.submit
+    ставит запись в очередь его потока, и вызывающий поток не ждет соединение-писатель.
+    При включенном групповом коммите это общий пакетный писатель.
+    """
+    app = current_app._get_current_object()
+    if app.config['DB_WRITE_BATCHING']:
+        return _get_app_batch_writer(app, 'db_batch_writer')
+    return _get_app_batch_writer(app, 'db_background_writer')
 
 def init_db():
     """
@@ -4,14 +4,113 @@ from PyQt6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, QH
                              QListWidget, QTextEdit, QLineEdit, QPushButton, QLabel,
                              QDialog, QFormLayout, QMessageBox, QFileDialog, QInputDialog, QMenu,
                              QListWidgetItem, QDialogButtonBox)
-from PyQt6.QtCore import Qt, QTimer, QUrl, QPoint
-from PyQt6.QtGui import QDesktopServices, QAction, QTextCursor, QMouseEvent
+from PyQt6.QtCore import Qt, QTimer, QUrl, QPoint, QThread, pyqtSignal
+from PyQt6.QtGui import QDesktopServices, QAction, QTextCursor, QMouseEvent, QTextDocument, QImage
 import os
+import json
 import configparser
+import hashlib
+import queue
+from collections import OrderedDict
 
 CONFIG_FILE = 'client_config.ini'
+CONDITIONAL_CACHE_SIZE = 128 # Сколько ответов с ETag хранить для повторных запросов
+RESUMABLE_UPLOAD_THRESHOLD = 8 * 1024 * 1024 # Файлы больше этого размера загружаются частями с докачкой
+UPLOAD_RETRIES = 5 # Попыток подряд на одну часть при обрывах соединения
+THUMBNAIL_CACHE_SIZE = 200 # Сколько миниатюр изображений держать в памяти
+THUMBNAIL_PLACEHOLDER_SIZE = (160, 120) # Заглушка на месте миниатюры, пока она загружается
+THUMBNAIL_MAX_ATTEMPTS = 6 # Неудачных попыток подряд, после которых миниатюра запрашивается только при перерисовке
+THUMBNAIL_RETRY_MAX_DELAY = 60 # Предельная пауза между повторами загрузки миниатюры, с
+MESSAGE_SYNC_INTERVAL = 3000 # Период синхронизации сообщений без потока событий, мс
+MESSAGE_SYNC_FALLBACK_INTERVAL = 30000 # Контрольная синхронизация при подключенном потоке событий, мс
+
+try:
+    import msgpack # Необязательная зависимость: компактный бинарный формат ответов
+    ACCEPT_MIMETYPES = 'application/msgpack, application/json;q=0.9'
+except ImportError:
+    msgpack = None
+    ACCEPT_MIMETYPES = 'application/json'
+
+try:
+    import brotli # noqa: F401 - если модуль есть, urllib3 сам распакует ответы Brotli
+    ACCEPT_ENCODING = 'br, gzip, deflate'
+except ImportError:
+    ACCEPT_ENCODING = 'gzip, deflate'
 
 class CustomQTextEdit(QTextEdit):
+    def __init__(self, thumbnail_loader=None, parent=None):
+        super().__init__(parent)
+        # ThumbnailLoaderThread для картинок из <img src="http...">: пока миниатюра загружается
+        # в фоне, показывается заглушка, и GUI-поток не ждет сеть
+        self.thumbnail_loader = thumbnail_loader
+        self._images = OrderedDict()
+        self._pending = set() # Запрошены у загрузчика или ждут повтора: перерисовка не запрашивает их снова
+        self._attempts = {} # url -> неудачных попыток подряд (пауза перед повтором растет)
+        self._missing = OrderedDict() # Миниатюры нет на сервере (404): не запрашиваем снова
+        self._placeholder = None
+        if thumbnail_loader is not None:
+            thumbnail_loader.loaded.connect(self._on_thumbnail_loaded)
+            thumbnail_loader.failed.connect(self._on_thumbnail_failed)
+
+    def loadResource(self, resource_type, url):
+        if (self.thumbnail_loader is not None and url.scheme() in ('http', 'https')
+                and resource_type == QTextDocument.ResourceType.ImageResource.value):
+            key = url.toString()
+            image = self._images.get(key)
+            if image is not None:
+                self._images.move_to_end(key)
+                return image
+            if key in self._missing:
+                return None
+            if key not in self._pending:
+                self._pending.add(key)
+                self.thumbnail_loader.request(key)
+            return self._get_placeholder()
+        return super().loadResource(resource_type, url)
+
+    def _get_placeholder(self):
+        if self._placeholder is None:
+            self._placeholder = QImage(*THUMBNAIL_PLACEHOLDER_SIZE, QImage.Format.Format_RGB32)
+            self._placeholder.fill(Qt.GlobalColor.lightGray)
+        return self._placeholder
+
+    def _remember_missing(self, url):
+        self._missing[url] = True
+        if len(self._missing) > THUMBNAIL_CACHE_SIZE:
+            self._missing.popitem(last=False)
+
+    def _on_thumbnail_loaded(self, url, data):
+        self._pending.discard(url)
+        self._attempts.pop(url, None)
+        image = QImage.fromData(data)
+        if image.isNull():
+            self._remember_missing(url)
+            return
+        self._images[url] = image
+        if len(self._images) > THUMBNAIL_CACHE_SIZE:
+            self._images.popitem(last=False)
+        # Документ запомнил заглушку как ресурс этого url: подменяем ее и пересчитываем разметку
+        document = self.document()
+        document.addResource(QTextDocument.ResourceType.ImageResource.value, QUrl(url), image)
+        document.markContentsDirty(0, document.characterCount())
+
+    def _on_thumbnail_failed(self, url, retry_after):
+        if retry_after < 0:
+            self._pending.discard(url)
+            self._attempts.pop(url, None)
+            self._remember_missing(url)
+            return
+        attempts = self._attempts.get(url, 0) + 1
+        if attempts >= THUMBNAIL_MAX_ATTEMPTS:
+            # Сервер долго недоступен: перестаем повторять, следующая перерисовка запросит снова
+            self._pending.discard(url)
+            self._attempts.pop(url, None)
+            return
+        self._attempts[url] = attempts
+        # Пауза не меньше Retry-After и удваивается с каждой неудачей; url остается в _pending
+        delay = min(max(retry_after, 1.0) * 2 ** (attempts - 1), THUMBNAIL_RETRY_MAX_DELAY)
+        QTimer.singleShot(int(delay * 1000), lambda: self.thumbnail_loader.request(url))
+
     def mouseReleaseEvent(self, event: QMouseEvent):
         super().mouseReleaseEvent(event)
 
@@ -25,13 +124,168 @@ class CustomQTextEdit(QTextEdit):
                 return
         event.ignore()
 
+class EventStreamThread(QThread):
+    """
+    Фоновое подключение к потоку Server-Sent Events (/api/events).
+    Полученные события передаются в GUI-поток через сигнал event_received.
+    """
+    event_received = pyqtSignal(str, dict)
+    connection_changed = pyqtSignal(bool)
+
+    def __init__(self, api_client, parent=None):
+        super().__init__(parent)
+        self.api_client = api_client
+        self._running = True
+        self._response = None
+
+    def stop(self):
+        self._running = False
+        if self._response is not None:
+            self._response.close()
+
+    def run(self):
+        while self._running:
+            try:
+                # Отдельная сессия: requests.Session не рассчитана на использование из нескольких потоков
+                session = requests.Session()
+                session.cookies.update(self.api_client.session.cookies)
+                self._response = session.get(f"{self.api_client.BASE_URL}/api/events", stream=True, timeout=(5, 60))
+                if self._response.status_code != 200:
+                    raise requests.exceptions.RequestException(f"статус {self._response.status_code}")
+                self.connection_changed.emit(True)
+
+                event_name, data_lines = None, []
+                for line in self._response.iter_lines(decode_unicode=True):
+                    if not self._running:
+                        break
+                    if line.startswith('event:'):
+                        event_name = line[len('event:'):].strip()
+                    elif line.startswith('data:'):
+                        data_lines.append(line[len('data:'):].strip())
+                    elif line == '' and event_name:
+                        try:
+                            data = json.loads('\n'.join(data_lines)) if data_lines else {}
+                        except json.JSONDecodeError:
+                            data = {}
+                        self.event_received.emit(event_name, data)
+                        event_name, data_lines = None, []
+            except (requests.exceptions.RequestException, AttributeError) as e:
+                if self._running:
+                    print(f"Поток событий недоступен: {e}")
+            finally:
+                self._response = None
+            if self._running:
+                self.connection_changed.emit(False)
+                self.msleep(3000) # Пауза перед переподключением
+
+class ThumbnailLoaderThread(QThread):
+    """
+    Фоновая загрузка миниатюр изображений по очереди запрошенных url.
+    Результат передается в GUI-поток сигналами: loaded(url, данные) или
+    failed(url, пауза перед повтором в секундах; -1, если миниатюры нет и повторять не нужно).
+    """
+    loaded = pyqtSignal(str, bytes)
+    failed = pyqtSignal(str, float)
+
+    def __init__(self, api_client, parent=None):
+        super().__init__(parent)
+        self.api_client = api_client
+        self._queue = queue.Queue()
+
+    def request(self, url):
+        self._queue.put(url)
+
+    def stop(self):
+        self._queue.put(None)
+
+    def run(self):
+        # Отдельная сессия: requests.Session не рассчитана на использование из нескольких потоков
+        session = requests.Session()
+        while True:
+            url = self._queue.get()
+            if url is None:
+                break
+            session.cookies.update(self.api_client.session.cookies)
+            try:
+                response = session.get(url, timeout=10)
+            except requests.exceptions.RequestException as e:
+                print(f"Ошибка загрузки миниатюры {url}: {e}")
+                self.failed.emit(url, 0.0)
+                continue
+            if response.status_code == 200:
+                self.loaded.emit(url, response.content)
+            elif response.status_code == 202 or response.status_code >= 500:
+                # 202: миниатюра строится на сервере, повторить через Retry-After
+                try:
+                    retry_after = float(response.headers.get('Retry-After', 1))
+                except ValueError:
+                    retry_after = 1.0
+                self.failed.emit(url, retry_after)
+            else:
+                self.failed.emit(url, -1.0)
+
 class ApiClient:
     BASE_URL = ""
 
     def __init__(self):
         self.session = requests.Session()
+        # Сервер сжимает большие JSON-ответы; requests распаковывает их прозрачно
+        self.session.headers['Accept-Encoding'] = ACCEPT_ENCODING
+        # Если установлен msgpack, сервер отдает сообщения, чаты, пользователей и поиск в MessagePack
+        self.session.headers['Accept'] = ACCEPT_MIMETYPES
         self.user_id = None
         self.auth_token = None
+        self.last_messages_revision = 0
+        self.last_messages_has_more = False # Есть ли сообщения дальше в направлении последнего запроса страницы
+        self._conditional_cache = OrderedDict() # (url, параметры) -> последний ответ 200 с ETag
+        self.user_profiles = {} # "<user_id>" -> {display_name, avatar_url}, общий для всех чатов
+
+    def _conditional_get(self, url, params=None, **kwargs):
+        """
+        GET с автоматической отправкой If-None-Match.
+        Если сервер ответил 304 Not Modified, возвращается сохраненный ранее ответ 200,
+        поэтому вызывающему коду не нужно отличать 304 от обычного ответа.
+        """
+        cache_key = (url, tuple(sorted((params or {}).items())))
+        cached = self._conditional_cache.get(cache_key)
+        headers = kwargs.pop('headers', {})
+        if cached is not None:
+            headers['If-None-Match'] = cached.headers['ETag']
+        response = self.session.get(url, params=params, headers=headers, **kwargs)
+        if response.status_code == 304 and cached is not None:
+            self._conditional_cache.move_to_end(cache_key)
+            return cached
+        if response.status_code == 200 and response.headers.get('ETag'):
+            self._conditional_cache[cache_key] = response
+            self._conditional_cache.move_to_end(cache_key)
+            while len(self._conditional_cache) > CONDITIONAL_CACHE_SIZE:
+                self._conditional_cache.popitem(last=False)
+        return response
+
+    def _decode(self, response):
+        """
+        Разбирает тело ответа по Content-Type: MessagePack или JSON.
+        Ошибки разбора обоих форматов - подклассы ValueError.
+        """
+        content_type = response.headers.get('Content-Type', '')
+        if msgpack is not None and 'msgpack' in content_type:
+            return msgpack.unpackb(response.content, raw=False)
+        return response.json()
+
+    def _expand_compact_messages(self, data):
+        """
+        Сообщения в компактном формате содержат только sender_id, а профили
+        отправителей приходят картой users. Запоминаем профили (они общие для всех чатов)
+        и заполняем sender_display_name/sender_avatar_url, как в полном формате.
+        """
+        self.user_profiles.update(data.get('users') or {})
+        for message in data.get('messages', []):
+            if 'sender_display_name' in message:
+                continue
+            profile = self.user_profiles.get(str(message.get('sender_id')))
+            message['sender_display_name'] = profile['display_name'] if profile else 'Удаленный пользователь'
+            message['sender_avatar_url'] = profile.get('avatar_url') if profile else None
+        return data
 
     def set_base_url(self, address, port):
         self.BASE_URL = f"http://{address}:{port}"
@@ -53,6 +307,7 @@ class ApiClient:
         response = self.session.post(url, json=data)
         if response.status_code == 200:
             self.user_id = response.json()['user']['id']
+            self._conditional_cache.clear()
         return response
 
     def logout(self):
@@ -61,19 +316,34 @@ class ApiClient:
         if response.status_code == 200:
             self.user_id = None
             self.auth_token = None
+            self._conditional_cache.clear() # Сохраненные ответы относятся к прежнему пользователю
         return response
 
-    def get_users(self):
+    def get_users_page(self, query=None, after_id=None, limit=None):
+        """
+        Возвращает (пользователи, курсор следующей страницы) без текущего пользователя.
+        Фильтрация выполняется на сервере.
+        """
         url = f"{self.BASE_URL}/api/users"
-        response = self.session.get(url)
-        return response.json() if response.status_code == 200 else []
+        params = {"exclude_self": 1}
+        if query:
+            params["query"] = query
+        if after_id:
+            params["after_id"] = after_id
+        if limit:
+            params["limit"] = limit
+        response = self._conditional_get(url, params=params)
+        if response.status_code != 200:
+            print(f"Ошибка при получении пользователей, статус: {response.status_code}, ответ: {response.text}")
+            return [], None
+        return self._decode(response), response.headers.get('X-Next-Cursor')
 
     def get_chats(self):
         url = f"{self.BASE_URL}/api/chats"
-        response = self.session.get(url)
+        response = self._conditional_get(url)
         if response.status_code == 200:
             try:
-                data = response.json()
+                data = self._decode(response)
                 if isinstance(data, dict) and 'chats' in data and isinstance(data['chats'], list):
                     return data['chats']
                 elif isinstance(data, list):
@@ -81,7 +351,7 @@ class ApiClient:
                 else:
                     print(f"Предупреждение: Сервер вернул неожиданный формат чатов: {data}")
                     return []
-            except requests.exceptions.JSONDecodeError:
+            except ValueError: # JSON или MessagePack
                 print(f"Ошибка декодирования JSON для /api/chats: {response.text}")
                 return []
         else:
@@ -89,26 +359,68 @@ class ApiClient:
             return []
 
 
-    def get_chat_messages(self, chat_id):
+    def get_chat_messages(self, chat_id, before_id=None, after_id=None, limit=None):
         url = f"{self.BASE_URL}/api/chats/{chat_id}/messages"
-        response = self.session.get(url)
+        # Параметры курсорной пагинации; без них сервер вернет последнюю страницу
+        params = {'format': 'compact'}
+        if before_id is not None:
+            params['before_id'] = before_id
+        if after_id is not None:
+            params['after_id'] = after_id
+        if limit is not None:
+            params['limit'] = limit
+        response = self._conditional_get(url, params=params)
         if response.status_code == 200:
             try:
-                data = response.json()
+                data = self._decode(response)
                 if isinstance(data, dict) and 'messages' in data and isinstance(data['messages'], list):
+                    self._expand_compact_messages(data)
+                    # Ревизия чата на момент загрузки - с нее начинается инкрементальная синхронизация
+                    self.last_messages_revision = data.get('revision', 0)
+                    self.last_messages_has_more = bool((data.get('cursor') or {}).get('has_more'))
                     return data['messages']
                 elif isinstance(data, list):
                     return data
                 else:
                     print(f"Предупреждение: Сервер вернул неожиданный формат сообщений: {data}")
                     return []
-            except requests.exceptions.JSONDecodeError:
+            except ValueError: # JSON или MessagePack
                 print(f"Ошибка декодирования JSON для /api/chats/{chat_id}/messages: {response.text}")
                 return []
         else:
             print(f"Ошибка при получении сообщений для чата {chat_id}, статус: {response.status_code}, ответ: {response.text}")
             return []
 
+    def sync_chat_messages(self, chat_id, since, wait=None):
+        """
+        Запрашивает изменения в чате после ревизии since.
+        С параметром wait сервер держит запрос до wait секунд (long polling).
+        Возвращает None, если изменений нет (204), иначе словарь с messages/revision/has_more.
+        """
+        url = f"{self.BASE_URL}/api/chats/{chat_id}/messages/sync"
+        params = {'since': since, 'format': 'compact'}
+        timeout = None
+        if wait:
+            params['wait'] = wait
+            timeout = wait + 10 # Запас на сетевые задержки
+        response = self.session.get(url, params=params, timeout=timeout)
+        if response.status_code == 204:
+            return None
+        if response.status_code == 200:
+            try:
+                return self._expand_compact_messages(self._decode(response))
+            except ValueError: # JSON или MessagePack
+                print(f"Ошибка декодирования JSON для /api/chats/{chat_id}/messages/sync: {response.text}")
+                return None
+        print(f"Ошибка синхронизации сообщений для чата {chat_id}, статус: {response.status_code}, ответ: {response.text}")
+        return None
+
+    def mark_chat_read(self, chat_id, message_id=None):
+        url = f"{self.BASE_URL}/api/chats/{chat_id}/read"
+        data = {"message_id": message_id} if message_id is not None else {}
+        response = self.session.post(url, json=data)
+        return response
+
     def send_text_message(self, chat_id, content):
         url = f"{self.BASE_URL}/api/chats/{chat_id}/messages"
         data = {"message_type": "text", "content": content}
@@ -118,6 +430,8 @@ class ApiClient:
     def send_file_message(self, chat_id, file_path):
         url = f"{self.BASE_URL}/api/chats/{chat_id}/messages"
         try:
+            if os.path.getsize(file_path) > RESUMABLE_UPLOAD_THRESHOLD:
+                return self.upload_file_resumable(chat_id, file_path)
             with open(file_path, 'rb') as f:
                 files = {'file': (os.path.basename(file_path), f, 'application/octet-stream')}
                 data = {"message_type": "file"}
@@ -127,6 +441,60 @@ class ApiClient:
             QMessageBox.critical(None, "Ошибка", "Файл не найден.")
             return None
 
+    def upload_file_resumable(self, chat_id, file_path):
+        """
+        Загружает большой файл частями (POST /uploads, PUT частей, POST /complete).
+        После обрыва соединения узнает у сервера принятый offset и продолжает с него.
+        Если сервер уже хранит файл с таким SHA-256, сообщение создается без загрузки.
+        Возвращает ответ complete (201 при успехе), ответ с ошибкой или None, если сервер недоступен.
+        """
+        file_size = os.path.getsize(file_path)
+        digest = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+        response = self.session.post(f"{self.BASE_URL}/api/chats/{chat_id}/uploads",
+                                     json={"file_name": os.path.basename(file_path), "file_size": file_size,
+                                           "sha256": digest.hexdigest()})
+        if response.status_code != 201:
+            return response
+        upload = response.json()
+        if upload.get('deduplicated'):
+            return response # Сообщение уже создано сервером
+        upload_url = f"{self.BASE_URL}/api/uploads/{upload['upload_id']}"
+        chunk_size = upload['chunk_size']
+        offset = upload['offset']
+        failures = 0
+
+        with open(file_path, 'rb') as f:
+            while offset < file_size:
+                f.seek(offset)
+                chunk = f.read(chunk_size)
+                try:
+                    response = self.session.put(upload_url, params={"offset": offset}, data=chunk)
+                except requests.exceptions.RequestException as e:
+                    print(f"Обрыв при загрузке части с offset {offset}: {e}")
+                    response = None
+                if response is not None and response.status_code == 200:
+                    offset = response.json()['offset']
+                    failures = 0
+                    continue
+                if response is not None and response.status_code in (403, 404, 413):
+                    return response # Повтор не поможет
+                failures += 1
+                if failures > UPLOAD_RETRIES:
+                    return response
+                # Узнаем, сколько сервер уже принял, и продолжаем с этого места
+                try:
+                    state = self.session.get(upload_url)
+                except requests.exceptions.RequestException:
+                    continue
+                if state.status_code != 200:
+                    return state
+                offset = state.json()['offset']
+
+        return self.session.post(f"{upload_url}/complete")
+
     def get_file_url(self, filename):
         return f"{self.BASE_URL}/uploads/{filename}"
 
@@ -280,17 +648,71 @@ class ChatWindow(QMainWindow):
         self.api_client = api_client
         self.current_chat_id = None
         self.current_chat_type = None
+        self.current_messages = [] # Сообщения текущего чата, отсортированные по id
+        self.current_revision = 0 # Последняя известная ревизия текущего чата
+        self.has_older_messages = False # На сервере есть сообщения раньше current_messages[0]
+        self.loading_older_messages = False
         self.setWindowTitle("Мессенджер")
         self.setGeometry(100, 100, 800, 600)
 
+        # Миниатюры изображений загружаются в фоне (несколько КБ вместо оригинала)
+        self.thumbnail_loader = ThumbnailLoaderThread(self.api_client, self)
+        self.thumbnail_loader.start()
+
         self.init_ui()
         self.load_chats()
 
         self.message_refresh_timer = QTimer(self)
-        self.message_refresh_timer.setInterval(3000)
-        self.message_refresh_timer.timeout.connect(self.load_messages)
+        self.message_refresh_timer.setInterval(MESSAGE_SYNC_INTERVAL)
+        # Таймер запрашивает только изменения (пустой ответ, если их нет).
+        # Пока подключен поток событий, таймер работает реже - на случай потерянных событий.
+        self.message_refresh_timer.timeout.connect(self.sync_messages)
         self.message_refresh_timer.start()
 
+        self.event_stream = EventStreamThread(self.api_client, self)
+        self.event_stream.event_received.connect(self.handle_server_event)
+        self.event_stream.connection_changed.connect(self.on_event_stream_connection_changed)
+        self.event_stream.start()
+
+    def closeEvent(self, event):
+        self.event_stream.stop()
+        self.event_stream.wait(2000)
+        self.thumbnail_loader.stop()
+        self.thumbnail_loader.wait(2000)
+        super().closeEvent(event)
+
+    def on_event_stream_connection_changed(self, connected):
+        if connected:
+            self.message_refresh_timer.setInterval(MESSAGE_SYNC_FALLBACK_INTERVAL)
+            self.sync_messages() # Догружаем то, что могли пропустить до подключения
+        else:
+            self.message_refresh_timer.setInterval(MESSAGE_SYNC_INTERVAL)
+
+    def handle_server_event(self, event_name, data):
+        if event_name == 'resync':
+            self.sync_messages()
+            return
+        if event_name not in ('message_created', 'message_deleted'):
+            return
+        if data.get('chat_id') != self.current_chat_id:
+            return
+
+        # Ревизии чата идут подряд: событие применяется, только если оно следующее.
+        # Более старое уже получено синхронизацией, после пропуска догружаем изменения.
+        revision = data.get('revision') or 0
+        if revision <= self.current_revision:
+            return
+        if revision != self.current_revision + 1:
+            self.sync_messages()
+            return
+
+        by_id = {m.get('id'): m for m in self.current_messages}
+        by_id[data.get('id')] = data
+        self.current_messages = sorted(by_id.values(), key=lambda m: m.get('id') or 0)
+        self.current_revision = revision
+        self.mark_current_chat_read()
+        self.render_messages(self.current_messages)
+
     def init_ui(self):
         self.central_widget = QWidget()
         self.setCentralWidget(self.central_widget)
@@ -327,7 +749,7 @@ class ChatWindow(QMainWindow):
         self.current_chat_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
         self.right_panel_layout.addWidget(self.current_chat_label)
 
-        self.messages_display = CustomQTextEdit()
+        self.messages_display = CustomQTextEdit(thumbnail_loader=self.thumbnail_loader)
         self.messages_display.setReadOnly(True)
         self.messages_display.setHtml("<h1>Добро пожаловать в мессенджер!</h1>")
         self.messages_display.setTextInteractionFlags(
@@ -337,6 +759,8 @@ class ChatWindow(QMainWindow):
         )
         self.messages_display.setContextMenuPolicy(Qt.ContextMenuPolicy.CustomContextMenu)
         self.messages_display.customContextMenuRequested.connect(self.show_message_context_menu)
+        # Прокрутка к началу догружает предыдущую страницу истории
+        self.messages_display.verticalScrollBar().valueChanged.connect(self.on_messages_scrolled)
 
         self.right_panel_layout.addWidget(self.messages_display)
 
@@ -363,17 +787,73 @@ class ChatWindow(QMainWindow):
         menu.addAction("Канал", self.create_channel_dialog)
         menu.exec(self.create_chat_button.mapToGlobal(self.create_chat_button.rect().bottomLeft()))
 
-    def create_private_chat_dialog(self):
-        users = self.api_client.get_users()
-        print(f"Пользователи, полученные от API: {users}") # ДОБАВЛЕННЫЙ ОТЛАДОЧНЫЙ ВЫВОД
+    def _bind_user_search(self, search_input, user_list_widget, data_key, selected=None):
+        """
+        Заполняет список пользователей страницами с сервера.
+        Поиск выполняется на сервере (с задержкой после ввода),
+        следующая страница подгружается при прокрутке до конца списка.
+        В ItemDataRole.UserRole сохраняется поле пользователя data_key.
+        Если передан словарь selected, в нем копится выбор {значение: подпись}:
+        он сохраняется при смене поиска, когда список перезаполняется.
+        """
+        state = {"query": "", "cursor": None, "loading": False}
 
-        # Исключаем текущего пользователя из списка
-        other_users = [user for user in users if user.get('id') != self.api_client.user_id]
+        def load_page(reset):
+            if state["loading"]:
+                return
+            state["loading"] = True
+            try:
+                if reset:
+                    user_list_widget.clear()
+                    state["cursor"] = None
+                users, state["cursor"] = self.api_client.get_users_page(
+                    query=state["query"] or None, after_id=None if reset else state["cursor"])
+                for user in users:
+                    display_name = user.get('display_name', 'Неизвестный пользователь')
+                    value = user.get(data_key)
+                    if value:
+                        item = QListWidgetItem(f"{display_name} (@{user.get('username')})") # Отображаем display_name и username
+                        item.setData(Qt.ItemDataRole.UserRole, value)
+                        user_list_widget.addItem(item)
+                        if selected is not None and value in selected:
+                            item.setSelected(True)
+                    else:
+                        print(f"Предупреждение: Пользователь {display_name} не имеет {data_key}.")
+            finally:
+                state["loading"] = False
+
+        search_timer = QTimer(user_list_widget)
+        search_timer.setSingleShot(True)
+        search_timer.setInterval(300) # Не отправляем запрос на каждое нажатие клавиши
+
+        def on_text_changed(text):
+            state["query"] = text.strip()
+            search_timer.start()
+
+        def on_scroll(value):
+            if state["cursor"] and value >= user_list_widget.verticalScrollBar().maximum():
+                load_page(reset=False)
+
+        def on_selection_changed():
+            if state["loading"]:
+                return # Список перезаполняется: выбор скрытых поиском пользователей сохраняем
+            for index in range(user_list_widget.count()):
+                item = user_list_widget.item(index)
+                value = item.data(Qt.ItemDataRole.UserRole)
+                if item.isSelected():
+                    selected[value] = item.text()
+                else:
+                    selected.pop(value, None)
 
-        if not other_users:
-            QMessageBox.information(self, "Информация", "Нет других пользователей для создания приватного чата.")
-            return
+        search_timer.timeout.connect(lambda: load_page(reset=True))
+        search_input.textChanged.connect(on_text_changed)
+        user_list_widget.verticalScrollBar().valueChanged.connect(on_scroll)
+        if selected is not None:
+            user_list_widget.itemSelectionChanged.connect(on_selection_changed)
+        load_page(reset=True)
+        return user_list_widget.count()
 
+    def create_private_chat_dialog(self):
         user_selection_dialog = QDialog(self)
         user_selection_dialog.setWindowTitle("Выберите пользователя для приватного чата")
         user_selection_layout = QVBoxLayout(user_selection_dialog)
@@ -386,30 +866,10 @@ class ChatWindow(QMainWindow):
         user_list_widget.setSelectionMode(QListWidget.SelectionMode.SingleSelection)
         user_selection_layout.addWidget(user_list_widget)
 
-        # Сохраняем исходный список пользователей для фильтрации
-        # В ItemDataRole.UserRole будем хранить username
-        for user in other_users:
-            display_name = user.get('display_name', 'Неизвестный пользователь')
-            username = user.get('username')
-            if username: # Убедимся, что username доступен
-                item = QListWidgetItem(f"{display_name} (@{username})") # Отображаем display_name и username
-                item.setData(Qt.ItemDataRole.UserRole, username) # Сохраняем username
-                user_list_widget.addItem(item)
-            else:
-                print(f"Предупреждение: Пользователь {display_name} не имеет username.")
-
-        def filter_users(text):
-            text = text.lower()
-            for i in range(user_list_widget.count()):
-                item = user_list_widget.item(i)
-                # Проверяем как по отображаемому имени, так и по username
-                item_text = item.text().lower()
-                if text in item_text:
-                    item.setHidden(False)
-                else:
-                    item.setHidden(True)
-
-        search_input.textChanged.connect(filter_users)
+        # В ItemDataRole.UserRole будем хранить username; текущий пользователь исключается сервером
+        if not self._bind_user_search(search_input, user_list_widget, 'username'):
+            QMessageBox.information(self, "Информация", "Нет других пользователей для создания приватного чата.")
+            return
 
         button_box = QDialogButtonBox(QDialogButtonBox.StandardButton.Ok | QDialogButtonBox.StandardButton.Cancel)
         button_box.accepted.connect(user_selection_dialog.accept)
@@ -441,31 +901,29 @@ class ChatWindow(QMainWindow):
         if not ok or not chat_name:
             return
 
-        users = self.api_client.get_users()
-        other_users = [user for user in users if user['id'] != self.api_client.user_id]
-        
-        member_ids = []
-        member_names = [user['display_name'] for user in other_users]
-        user_map = {user['display_name']: user['id'] for user in other_users}
-
         members_dialog = QDialog(self)
         members_dialog.setWindowTitle("Выберите участников (необязательно)")
         members_layout = QVBoxLayout(members_dialog)
+
+        search_input = QLineEdit()
+        search_input.setPlaceholderText("Поиск пользователей...")
+        members_layout.addWidget(search_input)
         
         member_list_widget = QListWidget()
         member_list_widget.setSelectionMode(QListWidget.SelectionMode.MultiSelection)
-        for name in member_names:
-            member_list_widget.addItem(name)
         members_layout.addWidget(member_list_widget)
 
+        # Пользователи подгружаются страницами с сервера по мере прокрутки и поиска; текущий
+        # пользователь исключается сервером. Выбранные {id: подпись} копятся при смене поиска
+        selected_members = {}
+        self._bind_user_search(search_input, member_list_widget, 'id', selected_members)
+
         ok_button = QPushButton("ОК")
         ok_button.clicked.connect(members_dialog.accept)
         members_layout.addWidget(ok_button)
 
         if members_dialog.exec() == QDialog.DialogCode.Accepted:
-            selected_items = member_list_widget.selectedItems()
-            for item in selected_items:
-                member_ids.append(user_map[item.text()])
+            member_ids = list(selected_members)
             
             # Если не выбраны участники, сервер должен сам добавить создателя.
             # Эта проверка теперь не блокирует создание чата, если других пользователей нет.
@@ -494,11 +952,19 @@ class ChatWindow(QMainWindow):
     def load_chats(self):
         self.chat_list.clear()
         chats = self.api_client.get_chats()
+        # Сервер уже отсортировал чаты по последней активности и посчитал непрочитанные
         for chat in chats:
             if isinstance(chat, dict) and 'id' in chat and 'name' in chat and 'type' in chat:
-                item = QListWidgetItem(chat['name'])
+                unread_count = chat.get('unread_count') or 0
+                item_text = f"{chat['name']} ({unread_count})" if unread_count else chat['name']
+                item = QListWidgetItem(item_text)
                 item.setData(Qt.ItemDataRole.UserRole, chat['id'])
                 item.setData(Qt.ItemDataRole.UserRole + 1, chat['type'])
+                item.setData(Qt.ItemDataRole.UserRole + 2, chat['name'])
+                last_message = chat.get('last_message')
+                if last_message:
+                    preview = last_message.get('content') or last_message.get('file_name') or ''
+                    item.setToolTip(f"{last_message.get('sender_display_name', '')}: {preview}")
                 self.chat_list.addItem(item)
             else:
                 print(f"Предупреждение: Пропущен некорректный элемент чата: {chat}")
@@ -513,15 +979,99 @@ class ChatWindow(QMainWindow):
     def select_chat(self, item):
         self.current_chat_id = item.data(Qt.ItemDataRole.UserRole)
         self.current_chat_type = item.data(Qt.ItemDataRole.UserRole + 1)
-        self.current_chat_label.setText(f"Чат: {item.text()} ({self.current_chat_type})")
+        chat_name = item.data(Qt.ItemDataRole.UserRole + 2) or item.text()
+        self.current_chat_label.setText(f"Чат: {chat_name} ({self.current_chat_type})")
+        item.setText(chat_name) # Сообщения чата открыты - счетчик непрочитанных сбрасывается
         self.load_messages()
 
     def load_messages(self):
         if not self.current_chat_id:
+            self.current_messages = []
             self.messages_display.clear()
             return
 
         messages_data = self.api_client.get_chat_messages(self.current_chat_id)
+        if isinstance(messages_data, list):
+            self.current_messages = messages_data
+            self.current_revision = self.api_client.last_messages_revision
+            self.has_older_messages = self.api_client.last_messages_has_more
+            self.mark_current_chat_read()
+        self.render_messages(messages_data)
+
+    def on_messages_scrolled(self, value):
+        if value == self.messages_display.verticalScrollBar().minimum():
+            self.load_older_messages()
+
+    def load_older_messages(self):
+        """Загружает страницу сообщений перед первым показанным (before_id) и сохраняет позицию прокрутки."""
+        if not self.current_chat_id or not self.current_messages or not self.has_older_messages:
+            return
+        if self.loading_older_messages:
+            return
+
+        chat_id = self.current_chat_id
+        self.loading_older_messages = True
+        try:
+            older = self.api_client.get_chat_messages(chat_id, before_id=self.current_messages[0].get('id'))
+            if chat_id != self.current_chat_id:
+                return
+            self.has_older_messages = bool(older) and self.api_client.last_messages_has_more
+            if not older:
+                return
+            by_id = {m.get('id'): m for m in older}
+            by_id.update((m.get('id'), m) for m in self.current_messages) # Синхронизированные версии новее
+            self.current_messages = sorted(by_id.values(), key=lambda m: m.get('id') or 0)
+
+            # Показываем те же сообщения на том же месте: отступ от конца документа не меняется
+            scroll_bar = self.messages_display.verticalScrollBar()
+            offset_from_end = scroll_bar.maximum() - scroll_bar.value()
+            self.render_messages(self.current_messages)
+            scroll_bar.setValue(scroll_bar.maximum() - offset_from_end)
+        finally:
+            self.loading_older_messages = False
+
+    def mark_current_chat_read(self):
+        """Сдвигает курсор прочтения до последнего показанного сообщения."""
+        if self.current_chat_id and self.current_messages:
+            last_id = self.current_messages[-1].get('id')
+            if last_id:
+                self.api_client.mark_chat_read(self.current_chat_id, last_id)
+
+    def sync_messages(self):
+        """Догружает только изменения текущего чата с момента последней ревизии."""
+        if not self.current_chat_id:
+            return
+
+        chat_id = self.current_chat_id
+        changed = False
+        while True:
+            data = self.api_client.sync_chat_messages(chat_id, self.current_revision)
+            if not data or chat_id != self.current_chat_id:
+                break
+            changes = data.get('messages', [])
+            self.current_revision = data.get('revision', self.current_revision)
+            if changes:
+                changed = True
+                by_id = {m.get('id'): m for m in self.current_messages}
+                for message in changes:
+                    by_id[message.get('id')] = message # Новое сообщение или обновление (удаление)
+                self.current_messages = sorted(by_id.values(), key=lambda m: m.get('id') or 0)
+            if not data.get('has_more'):
+                break
+
+        if changed:
+            self.mark_current_chat_read()
+            self.render_messages(self.current_messages)
+
+    def render_messages(self, messages_data):
+        scroll_bar = self.messages_display.verticalScrollBar()
+        scroll_bar.blockSignals(True) # Перерисовка не считается прокруткой к началу истории
+        try:
+            self._render_messages(messages_data)
+        finally:
+            scroll_bar.blockSignals(False)
+
+    def _render_messages(self, messages_data):
         self.messages_display.clear()
 
         current_user_id = self.api_client.user_id
@@ -571,6 +1121,10 @@ class ChatWindow(QMainWindow):
                 if file_url:
                     full_file_url = self.api_client.get_file_url(file_name)
                     file_info = f"{file_name} ({file_size / (1024*1024):.2f} MB)" if file_size else file_name 
+                    thumbnail_url = message.get('thumbnail_url')
+                    if thumbnail_url:
+                        # Превью изображения; оригинал открывается по клику
+                        msg_html += f"<div class='message-content'><a href='{full_file_url}'><img src='{thumbnail_url}'></a></div>"
                     msg_html += f"<div class='message-content file-content'><a href='{full_file_url}'>{file_info}</a></div>"
                 else:
                     msg_html += f"<div class='message-content file-content'>[Неизвестный файл]</div>"
@@ -637,7 +1191,7 @@ class ChatWindow(QMainWindow):
         block = self.messages_display.document().findBlock(cursor.position())
         line_number = block.blockNumber()
 
-        messages = self.api_client.get_chat_messages(self.current_chat_id)
+        messages = self.current_messages
         
         selected_message = None
         if line_number < len(messages):
@@ -770,7 +1324,7 @@ class ChatWindow(QMainWindow):
         for i in range(self.chat_list.count()):
             item = self.chat_list.item(i)
             if item.data(Qt.ItemDataRole.UserRole) == chat_id_to_leave:
-                chat_name_to_leave = item.text()
+                chat_name_to_leave = item.data(Qt.ItemDataRole.UserRole + 2) or item.text()
                 break # Нашли имя чата, выходим из цикла
         
         if QMessageBox.question(self, "Подтверждение", f"Вы уверены, что хотите покинуть чат '{chat_name_to_leave}'?",
@@ -778,14 +1332,6 @@ class ChatWindow(QMainWindow):
             self._execute_leave_chat(chat_id_to_leave, chat_name_to_leave) # Используем новую вспомогательную функцию
 
     def add_member_to_group_chat_dialog(self, chat_id):
-        users = self.api_client.get_users()
-        # Исключаем текущего пользователя из списка
-        other_users = [user for user in users if user.get('id') != self.api_client.user_id]
-
-        if not other_users:
-            QMessageBox.information(self, "Информация", "Нет других пользователей для добавления.")
-            return
-
         user_selection_dialog = QDialog(self)
         user_selection_dialog.setWindowTitle("Добавить участника в группу")
         user_selection_layout = QVBoxLayout(user_selection_dialog)
@@ -798,32 +1344,12 @@ class ChatWindow(QMainWindow):
         user_list_widget.setSelectionMode(QListWidget.SelectionMode.MultiSelection) # Множественный выбор
         user_selection_layout.addWidget(user_list_widget)
 
-        # Сохраняем исходный список пользователей для фильтрации
-        # В ItemDataRole.UserRole будем хранить user_id
-        for user in other_users:
-            display_name = user.get('display_name', 'Неизвестный пользователь')
-            user_id = user.get('id')
-            username = user.get('username')
-            if user_id:
-                item = QListWidgetItem(f"{display_name} (@{username})") # Отображаем display_name и username
-                item.setData(Qt.ItemDataRole.UserRole, user_id) # Сохраняем user_id
-                user_list_widget.addItem(item)
-            else:
-                print(f"Предупреждение: Пользователь {display_name} не имеет ID.")
-
-
-        def filter_users(text):
-            text = text.lower()
-            for i in range(user_list_widget.count()):
-                item = user_list_widget.item(i)
-                # Проверяем как по отображаемому имени, так и по username
-                item_text = item.text().lower()
-                if text in item_text:
-                    item.setHidden(False)
-                else:
-                    item.setHidden(True)
-
-        search_input.textChanged.connect(filter_users)
+        # В ItemDataRole.UserRole будем хранить user_id; текущий пользователь исключается сервером.
+        # Выбранные {id: подпись} копятся при смене поиска
+        selected_members = {}
+        if not self._bind_user_search(search_input, user_list_widget, 'id', selected_members):
+            QMessageBox.information(self, "Информация", "Нет других пользователей для добавления.")
+            return
 
         button_box = QDialogButtonBox(QDialogButtonBox.StandardButton.Ok | QDialogButtonBox.StandardButton.Cancel)
         button_box.accepted.connect(user_selection_dialog.accept)
@@ -832,9 +1358,7 @@ class ChatWindow(QMainWindow):
 
         selected_user_ids = []
         if user_selection_dialog.exec() == QDialog.DialogCode.Accepted:
-            selected_items = user_list_widget.selectedItems()
-            for item in selected_items:
-                selected_user_ids.append(item.data(Qt.ItemDataRole.UserRole))
+            selected_user_ids = list(selected_members)
 
         if selected_user_ids:
             success_count = 0
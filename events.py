@@ -0,0 +1,141 @@
+import json
+import queue
+import threading
+from collections import OrderedDict
+
+
+class EventSubscription:
+    """
+    Подписка одного подключенного клиента на события.
+    Хранит ограниченную очередь событий; если клиент не успевает их забирать,
+    подписка помечается как переполненная и клиенту отправляется событие 'resync'.
+    """
+
+    def __init__(self, user_id, max_queue_size):
+        self.user_id = user_id
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.overflowed = False
+
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.overflowed = True
+
+    def get(self, timeout):
+        """Возвращает следующее событие или None, если за timeout секунд событий не было."""
+        if self.overflowed:
+            self.overflowed = False
+            # Очередь переполнена - часть событий потеряна, клиент должен пересинхронизироваться
+            with self.queue.mutex:
+                self.queue.queue.clear()
+            return {'event': 'resync', 'data': {}}
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class EventBroker:
+    """
+    Внутрипроцессный брокер событий для push-доставки (Server-Sent Events).
+    Подписки хранятся по user_id; публикация рассылает событие всем
+    подключенным участникам чата.
+
+    Брокер работает в пределах одного процесса: при запуске нескольких
+    worker-процессов клиент получает события только от своего процесса,
+    поэтому клиенты должны сохранять инкрементальную синхронизацию как запасной путь.
+    """
+
+    def __init__(self, max_queue_size=100):
+        self.max_queue_size = max_queue_size
+        self._lock = threading.Lock()
+        self._subscriptions = {} # user_id -> set(EventSubscription)
+
+    def subscribe(self, user_id):
+        subscription = EventSubscription(user_id, self.max_queue_size)
+        with self._lock:
+            self._subscriptions.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            user_subscriptions = self._subscriptions.get(subscription.user_id)
+            if user_subscriptions is not None:
+                user_subscriptions.discard(subscription)
+                if not user_subscriptions:
+                    del self._subscriptions[subscription.user_id]
+
+    def has_subscribers(self):
+        """Позволяет пропустить выборку участников чата, если никто не подключен."""
+        return bool(self._subscriptions)
+
+    def publish(self, user_ids, event_name, data):
+        """Отправляет событие всем подключенным пользователям из user_ids."""
+        event = {'event': event_name, 'data': data}
+        with self._lock:
+            targets = [s for user_id in user_ids for s in self._subscriptions.get(user_id, ())]
+        for subscription in targets:
+            subscription.put(event)
+        return len(targets)
+
+
+def format_sse(event):
+    """Сериализует событие в формат text/event-stream."""
+    payload = json.dumps(event['data'], ensure_ascii=False)
+    return f"event: {event['event']}\ndata: {payload}\n\n"
+
+
+class ChatNotifier:
+    """
+    Внутрипроцессный уведомитель для long polling.
+    Запрос запоминает токен (общий счетчик изменений всех чатов) до чтения из БД
+    и затем ждет, пока send_message/delete_message не изменят его чат.
+
+    Для каждого чата хранится значение счетчика при последнем изменении, но только
+    для max_chats недавно изменявшихся чатов (LRU). Вытесненные значения поднимают
+    нижнюю границу _floor, которую получают отсутствующие чаты: изменение после токена
+    не теряется, в худшем случае ожидание завершится раньше (запрос перечитает БД).
+    """
+
+    def __init__(self, max_chats=10000):
+        self.max_chats = max_chats
+        self._lock = threading.Lock()
+        self._seq = 0 # Общий счетчик изменений
+        self._versions = OrderedDict() # chat_id -> значение _seq при последнем изменении чата
+        self._floor = 0 # Наибольшее значение среди вытесненных из _versions
+        self._conditions = {} # chat_id -> (Condition, число ожидающих)
+
+    def token(self, chat_id):
+        with self._lock:
+            return self._seq
+
+    def _changed(self, chat_id, token):
+        return self._versions.get(chat_id, self._floor) > token
+
+    def notify(self, chat_id):
+        with self._lock:
+            self._seq += 1
+            self._versions[chat_id] = self._seq
+            self._versions.move_to_end(chat_id)
+            while len(self._versions) > self.max_chats:
+                _, version = self._versions.popitem(last=False)
+                self._floor = max(self._floor, version)
+            entry = self._conditions.get(chat_id)
+            if entry is not None:
+                entry[0].notify_all()
+
+    def wait(self, chat_id, token, timeout):
+        """Ждет изменения чата после token. Возвращает True, если изменение произошло."""
+        with self._lock:
+            entry = self._conditions.get(chat_id)
+            if entry is None:
+                entry = [threading.Condition(self._lock), 0]
+                self._conditions[chat_id] = entry
+            entry[1] += 1
+            try:
+                return entry[0].wait_for(lambda: self._changed(chat_id, token), timeout)
+            finally:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._conditions[chat_id]
@@ -0,0 +1,88 @@
+import json
+
+try:
+    import orjson # Необязательная зависимость: быстрый кодировщик JSON
+except ImportError:
+    orjson = None
+
+
+def dumps(value):
+    """Сериализует значение в JSON (bytes, UTF-8). Использует orjson, если он установлен."""
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+class LazyArray:
+    """
+    JSON-массив, элементы которого берутся из итератора (например, курсора БД)
+    во время отправки ответа. transform преобразует строку в сериализуемое значение.
+    """
+
+    def __init__(self, items, transform=None):
+        self.items = items
+        self.transform = transform
+
+
+class LazyValue:
+    """
+    Значение, вычисляемое во время отправки ответа.
+    Нужно для полей, зависящих от уже выданных элементов массива (курсор страницы и т.п.).
+    """
+
+    def __init__(self, func):
+        self.func = func
+
+
+def resolve(value):
+    """
+    Раскрывает LazyArray/LazyValue в обычные списки и значения (в порядке ключей словаря).
+    Нужно для форматов, которым количество элементов требуется заранее (MessagePack).
+    """
+    if isinstance(value, LazyArray):
+        return [value.transform(item) if value.transform else item for item in value.items]
+    if isinstance(value, LazyValue):
+        return resolve(value.func())
+    if isinstance(value, dict):
+        return {key: resolve(item) for key, item in value.items()}
+    return value
+
+
+def _encode(value):
+    if isinstance(value, LazyArray):
+        yield b'['
+        separator = b''
+        for item in value.items:
+            yield separator + dumps(value.transform(item) if value.transform else item)
+            separator = b','
+        yield b']'
+    elif isinstance(value, LazyValue):
+        yield from _encode(value.func())
+    elif isinstance(value, dict):
+        yield b'{'
+        separator = b''
+        for key, item in value.items():
+            yield separator + dumps(str(key)) + b':'
+            yield from _encode(item)
+            separator = b','
+        yield b'}'
+    else:
+        yield dumps(value)
+
+
+def iter_json(value, chunk_size=64 * 1024):
+    """
+    Генератор JSON-представления value порциями примерно по chunk_size байт.
+    Словари обходятся по порядку ключей, поэтому LazyValue после LazyArray
+    вычисляется, когда массив уже выдан. В памяти одновременно находится
+    только текущая порция, а не весь список строк и весь закодированный ответ.
+    """
+    buffer, size = [], 0
+    for piece in _encode(value):
+        buffer.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield b''.join(buffer)
+            buffer, size = [], 0
+    if buffer:
+        yield b''.join(buffer)
@@ -0,0 +1,26 @@
+from jsonstream import resolve
+
+try:
+    import msgpack # Необязательная зависимость: ответы в формате MessagePack
+except ImportError:
+    msgpack = None
+
+JSON_MIMETYPE = 'application/json'
+MSGPACK_MIMETYPE = 'application/msgpack'
+MSGPACK_MIMETYPES = (MSGPACK_MIMETYPE, 'application/x-msgpack')
+
+
+def choose_mimetype(accept_mimetypes):
+    """
+    Выбирает формат ответа по заголовку Accept (request.accept_mimetypes).
+    MessagePack отдается, только если клиент предпочитает его JSON и модуль msgpack установлен.
+    """
+    if msgpack is None:
+        return JSON_MIMETYPE
+    best = accept_mimetypes.best_match((JSON_MIMETYPE,) + MSGPACK_MIMETYPES, default=JSON_MIMETYPE)
+    return MSGPACK_MIMETYPE if best in MSGPACK_MIMETYPES else JSON_MIMETYPE
+
+
+def pack(value):
+    """Сериализует значение (может содержать LazyArray/LazyValue) в MessagePack."""
+    return msgpack.packb(resolve(value), use_bin_type=True)
@@ -1,6 +1,13 @@
 -- schema.sql
 -- Содержит SQL-запросы для создания всех таблиц базы данных
 
+DROP TABLE IF EXISTS upload_sessions;
+DROP TABLE IF EXISTS blobs;
+DROP TABLE IF EXISTS revisions;
+DROP TABLE IF EXISTS messages_fts;
+DROP TABLE IF EXISTS users_trigram_fts;
+DROP TABLE IF EXISTS users_prefix_fts;
+DROP TABLE IF EXISTS chat_read_cursors;
 DROP TABLE IF EXISTS messages;
 DROP TABLE IF EXISTS channel_subscribers;
 DROP TABLE IF EXISTS group_members;
@@ -17,11 +24,17 @@ CREATE TABLE users (
     avatar_url TEXT,
     created_at TEXT DEFAULT CURRENT_TIMESTAMP NOT NULL,
     updated_at TEXT DEFAULT CURRENT_TIMESTAMP NOT NULL,
-    is_deleted BOOLEAN DEFAULT FALSE NOT NULL
+    is_deleted BOOLEAN DEFAULT FALSE NOT NULL,
+    -- Нормализованные для поиска копии (регистр, ё -> е); search_fold() регистрирует database.py
+    username_folded TEXT GENERATED ALWAYS AS (search_fold(username)) STORED,
+    display_name_folded TEXT GENERATED ALWAYS AS (search_fold(display_name)) STORED
 );
 
 CREATE INDEX IF NOT EXISTS idx_users_username ON users (username);
 CREATE INDEX IF NOT EXISTS idx_users_email ON users (email);
+-- Точные совпадения и совпадения начала строки в поиске пользователей
+CREATE INDEX IF NOT EXISTS idx_users_username_folded ON users (username_folded);
+CREATE INDEX IF NOT EXISTS idx_users_display_name_folded ON users (display_name_folded);
 
 CREATE TABLE chats (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -31,6 +44,7 @@ CREATE TABLE chats (
     created_at TEXT DEFAULT CURRENT_TIMESTAMP NOT NULL,
     updated_at TEXT DEFAULT CURRENT_TIMESTAMP NOT NULL,
     owner_id INTEGER, -- НОВОЕ: Добавлен столбец owner_id для каналов
+    version INTEGER DEFAULT 0 NOT NULL, -- Счетчик изменений чата (сообщения, данные чата, участники) для ETag
     FOREIGN KEY (owner_id) REFERENCES users(id) ON DELETE SET NULL -- Если пользователь-владелец удален, owner_id становится NULL
 );
 
@@ -76,20 +90,295 @@ CREATE TABLE messages (
     file_url TEXT,
     file_name TEXT,
     file_size INTEGER,
+    file_sha256 TEXT, -- Содержимое файла в хранилище по адресу содержимого (таблица blobs)
+    width INTEGER, -- Размеры изображения; заполняются после построения миниатюры
+    height INTEGER,
     sent_at TEXT DEFAULT CURRENT_TIMESTAMP NOT NULL,
     is_deleted BOOLEAN DEFAULT FALSE NOT NULL,
     deleted_by INTEGER, -- Пользователь, который удалил сообщение (мягкое удаление)
+    revision INTEGER DEFAULT 0 NOT NULL, -- Ревизия внутри чата: растет при добавлении, мягком удалении сообщения и записи размеров изображения
     FOREIGN KEY (chat_id) REFERENCES chats(id) ON DELETE CASCADE,
     FOREIGN KEY (sender_id) REFERENCES users(id) ON DELETE SET NULL,
     FOREIGN KEY (deleted_by) REFERENCES users(id) ON DELETE SET NULL,
-    CHECK ( (message_type = 'text' AND content IS NOT NULL AND file_url IS NULL) OR
+    -- Мягко удаленные сообщения хранятся без содержимого (content/file_url обнуляются)
+    CHECK ( is_deleted OR
+            (message_type = 'text' AND content IS NOT NULL AND file_url IS NULL) OR
             (message_type = 'file' AND content IS NULL AND file_url IS NOT NULL) )
 );
 
+-- Курсор прочтения: последнее прочитанное участником сообщение чата (для счетчика непрочитанных)
+CREATE TABLE chat_read_cursors (
+    chat_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    last_read_message_id INTEGER NOT NULL DEFAULT 0,
+    updated_at TEXT DEFAULT CURRENT_TIMESTAMP NOT NULL,
+    PRIMARY KEY (chat_id, user_id),
+    FOREIGN KEY (chat_id) REFERENCES chats(id) ON DELETE CASCADE,
+    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+);
+
 -- Индексы для ускорения поиска по связям
 CREATE INDEX IF NOT EXISTS idx_private_chats_user1_user2 ON private_chats (user1_id, user2_id);
 CREATE INDEX IF NOT EXISTS idx_group_members_group_user ON group_members (group_id, user_id);
 CREATE INDEX IF NOT EXISTS idx_channel_subscribers_channel_user ON channel_subscribers (channel_id, user_id);
-CREATE INDEX IF NOT EXISTS idx_messages_chat_id ON messages (chat_id);
+-- Индексы для выборки списка чатов пользователя (GET /api/chats)
+CREATE INDEX IF NOT EXISTS idx_private_chats_user2 ON private_chats (user2_id);
+CREATE INDEX IF NOT EXISTS idx_group_members_user ON group_members (user_id);
+CREATE INDEX IF NOT EXISTS idx_channel_subscribers_user ON channel_subscribers (user_id);
+-- Составной индекс для курсорной пагинации сообщений внутри чата (WHERE chat_id = ? AND id < ? ORDER BY id)
+CREATE INDEX IF NOT EXISTS idx_messages_chat_id_id ON messages (chat_id, id);
 CREATE INDEX IF NOT EXISTS idx_messages_sender_id ON messages (sender_id);
-CREATE INDEX IF NOT EXISTS idx_messages_sent_at ON messages (sent_at);
\ No newline at end of file
+CREATE INDEX IF NOT EXISTS idx_messages_sent_at ON messages (sent_at);
+CREATE INDEX IF NOT EXISTS idx_messages_chat_revision ON messages (chat_id, revision);
+-- Сообщения с тем же содержимым файла (размеры изображения, миниатюры)
+CREATE INDEX IF NOT EXISTS idx_messages_file_sha256 ON messages (file_sha256);
+-- Имя старого файла (плоская загрузка до хранения по адресу содержимого) для проверки ссылок в gc-uploads
+CREATE INDEX IF NOT EXISTS idx_messages_legacy_file ON messages (substr(file_url, instr(file_url, '/uploads/') + 9))
+    WHERE file_url IS NOT NULL AND file_sha256 IS NULL;
+
+-- Триггеры ревизий сообщений для инкрементальной синхронизации (GET /api/chats/<id>/messages/sync).
+-- Каждое новое сообщение и каждое мягкое удаление получает следующую ревизию своего чата.
+CREATE TRIGGER IF NOT EXISTS trg_messages_revision_insert
+AFTER INSERT ON messages
+BEGIN
+    UPDATE messages
+    SET revision = (SELECT COALESCE(MAX(revision), 0) + 1 FROM messages WHERE chat_id = NEW.chat_id)
+    WHERE id = NEW.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_messages_revision_delete
+AFTER UPDATE OF is_deleted ON messages
+WHEN NEW.is_deleted AND NOT OLD.is_deleted
+BEGIN
+    UPDATE messages
+    SET revision = (SELECT COALESCE(MAX(revision), 0) + 1 FROM messages WHERE chat_id = NEW.chat_id)
+    WHERE id = NEW.id;
+END;
+
+-- Размеры изображения записываются после создания сообщения (фоновая миниатюра),
+-- поэтому синхронизация должна вернуть сообщение повторно
+CREATE TRIGGER IF NOT EXISTS trg_messages_revision_dimensions
+AFTER UPDATE OF width, height ON messages
+WHEN NEW.width IS NOT OLD.width OR NEW.height IS NOT OLD.height
+BEGIN
+    UPDATE messages
+    SET revision = (SELECT COALESCE(MAX(revision), 0) + 1 FROM messages WHERE chat_id = NEW.chat_id)
+    WHERE id = NEW.id;
+END;
+
+-- Полнотекстовый индекс сообщений (FTS5, external content поверх messages).
+-- Индексируются текст и имя файла неудаленных сообщений; unicode61 приводит регистр,
+-- в том числе для кириллицы.
+CREATE VIRTUAL TABLE messages_fts USING fts5(
+    content,
+    file_name,
+    content='messages',
+    content_rowid='id',
+    tokenize='unicode61 remove_diacritics 2'
+);
+
+-- Триггеры синхронизации messages_fts с messages
+CREATE TRIGGER IF NOT EXISTS trg_messages_fts_insert
+AFTER INSERT ON messages
+WHEN NOT NEW.is_deleted
+BEGIN
+    INSERT INTO messages_fts (rowid, content, file_name) VALUES (NEW.id, NEW.content, NEW.file_name);
+END;
+
+-- Мягкое удаление (delete_message) обнуляет content/file_name, поэтому из индекса убираем старые значения
+CREATE TRIGGER IF NOT EXISTS trg_messages_fts_soft_delete
+AFTER UPDATE OF is_deleted ON messages
+WHEN NEW.is_deleted AND NOT OLD.is_deleted
+BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, content, file_name) VALUES ('delete', OLD.id, OLD.content, OLD.file_name);
+END;
+
+-- Физическое удаление (например, каскадом при удалении чата)
+CREATE TRIGGER IF NOT EXISTS trg_messages_fts_delete
+AFTER DELETE ON messages
+WHEN NOT OLD.is_deleted
+BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, content, file_name) VALUES ('delete', OLD.id, OLD.content, OLD.file_name);
+END;
+
+-- Индексы поиска пользователей (GET /api/users/search) по username и display_name.
+-- users_trigram_fts: поиск подстроки для запросов от 3 символов.
+-- users_prefix_fts: поиск по началу слова для коротких запросов (1-2 символа).
+-- Индексируются нормализованные столбцы *_folded (регистр, ё -> е).
+CREATE VIRTUAL TABLE users_trigram_fts USING fts5(
+    username_folded,
+    display_name_folded,
+    content='users',
+    content_rowid='id',
+    tokenize='trigram'
+);
+
+CREATE VIRTUAL TABLE users_prefix_fts USING fts5(
+    username_folded,
+    display_name_folded,
+    content='users',
+    content_rowid='id',
+    tokenize='unicode61 remove_diacritics 2',
+    prefix='1 2'
+);
+
+CREATE TRIGGER IF NOT EXISTS trg_users_search_insert
+AFTER INSERT ON users
+BEGIN
+    INSERT INTO users_trigram_fts (rowid, username_folded, display_name_folded) VALUES (NEW.id, NEW.username_folded, NEW.display_name_folded);
+    INSERT INTO users_prefix_fts (rowid, username_folded, display_name_folded) VALUES (NEW.id, NEW.username_folded, NEW.display_name_folded);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_users_search_update
+AFTER UPDATE OF username, display_name ON users
+BEGIN
+    INSERT INTO users_trigram_fts (users_trigram_fts, rowid, username_folded, display_name_folded) VALUES ('delete', OLD.id, OLD.username_folded, OLD.display_name_folded);
+    INSERT INTO users_prefix_fts (users_prefix_fts, rowid, username_folded, display_name_folded) VALUES ('delete', OLD.id, OLD.username_folded, OLD.display_name_folded);
+    INSERT INTO users_trigram_fts (rowid, username_folded, display_name_folded) VALUES (NEW.id, NEW.username_folded, NEW.display_name_folded);
+    INSERT INTO users_prefix_fts (rowid, username_folded, display_name_folded) VALUES (NEW.id, NEW.username_folded, NEW.display_name_folded);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_users_search_delete
+AFTER DELETE ON users
+BEGIN
+    INSERT INTO users_trigram_fts (users_trigram_fts, rowid, username_folded, display_name_folded) VALUES ('delete', OLD.id, OLD.username_folded, OLD.display_name_folded);
+    INSERT INTO users_prefix_fts (users_prefix_fts, rowid, username_folded, display_name_folded) VALUES ('delete', OLD.id, OLD.username_folded, OLD.display_name_folded);
+END;
+
+-- Счетчики ревизий наборов данных для ETag/If-None-Match (например, GET /api/users).
+-- Счетчик растет при любом изменении соответствующей таблицы.
+CREATE TABLE revisions (
+    name TEXT PRIMARY KEY,
+    revision INTEGER NOT NULL DEFAULT 0
+);
+
+INSERT INTO revisions (name, revision) VALUES ('users', 0);
+
+CREATE TRIGGER IF NOT EXISTS trg_users_revision_insert
+AFTER INSERT ON users
+BEGIN
+    UPDATE revisions SET revision = revision + 1 WHERE name = 'users';
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_users_revision_update
+AFTER UPDATE ON users
+BEGIN
+    UPDATE revisions SET revision = revision + 1 WHERE name = 'users';
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_users_revision_delete
+AFTER DELETE ON users
+BEGIN
+    UPDATE revisions SET revision = revision + 1 WHERE name = 'users';
+END;
+
+-- Счетчик изменений чата (chats.version): растет при новых и удаленных сообщениях,
+-- изменении данных чата и составе участников. Используется как ETag списка чатов и истории.
+CREATE TRIGGER IF NOT EXISTS trg_chats_version_message_insert
+AFTER INSERT ON messages
+BEGIN
+    UPDATE chats SET version = version + 1 WHERE id = NEW.chat_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_chats_version_message_update
+AFTER UPDATE OF is_deleted, content, file_url, width, height ON messages
+BEGIN
+    UPDATE chats SET version = version + 1 WHERE id = NEW.chat_id;
+END;
+
+-- Любое изменение строки чата, кроме самого счетчика (условие WHEN исключает рекурсию)
+CREATE TRIGGER IF NOT EXISTS trg_chats_version_update
+AFTER UPDATE ON chats
+WHEN NEW.version = OLD.version
+BEGIN
+    UPDATE chats SET version = version + 1 WHERE id = NEW.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_chats_version_group_insert
+AFTER INSERT ON group_members
+BEGIN
+    UPDATE chats SET version = version + 1 WHERE id = NEW.group_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_chats_version_group_update
+AFTER UPDATE ON group_members
+BEGIN
+    UPDATE chats SET version = version + 1 WHERE id = NEW.group_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_chats_version_group_delete
+AFTER DELETE ON group_members
+BEGIN
+    UPDATE chats SET version = version + 1 WHERE id = OLD.group_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_chats_version_channel_insert
+AFTER INSERT ON channel_subscribers
+BEGIN
+    UPDATE chats SET version = version + 1 WHERE id = NEW.channel_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_chats_version_channel_delete
+AFTER DELETE ON channel_subscribers
+BEGIN
+    UPDATE chats SET version = version + 1 WHERE id = OLD.channel_id;
+END;
+
+-- Сессии возобновляемой загрузки файлов (POST /api/chats/<id>/uploads).
+-- Части файла дописываются во временный файл UPLOAD_TEMP_FOLDER/<id>.part;
+-- received_size - сколько байт уже надежно записано (с этого смещения клиент продолжает).
+-- status = 'writing' - запрос PUT сейчас пишет часть (защита от параллельной записи).
+CREATE TABLE upload_sessions (
+    id TEXT PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    chat_id INTEGER NOT NULL,
+    file_name TEXT NOT NULL,
+    file_size INTEGER NOT NULL,
+    sha256 TEXT, -- Ожидаемый хеш от клиента (необязательно): проверяется при завершении
+    received_size INTEGER DEFAULT 0 NOT NULL,
+    status TEXT DEFAULT 'pending' NOT NULL CHECK(status IN ('pending', 'writing')),
+    created_at TEXT DEFAULT CURRENT_TIMESTAMP NOT NULL,
+    updated_at TEXT DEFAULT CURRENT_TIMESTAMP NOT NULL,
+    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
+    FOREIGN KEY (chat_id) REFERENCES chats(id) ON DELETE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS idx_upload_sessions_updated_at ON upload_sessions (updated_at);
+
+-- Файлы по адресу содержимого: один файл на уникальный SHA-256, сколько бы сообщений на него ни ссылалось.
+-- ref_count поддерживается триггерами по messages.file_sha256. Файлы с ref_count = 0 удаляются
+-- сборщиком мусора не раньше, чем через период ожидания после updated_at
+-- (защита от гонки с отправкой, которая только что сохранила файл).
+CREATE TABLE blobs (
+    sha256 TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    ref_count INTEGER DEFAULT 0 NOT NULL,
+    created_at TEXT DEFAULT CURRENT_TIMESTAMP NOT NULL,
+    updated_at TEXT DEFAULT CURRENT_TIMESTAMP NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_blobs_unreferenced ON blobs (updated_at) WHERE ref_count = 0;
+
+CREATE TRIGGER IF NOT EXISTS trg_blobs_ref_insert
+AFTER INSERT ON messages
+WHEN NEW.file_sha256 IS NOT NULL
+BEGIN
+    UPDATE blobs SET ref_count = ref_count + 1, updated_at = CURRENT_TIMESTAMP WHERE sha256 = NEW.file_sha256;
+END;
+
+-- Мягкое удаление обнуляет file_sha256 - ссылка освобождается
+CREATE TRIGGER IF NOT EXISTS trg_blobs_ref_update
+AFTER UPDATE OF file_sha256 ON messages
+WHEN OLD.file_sha256 IS NOT NEW.file_sha256
+BEGIN
+    UPDATE blobs SET ref_count = ref_count - 1, updated_at = CURRENT_TIMESTAMP WHERE sha256 = OLD.file_sha256;
+    UPDATE blobs SET ref_count = ref_count + 1, updated_at = CURRENT_TIMESTAMP WHERE sha256 = NEW.file_sha256;
+END;
+
+-- Срабатывает и при каскадном удалении сообщений вместе с чатом
+CREATE TRIGGER IF NOT EXISTS trg_blobs_ref_delete
+AFTER DELETE ON messages
+WHEN OLD.file_sha256 IS NOT NULL
+BEGIN
+    UPDATE blobs SET ref_count = ref_count - 1, updated_at = CURRENT_TIMESTAMP WHERE sha256 = OLD.file_sha256;
+END;
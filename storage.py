@@ -0,0 +1,173 @@
+import os
+import tempfile
+
+try:
+    import boto3 # Необязательная зависимость: S3-совместимое хранилище
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
+    ClientError = None
+
+
+class LocalStorage:
+    """
+    Файлы на локальном диске. Ключ раскладывается по вложенным каталогам по префиксу
+    (ab/cd/abcd...), чтобы в одном каталоге не оказывались миллионы файлов.
+    """
+
+    def __init__(self, root, shard_depth=2, shard_width=2):
+        self.root = root
+        self.shard_depth = shard_depth
+        self.shard_width = shard_width
+
+    def relpath(self, key):
+        """Путь файла относительно root (для X-Accel-Redirect)."""
+        shards = [key[i * self.shard_width:(i + 1) * self.shard_width] for i in range(self.shard_depth)]
+        return '/'.join(shards + [key])
+
+    def local_path(self, key):
+        return os.path.join(self.root, *self.relpath(key).split('/'))
+
+    def url(self, key, mimetype=None):
+        return None # Файл отдает приложение или фронт-прокси
+
+    def exists(self, key):
+        return os.path.isfile(self.local_path(key))
+
+    def put_file(self, key, source_path):
+        """
+        Переносит готовый локальный файл в хранилище под ключом key.
+        Если такой ключ уже есть (то же содержимое), source_path удаляется.
+        """
+        path = self.local_path(key)
+        if os.path.exists(path):
+            os.remove(source_path)
+            return
+        # Сборка мусора может удалить пустой каталог-шард между makedirs и replace: пробуем снова
+        for attempt in range(3):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            try:
+                os.replace(source_path, path)
+                return
+            except FileNotFoundError:
+                if attempt == 2 or not os.path.exists(source_path):
+                    raise
+
+    def open(self, key):
+        return open(self.local_path(key), 'rb')
+
+    def delete(self, key):
+        try:
+            os.remove(self.local_path(key))
+        except FileNotFoundError:
+            pass
+
+    def iter_entries(self):
+        """(key, size, mtime) всех хранимых файлов; обходятся только каталоги-шарды."""
+        def walk(path, level):
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if level < self.shard_depth:
+                        if entry.is_dir(follow_symlinks=False):
+                            yield from walk(entry.path, level + 1)
+                        # Файлы вне шардов (старые плоские загрузки) хранилищу не принадлежат
+                    elif entry.is_file(follow_symlinks=False):
+                        stat = entry.stat()
+                        yield entry.name, stat.st_size, stat.st_mtime
+        if os.path.isdir(self.root):
+            yield from walk(self.root, 0)
+
+
+class S3Storage:
+    """
+    S3-совместимое хранилище (AWS S3, MinIO и т.п.; адрес задается endpoint_url).
+    Файлы отдаются клиенту по временной подписанной ссылке напрямую из хранилища.
+    Объект передается в процессы пула миниатюр, поэтому клиент boto3 создается лениво.
+    """
+
+    def __init__(self, bucket, prefix='', endpoint_url=None, region=None,
+                 access_key_id=None, secret_access_key=None, url_expires=3600,
+                 spool_size=16 * 1024 * 1024):
+        if boto3 is None:
+            raise RuntimeError('Для STORAGE_BACKEND=s3 нужен модуль boto3.')
+        self.bucket = bucket
+        self.prefix = prefix
+        self.url_expires = url_expires
+        self.spool_size = spool_size
+        self._client_kwargs = dict(endpoint_url=endpoint_url, region_name=region,
+                                   aws_access_key_id=access_key_id,
+                                   aws_secret_access_key=secret_access_key)
+        self._client = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_client'] = None # Клиент boto3 не сериализуется
+        return state
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = boto3.client('s3', **self._client_kwargs)
+        return self._client
+
+    def _object_key(self, key):
+        return self.prefix + key
+
+    def local_path(self, key):
+        return None
+
+    def url(self, key, mimetype=None):
+        params = {'Bucket': self.bucket, 'Key': self._object_key(key)}
+        if mimetype:
+            params['ResponseContentType'] = mimetype
+        return self.client.generate_presigned_url('get_object', Params=params, ExpiresIn=self.url_expires)
+
+    def exists(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._object_key(key))
+            return True
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+
+    def put_file(self, key, source_path):
+        try:
+            if not self.exists(key):
+                self.client.upload_file(source_path, self.bucket, self._object_key(key))
+        finally:
+            os.remove(source_path)
+
+    def open(self, key):
+        """Файловый объект с содержимым (небольшие файлы - в памяти, большие - во временном файле)."""
+        spool = tempfile.SpooledTemporaryFile(max_size=self.spool_size)
+        try:
+            self.client.download_fileobj(self.bucket, self._object_key(key), spool)
+        except Exception:
+            spool.close()
+            raise
+        spool.seek(0)
+        return spool
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self._object_key(key))
+
+    def iter_entries(self):
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for item in page.get('Contents', ()):
+                yield item['Key'][len(self.prefix):], item['Size'], item['LastModified'].timestamp()
+
+
+def create_storage(config):
+    """Создает хранилище загрузок по настройкам приложения (STORAGE_BACKEND)."""
+    backend = config['STORAGE_BACKEND']
+    if backend == 'local':
+        return LocalStorage(config['UPLOAD_FOLDER'], shard_depth=config['STORAGE_SHARD_DEPTH'])
+    if backend == 's3':
+        return S3Storage(config['S3_BUCKET'], prefix=config['S3_PREFIX'],
+                         endpoint_url=config['S3_ENDPOINT_URL'], region=config['S3_REGION'],
+                         access_key_id=config['S3_ACCESS_KEY_ID'],
+                         secret_access_key=config['S3_SECRET_ACCESS_KEY'],
+                         url_expires=config['S3_URL_EXPIRES'])
+    raise ValueError(f'Неизвестное хранилище STORAGE_BACKEND={backend!r}')
@@ -0,0 +1,45 @@
+import os
+
+try:
+    from PIL import Image # Необязательная зависимость: миниатюры изображений (Pillow)
+except ImportError:
+    Image = None
+
+THUMBNAILS_AVAILABLE = Image is not None
+
+# Расширения вложений, для которых строятся миниатюры
+THUMBNAIL_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+
+
+def is_image(file_name):
+    return '.' in file_name and file_name.rsplit('.', 1)[1].lower() in THUMBNAIL_EXTENSIONS
+
+
+def build_thumbnail(storage, key, target_path, size, quality):
+    """
+    Строит JPEG-миниатюру файла key из хранилища storage, вписанную в квадрат size x size,
+    и атомарно кладет ее в target_path. Выполняется в процессе пула (модуль импортируется
+    заново, поэтому функция не зависит от Flask). Возвращает (width, height) исходного изображения.
+    """
+    with storage.open(key) as source, Image.open(source) as image:
+        width, height = image.size
+        image.draft('RGB', (size, size)) # JPEG декодируется сразу в уменьшенном масштабе
+        image.thumbnail((size, size))
+        if image.mode in ('RGBA', 'LA', 'P'):
+            # Прозрачность в JPEG не поддерживается - кладем изображение на белый фон
+            image = image.convert('RGBA')
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel('A'))
+            image = background
+        elif image.mode != 'RGB':
+            image = image.convert('RGB')
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        temp_path = f'{target_path}.{os.getpid()}.tmp'
+        try:
+            image.save(temp_path, 'JPEG', quality=quality, optimize=True)
+            os.replace(temp_path, target_path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+    return width, height
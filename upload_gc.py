@@ -0,0 +1,225 @@
+import os
+import re
+import time
+from itertools import islice
+
+# Ключи хранилища по адресу содержимого
+_SHA256_RE = re.compile(r'^[0-9a-f]{64}$')
+
+
+class GcReport:
+    """Счетчики одного этапа сборки мусора: сколько проверено, сколько удалено и сколько байт освобождено."""
+
+    def __init__(self, title):
+        self.title = title
+        self.scanned = 0
+        self.deleted = 0
+        self.freed_bytes = 0
+
+    def collected(self, size):
+        self.deleted += 1
+        self.freed_bytes += size or 0
+
+
+def _batches(items, size):
+    iterator = iter(items)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _delete(storage, key):
+    """Удаляет файл и пустые каталоги-шарды над ним (ab/cd/), если хранилище локальное."""
+    storage.delete(key)
+    local_path = getattr(storage, 'local_path', None)
+    if local_path is None:
+        return
+    path = os.path.dirname(local_path(key))
+    for _ in range(storage.shard_depth):
+        try:
+            os.rmdir(path) # Непустой каталог не удаляется (OSError)
+        except OSError:
+            return
+        path = os.path.dirname(path)
+
+
+def collect_unreferenced_blobs(db, storage, thumbnails, grace, batch_size, dry_run):
+    """
+    Файлы из blobs, на которые не ссылается ни одно сообщение (ref_count = 0) дольше grace секунд.
+    Строка и файл удаляются в одной транзакции записи с повторной проверкой условий: загрузка
+    того же содержимого сначала касается строки blobs (ждет эту транзакцию), а потом кладет файл,
+    поэтому файл, который снова используется, не удаляется.
+    """
+    report = GcReport('Файлы без ссылок (blobs.ref_count = 0)')
+    age = f'-{int(grace)} seconds'
+    last_sha256 = ''
+    while True:
+        rows = db.execute(
+            """
+            SELECT sha256, size FROM blobs
+            WHERE ref_count = 0 AND updated_at < datetime('now', ?) AND sha256 > ?
+            ORDER BY sha256 LIMIT ?
+            """,
+            (age, last_sha256, batch_size)
+        ).fetchall()
+        if not rows:
+            break
+        last_sha256 = rows[-1]['sha256']
+        report.scanned += len(rows)
+        for row in rows:
+            if not dry_run:
+                # Транзакция на файл: писатель не блокируется на время удаления всей пачки (например, из S3)
+                db.execute("BEGIN IMMEDIATE")
+                try:
+                    if not db.execute(
+                        "DELETE FROM blobs WHERE sha256 = ? AND ref_count = 0 AND updated_at < datetime('now', ?)",
+                        (row['sha256'], age)
+                    ).rowcount:
+                        db.rollback()
+                        continue
+                    _delete(storage, row['sha256'])
+                    db.commit()
+                except Exception:
+                    db.rollback()
+                    raise
+                _delete(thumbnails, row['sha256'] + '.jpg')
+            report.collected(row['size'])
+    return report
+
+
+def collect_orphan_files(db, storage, thumbnails, grace, batch_size, dry_run):
+    """
+    Файлы хранилища без строки в blobs и без сообщений (например, сообщение не удалось создать
+    после загрузки). Файлы моложе grace секунд пропускаются: их загрузка может еще завершаться.
+    Перед удалением отсутствие строки проверяется снова в транзакции записи (см. collect_unreferenced_blobs).
+    """
+    report = GcReport('Файлы хранилища без записи в blobs')
+    cutoff = time.time() - grace
+    for batch in _batches(storage.iter_entries(), batch_size):
+        report.scanned += len(batch)
+        candidates = [(key, size) for key, size, mtime in batch if mtime < cutoff and _SHA256_RE.match(key)]
+        if not candidates:
+            continue
+        keys = [key for key, _ in candidates]
+        placeholders = ','.join('?' * len(keys))
+        known = {row[0] for row in db.execute(f"SELECT sha256 FROM blobs WHERE sha256 IN ({placeholders})", keys)}
+        known.update(row[0] for row in db.execute(
+            f"SELECT DISTINCT file_sha256 FROM messages WHERE file_sha256 IN ({placeholders})", keys
+        ))
+        for key, size in candidates:
+            if key in known:
+                continue
+            if not dry_run:
+                db.execute("BEGIN IMMEDIATE")
+                try:
+                    if db.execute(
+                        """
+                        SELECT 1 WHERE EXISTS (SELECT 1 FROM blobs WHERE sha256 = ?)
+                                    OR EXISTS (SELECT 1 FROM messages WHERE file_sha256 = ?)
+                        """,
+                        (key, key)
+                    ).fetchone():
+                        db.rollback()
+                        continue
+                    _delete(storage, key)
+                    db.commit()
+                except Exception:
+                    db.rollback()
+                    raise
+                _delete(thumbnails, key + '.jpg')
+            report.collected(size)
+    return report
+
+
+def collect_legacy_files(db, upload_folder, grace, batch_size, dry_run):
+    """
+    Файлы, загруженные до хранения по адресу содержимого (плоские имена в UPLOAD_FOLDER).
+    Сверяются с messages.file_url: после удаления сообщения или чата на них никто не ссылается.
+    """
+    report = GcReport('Старые файлы UPLOAD_FOLDER без ссылок из messages.file_url')
+    if not os.path.isdir(upload_folder):
+        return report
+    cutoff = time.time() - grace
+    with os.scandir(upload_folder) as entries:
+        for batch in _batches((entry for entry in entries if entry.is_file(follow_symlinks=False)), batch_size):
+            report.scanned += len(batch)
+            names = [entry.name for entry in batch]
+            placeholders = ','.join('?' * len(names))
+            # Выражение совпадает с индексом idx_messages_legacy_file: на пачку - поиск по индексу, а не обход messages
+            referenced = {row[0] for row in db.execute(
+                f"""
+                SELECT DISTINCT substr(file_url, instr(file_url, '/uploads/') + 9) FROM messages
+                WHERE file_url IS NOT NULL AND file_sha256 IS NULL
+                  AND substr(file_url, instr(file_url, '/uploads/') + 9) IN ({placeholders})
+                """,
+                names
+            )}
+            for entry in batch:
+                if entry.name in referenced:
+                    continue
+                stat = entry.stat()
+                if stat.st_mtime >= cutoff:
+                    continue
+                if not dry_run:
+                    _remove(entry.path)
+                report.collected(stat.st_size)
+    return report
+
+
+def collect_upload_sessions(db, temp_folder, session_ttl, grace, batch_size, dry_run):
+    """
+    Брошенные возобновляемые загрузки (нет частей дольше session_ttl секунд) и временные файлы
+    без сессии: части загрузок удаленных чатов, остатки прерванной записи.
+    """
+    report = GcReport('Незавершенные загрузки и временные файлы')
+    age = f'-{int(session_ttl)} seconds'
+    last_id = ''
+    while True:
+        rows = db.execute(
+            "SELECT id FROM upload_sessions WHERE updated_at < datetime('now', ?) AND id > ? ORDER BY id LIMIT ?",
+            (age, last_id, batch_size)
+        ).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1]['id']
+        report.scanned += len(rows)
+        for row in rows:
+            if not dry_run:
+                # Условие повторяется: сессия могла получить новую часть после выборки
+                if not db.execute("DELETE FROM upload_sessions WHERE id = ? AND updated_at < datetime('now', ?)",
+                                  (row['id'], age)).rowcount:
+                    continue
+            report.collected(0)
+        if not dry_run:
+            db.commit()
+
+    if not os.path.isdir(temp_folder):
+        return report
+    cutoff = time.time() - grace
+    with os.scandir(temp_folder) as entries:
+        for batch in _batches((entry for entry in entries if entry.is_file(follow_symlinks=False)), batch_size):
+            report.scanned += len(batch)
+            upload_ids = {entry.name.split('.', 1)[0] for entry in batch}
+            placeholders = ','.join('?' * len(upload_ids))
+            active = {row[0] for row in db.execute(
+                f"SELECT id FROM upload_sessions WHERE id IN ({placeholders})", list(upload_ids)
+            )}
+            for entry in batch:
+                if entry.name.split('.', 1)[0] in active:
+                    continue
+                stat = entry.stat()
+                if stat.st_mtime >= cutoff:
+                    continue
+                if not dry_run:
+                    _remove(entry.path)
+                report.collected(stat.st_size)
+    return report